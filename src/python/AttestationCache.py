@@ -0,0 +1,298 @@
+"""
+Device attestation cache for the gateway application.
+Challenges every paired low-end device with a fresh nonce, has the TCB check its answer, and keeps the resulting
+trust level with an expiry. Attestations are refreshed in the background before they expire, and trust checks are
+answered without waiting on the device or the TCB.
+"""
+
+import asyncio
+import dataclasses
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import metrics
+from TcbClient import TcbClient, TcbError, TcbRefused
+from logger import get_logger
+
+log = get_logger("attestation")
+
+ATTESTATIONS = metrics.counter("gateway_attestations_total", "Device attestations by result", ["result"])
+
+# Slotted dataclasses need Python 3.10, older interpreters get regular ones
+_attestation = dataclasses.dataclass(slots=True) if sys.version_info >= (3, 10) else dataclasses.dataclass
+
+
+@_attestation
+class Attestation:
+    uid: str
+    trust_level: float
+    certificate: Dict[str, Any]
+    verified_at: float  # time.monotonic() of the verified challenge
+    expires_at: float  # time.monotonic()
+
+
+def certificate_trust_level(uid: str, certificate: Dict[str, Any]) -> float:
+    """
+    Trust level a conformity certificate vouches for: its lowest claim.
+
+    Raises:
+        ValueError: If the certificate is not for this device or its claims are not numbers.
+    """
+    evidence = certificate.get('evidence') or {}
+    if evidence.get('uid') != uid:
+        raise ValueError(f"certificate is for {evidence.get('uid')!r}")
+    if not evidence.get('signature'):
+        raise ValueError("certificate is not signed")
+    claims = certificate.get('cc') or {}
+    return min(float(claims['integrity']), float(claims['access_control']))
+
+
+class AttestationCache:
+    """
+    Attestations of the tracked devices, by MAC address.
+
+    track() registers a paired low-end device by its TCB UID. The device is attested in
+    the background: it signs a fresh nonce with its key (`challenge`, e.g.
+    BluetoothAdapter.sign_challenge), the TCB checks the signature (TcbClient.verify),
+    and the trust level its conformity certificate vouches for is stored for `ttl`
+    seconds. The certificate is fetched once per device, attestations only repeat the
+    challenge. Devices due together are challenged together and their signatures
+    checked at once, so they share one TCB batch request.
+
+    `refresh_ahead` seconds before an attestation expires the device is challenged
+    again, so entries of devices in use never lapse while the device and the TCB answer.
+    A failed attempt (no answer from the device or the TCB) keeps the current entry until
+    it expires; a wrong signature, a device the TCB refuses or an invalid certificate
+    revokes it. Either way the device is tried again after `retry_delay` seconds.
+
+    trust_level() is a dictionary lookup for the instruction path: it never waits on
+    the device or the TCB, and returns None for devices without a valid attestation.
+    """
+    def __init__(self, tcb: TcbClient, challenge: Callable[[str, str], Awaitable[Optional[str]]], ttl: float = 3600.0,
+                 refresh_ahead: float = 300.0, retry_delay: float = 30.0):
+        """
+        Initialize the cache.
+
+        Args:
+            tcb (TcbClient): Client of the TCB service.
+            challenge (Callable[[str, str], Awaitable[str | None]]): Has the device with a MAC address sign a
+                hex nonce, returns the hex signature or None if the device cannot be reached.
+            ttl (float, optional): Seconds an attestation is valid.
+            refresh_ahead (float, optional): Seconds before expiry at which it is refreshed.
+            retry_delay (float, optional): Seconds before a failed attestation is tried again.
+        """
+        if not 0 <= refresh_ahead < ttl:
+            raise ValueError("refresh_ahead must be shorter than ttl")
+        self.tcb = tcb
+        self.challenge = challenge
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.retry_delay = retry_delay
+
+        self.entries: Dict[str, Attestation] = {}  # MAC address -> current attestation
+        self.uids: Dict[str, str] = {}  # MAC address -> TCB UID of tracked devices
+        self._retry_at: Dict[str, float] = {}  # MAC address -> time.monotonic() of the next attempt after a failure
+        self._refreshing: Dict[str, asyncio.Task] = {}  # MAC address -> attestation running, shared by the devices due together
+        self._wakeup: Optional[asyncio.Event] = None  # created in the event loop by run()
+
+    def track(self, address: str, uid: str):
+        """
+        Attest a device from now on. A device tracked under another UID starts over.
+        """
+        if self.uids.get(address) == uid:
+            return
+        self.forget(address)
+        self.uids[address] = uid
+        self._wake()
+
+    def forget(self, address: str):
+        """
+        Stop attesting a device, e.g. once it is unpaired. An attestation already running
+        for it finishes for the other devices, its result for this one is discarded.
+        """
+        self.uids.pop(address, None)
+        self.entries.pop(address, None)
+        self._retry_at.pop(address, None)
+        self._refreshing.pop(address, None)
+
+    def retry(self, address: str):
+        """
+        Attest a tracked device without waiting out its retry delay, e.g. once it is connected.
+        """
+        if self._retry_at.pop(address, None) is not None:
+            self._wake()
+
+    def is_tracked(self, address: str) -> bool:
+        return address in self.uids
+
+    def trust_level(self, address: str, now: Optional[float] = None) -> Optional[float]:
+        """
+        Trust level of a device's valid attestation, None if it has none.
+        """
+        entry = self.entries.get(address)
+        if entry is None or entry.expires_at <= (now if now is not None else time.monotonic()):
+            return None
+        return entry.trust_level
+
+    def valid_count(self) -> int:
+        now = time.monotonic()
+        # Read by the metrics server thread: copy before iterating, the event loop may change the entries
+        return sum(1 for entry in list(self.entries.values()) if entry.expires_at > now)
+
+    async def attest(self, address: str) -> Optional[Attestation]:
+        """
+        Attest a tracked device now, or wait for the attestation already running.
+
+        Returns:
+            Attestation | None: The new attestation, None if it failed.
+        """
+        task = self._refreshing.get(address)
+        if task is None:
+            if address not in self.uids:
+                return None
+            task = self._start([address])
+        try:
+            results = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():  # the cache stopped meanwhile
+                return None
+            raise
+        return results.get(address)
+
+    def _start(self, addresses: List[str]) -> asyncio.Task:
+        devices = {address: self.uids[address] for address in addresses}
+        task = asyncio.get_running_loop().create_task(self._refresh(devices))
+        for address in devices:
+            self._refreshing[address] = task
+        task.add_done_callback(lambda task: self._refresh_done(devices, task))
+        return task
+
+    def _refresh_done(self, devices: Dict[str, str], task: asyncio.Task):
+        for address, uid in devices.items():
+            if self._refreshing.get(address) is task:
+                del self._refreshing[address]
+            if not task.cancelled() and task.exception() is not None and self.uids.get(address) == uid:
+                # Never leave a device without a next attempt, run() would start it again at once
+                self._retry_at[address] = time.monotonic() + self.retry_delay
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Attestation of %s failed: %s", ", ".join(devices), task.exception())
+        self._wake()  # schedule the next refresh of the devices
+
+    async def _refresh(self, devices: Dict[str, str]) -> Dict[str, Optional[Attestation]]:
+        addresses = list(devices)
+        nonces = {address: TcbClient.new_nonce() for address in addresses}
+        # The devices sign their nonces concurrently...
+        answers = await asyncio.gather(*(self._answer(address, devices[address], nonces[address]) for address in addresses))
+        answered = [(address, answer) for address, answer in zip(addresses, answers) if answer is not None]
+        # ...and their signatures are checked at once, so TcbClient sends them as one batch
+        verified = await asyncio.gather(*(self.tcb.verify(devices[address], nonces[address], signature)
+                                          for address, (_, _, signature) in answered), return_exceptions=True)
+
+        results: Dict[str, Optional[Attestation]] = dict.fromkeys(addresses)
+        for (address, (certificate, trust_level, _)), valid in zip(answered, verified):
+            uid = devices[address]
+            if self.uids.get(address) != uid:  # forgotten or re-tracked meanwhile
+                continue
+            if isinstance(valid, TcbRefused):
+                self._invalid(address, uid, f"the TCB refused the device: {valid}")
+            elif isinstance(valid, (TcbError, ValueError, KeyError)):
+                self._failed(address, uid, valid)
+            elif isinstance(valid, BaseException):
+                raise valid
+            elif not valid:
+                self._invalid(address, uid, "wrong signature of the challenge")
+            else:
+                now = time.monotonic()
+                entry = results[address] = self.entries[address] = Attestation(uid, trust_level, certificate, now, now + self.ttl)
+                self._retry_at.pop(address, None)
+                ATTESTATIONS.labels('ok').inc()
+                log.info("Attested %s (%s), trust level %s", address, uid, entry.trust_level)
+        return results
+
+    async def _answer(self, address: str, uid: str, nonce: str) -> Optional[Tuple[Dict[str, Any], float, str]]:
+        """
+        Certificate and trust level of a device and its signature of the nonce, None if it cannot be attested now.
+        """
+        entry = self.entries.get(address)
+        if entry is not None and entry.uid == uid:
+            certificate = entry.certificate
+        else:
+            try:
+                certificate = await self.tcb.conformity_certificate(uid)
+            except (TcbError, ValueError, KeyError) as e:
+                self._failed(address, uid, e)
+                return None
+        if self.uids.get(address) != uid:
+            return None
+        try:
+            trust_level = certificate_trust_level(uid, certificate)
+        except (ValueError, KeyError, TypeError) as e:
+            # The TCB answered, but does not vouch for the device (any more)
+            self._invalid(address, uid, f"invalid conformity certificate: {e}")
+            return None
+
+        try:
+            signature = await self.challenge(address, nonce)
+        except Exception as e:
+            self._failed(address, uid, f"challenge not answered: {e}")
+            return None
+        if not signature:
+            self._failed(address, uid, "device not connected")
+            return None
+        return certificate, trust_level, signature
+
+    def _failed(self, address: str, uid: str, reason):
+        ATTESTATIONS.labels('failed').inc()
+        self._retry_at[address] = time.monotonic() + self.retry_delay
+        log.warning("Attestation of %s (%s) failed: %s%s", address, uid, reason,
+                    ", keeping the current one until it expires" if address in self.entries else "")
+
+    def _invalid(self, address: str, uid: str, reason: str):
+        ATTESTATIONS.labels('invalid').inc()
+        self.entries.pop(address, None)
+        self._retry_at[address] = time.monotonic() + self.retry_delay
+        log.warning("Attestation of %s (%s) revoked: %s", address, uid, reason)
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _due_at(self, address: str) -> float:
+        """
+        time.monotonic() at which a device should next be attested.
+        """
+        entry = self.entries.get(address)
+        due = entry.expires_at - self.refresh_ahead if entry is not None else 0.0
+        return max(due, self._retry_at.get(address, 0.0))
+
+    async def run(self):
+        """
+        Attest new devices and refresh attestations before they expire, until cancelled.
+        """
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                self._wakeup.clear()
+                now = time.monotonic()
+                next_due = None
+                due = []
+                for address in list(self.uids):
+                    if address in self._refreshing:
+                        continue
+                    due_at = self._due_at(address)
+                    if due_at <= now:
+                        due.append(address)
+                    elif next_due is None or due_at < next_due:
+                        next_due = due_at
+                if due:
+                    self._start(due)
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), next_due - now if next_due is not None else None)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._wakeup = None
+            for task in set(self._refreshing.values()):
+                task.cancel()
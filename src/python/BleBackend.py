@@ -0,0 +1,274 @@
+"""
+BLE backends for the gateway application.
+BluetoothAdapter talks to devices through a backend: Bleak for real hardware,
+or an in-memory fake for load testing without Bluetooth.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import random
+import struct
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional
+
+import config as config
+
+
+class BleBackend(ABC):
+    """
+    Creates BleakClient-compatible clients and scans for devices.
+    """
+    @abstractmethod
+    def create_client(self, address: str, disconnected_callback: Optional[Callable[[Any], None]] = None):
+        """
+        Create a client for a device. The client is not connected yet.
+
+        Args:
+            address (str): MAC address of the device.
+            disconnected_callback (Callable, optional): Called with the client when the link drops.
+        """
+        pass
+
+    @abstractmethod
+    async def discover(self, timeout: float) -> List[Any]:
+        """
+        Scan for devices. Returned objects have address, name and rssi attributes.
+        """
+        pass
+
+
+class BleakBackend(BleBackend):
+    """
+    Real Bluetooth through Bleak. Bleak is imported on first use.
+    """
+    def create_client(self, address: str, disconnected_callback: Optional[Callable[[Any], None]] = None):
+        from bleak import BleakClient
+        return BleakClient(address, disconnected_callback=disconnected_callback)
+
+    async def discover(self, timeout: float) -> List[Any]:
+        from bleak import BleakScanner
+        return await BleakScanner.discover(timeout=timeout)
+
+
+class FakeBleError(Exception):
+    """
+    Raised by the fake backend where Bleak would raise BleakError.
+    """
+    pass
+
+
+class FakeDevice:
+    """
+    A simulated peripheral. Each notification is payload_size bytes; the first 8 bytes
+    carry time.monotonic() at generation, the rest a sequence counter.
+    """
+    def __init__(self, address: str, name: str = None, rssi: int = -60, rate: float = 10.0, payload_size: int = 20,
+                 key: Optional[str] = None):
+        self.address = address
+        self.name = name or f"Fake {address}"
+        self.rssi = rssi
+        self.rate = rate
+        self.payload_size = max(payload_size, 8)
+        self.key = bytes.fromhex(key) if key else None  # HMAC key shared with the TCB, None: no attestation
+        self._sequence = 0
+
+    def sign(self, nonce: bytes) -> bytes:
+        if self.key is None:
+            raise FakeBleError(f"{self.address} has no attestation characteristic")
+        return hmac.new(self.key, nonce, hashlib.sha256).digest()
+
+    def frame(self) -> bytearray:
+        self._sequence = (self._sequence + 1) % 256
+        header = struct.pack("!d", time.monotonic())
+        return bytearray(header + bytes([self._sequence]) * (self.payload_size - len(header)))
+
+
+class FakeBleakClient:
+    """
+    In-memory stand-in for BleakClient, with simulated latency, link drops and GATT errors.
+    """
+    def __init__(self, address: str, backend: "FakeBleBackend", disconnected_callback: Optional[Callable[[Any], None]] = None):
+        self.address = address
+        self.backend = backend
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self._callbacks: Dict[str, Callable] = {}  # characteristic UUID -> callback
+        self._notify_tasks: Dict[str, asyncio.Task] = {}  # characteristic UUID -> task
+        self._challenge = b""  # last nonce written to the attestation characteristic
+
+    async def connect(self, **kwargs) -> bool:
+        await self.backend._delay(self.backend.connect_latency)
+        device = self.backend.devices.get(self.address)
+        if device is None:
+            self.backend.stats['connect_failures'] += 1
+            raise FakeBleError(f"Device with address {self.address} was not found")
+        self.backend._maybe_fail("connect")
+        self.is_connected = True
+        self.backend.stats['connects'] += 1
+        return True
+
+    async def disconnect(self) -> bool:
+        await self.backend._delay(self.backend.disconnect_latency)
+        self._stop_all_notifications()
+        self.is_connected = False
+        return True
+
+    async def start_notify(self, char_uuid: str, callback: Callable, **kwargs):
+        self._ensure_connected()
+        await self.backend._delay(self.backend.gatt_latency)
+        self.backend._maybe_fail("start_notify")
+        # BluetoothAdapter.read_data calls start_notify repeatedly, keep a single generator per characteristic
+        self._callbacks[char_uuid] = callback
+        if char_uuid not in self._notify_tasks:
+            self._notify_tasks[char_uuid] = asyncio.create_task(self._notify_loop(char_uuid))
+
+    async def stop_notify(self, char_uuid: str):
+        self._ensure_connected()
+        await self.backend._delay(self.backend.gatt_latency)
+        self._callbacks.pop(char_uuid, None)
+        task = self._notify_tasks.pop(char_uuid, None)
+        if task is not None:
+            task.cancel()
+
+    async def write_gatt_char(self, char_uuid: str, data, response: bool = False):
+        self._ensure_connected()
+        await self.backend._delay(self.backend.gatt_latency)
+        self.backend._maybe_fail("write_gatt_char")
+        if char_uuid == config.ATTESTATION_CHALLENGE_UUID:
+            self._challenge = bytes(data)
+
+    async def read_gatt_char(self, char_uuid: str) -> bytearray:
+        self._ensure_connected()
+        await self.backend._delay(self.backend.gatt_latency)
+        self.backend._maybe_fail("read_gatt_char")
+        device = self.backend.devices[self.address]
+        if char_uuid == config.ATTESTATION_CHALLENGE_UUID:
+            return bytearray(device.sign(self._challenge))
+        return device.frame()
+
+    def _ensure_connected(self):
+        if not self.is_connected:
+            raise FakeBleError(f"Not connected to {self.address}")
+
+    def _stop_all_notifications(self):
+        for task in self._notify_tasks.values():
+            task.cancel()
+        self._notify_tasks.clear()
+        self._callbacks.clear()
+
+    def _drop_link(self):
+        self._stop_all_notifications()
+        self.is_connected = False
+        self.backend.stats['link_drops'] += 1
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    async def _notify_loop(self, char_uuid: str):
+        device = self.backend.devices[self.address]
+        interval = 1.0 / device.rate
+        drop_probability = self.backend.link_drop_rate * interval
+        next_time = time.monotonic()
+        while True:
+            callback = self._callbacks.get(char_uuid)
+            if callback is None:
+                return
+            if drop_probability and self.backend.random.random() < drop_probability:
+                self._drop_link()
+                return
+
+            result = callback(char_uuid, device.frame())
+            if asyncio.iscoroutine(result):
+                await result
+            self.backend.stats['notifications'] += 1
+
+            next_time += interval
+            await asyncio.sleep(max(0.0, next_time - time.monotonic()))
+
+
+class FakeBleBackend(BleBackend):
+    """
+    In-memory BLE backend. All randomness comes from one seeded generator, so runs are repeatable.
+    """
+    def __init__(self, rate: float = 10.0, payload_size: int = 20, connect_latency: float = 0.5,
+                 disconnect_latency: float = 0.05, gatt_latency: float = 0.01, latency_jitter: float = 0.2,
+                 link_drop_rate: float = 0.0, gatt_error_rate: float = 0.0, scan_duration: Optional[float] = None,
+                 seed: Optional[int] = None):
+        """
+        Initialize the fake backend.
+
+        Args:
+            rate (float, optional): Default notifications per second per device.
+            payload_size (int, optional): Default notification size in bytes.
+            connect_latency (float, optional): Seconds a connect takes.
+            disconnect_latency (float, optional): Seconds a disconnect takes.
+            gatt_latency (float, optional): Seconds a GATT operation takes.
+            latency_jitter (float, optional): Relative random variation of all latencies, 0.2 = +-20%.
+            link_drop_rate (float, optional): Expected link drops per second per notifying device.
+            gatt_error_rate (float, optional): Probability that a connect or GATT operation fails.
+            scan_duration (float, optional): Seconds a scan takes, None uses the full scan timeout like Bleak.
+            seed (int, optional): Seed for the random generator.
+        """
+        self.rate = rate
+        self.payload_size = payload_size
+        self.connect_latency = connect_latency
+        self.disconnect_latency = disconnect_latency
+        self.gatt_latency = gatt_latency
+        self.latency_jitter = latency_jitter
+        self.link_drop_rate = link_drop_rate
+        self.gatt_error_rate = gatt_error_rate
+        self.scan_duration = scan_duration
+        self.random = random.Random(seed)
+
+        self.devices: Dict[str, FakeDevice] = {}
+        self.stats = {'connects': 0, 'connect_failures': 0, 'link_drops': 0, 'gatt_errors': 0, 'notifications': 0}
+
+    def add_device(self, address: str, **kwargs) -> FakeDevice:
+        """
+        Make a device available for scanning and connecting.
+
+        Args:
+            address (str): MAC address of the device.
+            **kwargs: FakeDevice arguments (name, rssi, rate, payload_size, key) overriding the backend defaults.
+        """
+        kwargs.setdefault('rate', self.rate)
+        kwargs.setdefault('payload_size', self.payload_size)
+        device = FakeDevice(address, **kwargs)
+        self.devices[address] = device
+        return device
+
+    def add_devices(self, count: int, prefix: str = "FA:KE") -> List[FakeDevice]:
+        """
+        Add `count` devices with generated addresses.
+        """
+        return [self.add_device(f"{prefix}:{index // 65536:02X}:{index // 256 % 256:02X}:{index % 256:02X}:00") for index in range(count)]
+
+    def create_client(self, address: str, disconnected_callback: Optional[Callable[[Any], None]] = None) -> FakeBleakClient:
+        return FakeBleakClient(address, self, disconnected_callback)
+
+    async def discover(self, timeout: float) -> List[FakeDevice]:
+        duration = timeout if self.scan_duration is None else min(timeout, self.scan_duration)
+        await asyncio.sleep(duration)
+        return list(self.devices.values())
+
+    async def _delay(self, latency: float):
+        if latency > 0:
+            jitter = 1.0 + self.random.uniform(-self.latency_jitter, self.latency_jitter)
+            await asyncio.sleep(latency * jitter)
+
+    def _maybe_fail(self, operation: str):
+        if self.gatt_error_rate and self.random.random() < self.gatt_error_rate:
+            self.stats['gatt_errors'] += 1
+            raise FakeBleError(f"Simulated GATT error during {operation}")
+
+
+class BleBackendFactory:
+    @staticmethod
+    def create_backend(backend_type: str) -> BleBackend:
+        if backend_type == "bleak":
+            return BleakBackend()
+        elif backend_type == "fake":
+            return FakeBleBackend()
+        else:
+            raise ValueError("Unsupported BLE backend type")
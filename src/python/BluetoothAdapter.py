@@ -4,48 +4,164 @@ Handles BLE device scanning, connection, and data reception.
 """
 
 import asyncio
+import datetime
 import json
+import logging
+import math
+import uuid
 from typing import Dict, List, Optional, Callable, Any
-from bleak import BleakClient, BleakScanner
 import time
 import config as config
+import metrics
+from BleBackend import BleBackend, BleakBackend
+from ClockSync import ClockSync
+from EdgeProcessor import EdgeProcessor
+from FrameRing import FrameRing
+from GattScheduler import GattScheduler
 from MqttHandler import MqttHandler
+from logger import get_logger
+
+log = get_logger("ble")
+notify_log = get_logger("ble.notify")  # one record per notification, rate limited
+
+BLE_NOTIFICATIONS = metrics.counter("gateway_ble_notifications_total", "BLE notifications received", ["device"])
+BLE_NOTIFICATION_BYTES = metrics.counter("gateway_ble_notification_bytes_total", "BLE notification payload bytes received", ["device"])
+EDGE_ALARMS = metrics.counter("gateway_edge_alarms_total", "Samples outside the thresholds of their processing profile", ["device"])
+
+_MIN_RING_FRAMES = 64
+
+
+def sample_ring_frames(duration: float, profile: Optional[Dict[str, Any]] = None) -> int:
+    """
+    Ring capacity for a measurement: the notifications expected at the profile's "rate", else
+    config.BLE_SAMPLE_RATE, over its duration with config.BLE_SAMPLE_RING_HEADROOM, at most
+    config.BLE_SAMPLE_RING_FRAMES.
+    """
+    rate = (profile or {}).get('rate')
+    if not isinstance(rate, (int, float)) or isinstance(rate, bool) or rate <= 0:
+        rate = config.BLE_SAMPLE_RATE
+    expected = math.ceil(rate * duration * config.BLE_SAMPLE_RING_HEADROOM)
+    return max(_MIN_RING_FRAMES, min(expected, config.BLE_SAMPLE_RING_FRAMES))
+
+
+def _log_notification(sender, data):
+    if notify_log.isEnabledFor(logging.DEBUG):
+        notify_log.debug("notification from %s: %s", sender, data.hex(','))
+
 
 class DataCache:
+    """
+    Notifications of one measurement, kept in a fixed-capacity FrameRing so memory does not
+    grow with the sampling rate or the measurement duration. When more notifications arrive
+    than fit, config.BLE_SAMPLE_RING_POLICY decides: "overwrite" keeps the newest ones,
+    "block" keeps the oldest. `count` covers all notifications, `dropped` those not kept.
+    """
+
+    def __init__(self, address: str = "unknown", ring: FrameRing = None, frames: int = None):
+        """
+        Args:
+            address (str, optional): MAC address, labels the notification metrics.
+            ring (FrameRing, optional): Where the notifications go, a new private ring if not given.
+            frames (int, optional): Capacity of the new ring, see sample_ring_frames.
+                Defaults to config.BLE_SAMPLE_RING_FRAMES.
+        """
+        self.ring = ring if ring is not None else FrameRing(
+            frames or config.BLE_SAMPLE_RING_FRAMES,
+            config.BLE_SAMPLE_FRAME_SIZE,
+            config.BLE_SAMPLE_RING_POLICY,
+            shared=config.BLE_SAMPLE_RING_SHARED
+        )
+        self.count = 0  # notifications received
+        self.dropped = 0  # notifications not kept because the ring was full
+        self.first_at = None  # time.monotonic() of the first and last notification
+        self.last_at = None
+        self._notifications = BLE_NOTIFICATIONS.labels(address)
+        self._notification_bytes = BLE_NOTIFICATION_BYTES.labels(address)
 
-    def __init__(self):
-        self.cached_data = []
+    @property
+    def cached_data(self) -> List[memoryview]:
+        """
+        The kept notifications, oldest first, as views into the ring.
+        """
+        return [data for _, _, data in self.ring.frames()]
     
+    def get_raw(self) -> bytes:
+        return b''.join(self.cached_data)
+
     def get_data(self) -> str:
-        return ','.join(self.cached_data)
+        # Every byte as two hex digits, comma separated
+        return ','.join(data.hex(',') for data in self.cached_data)
+
+    def add(self, received_at: float, data) -> bool:
+        """
+        Keep a notification.
+
+        Returns:
+            bool: False if the ring was full and refused it.
+        """
+        if self.first_at is None:
+            self.first_at = received_at
+        self.last_at = received_at
+        self.count += 1
+        kept = self.ring.write(received_at, 0, data, 0)  # never wait, this runs on the event loop
+        self.dropped = self.ring.dropped
+        return kept
 
     async def handle_notify(self, sender, data):
-        hex_data = data.hex()
-        grouped_data = [hex_data[i:i+2] for i in range(0, len(hex_data), 2)]
+        received_at = time.monotonic()
+        self._notifications.inc()
+        self._notification_bytes.inc(len(data))
 
         # # Write grouped data to CSV
         # with open('grouped_data.csv', 'a', newline='') as csvfile:
         #     writer = csv.writer(csvfile)
         #     writer.writerow(grouped_data)
-        print("grouped data", grouped_data)
-        
-        message = ','.join(grouped_data)
+        if notify_log.isEnabledFor(logging.DEBUG):
+            notify_log.debug("grouped data %s", data.hex(','))
 
-        self.cached_data.append(message)
+        # Hex encoding is left to get_data, edge processing works on the raw bytes
+        self.add(received_at, data)
+
+    def close(self):
+        """
+        Free the ring. Views from cached_data that are still alive keep its memory until they are gone.
+        """
+        self.ring.close()
 
 
 class BluetoothAdapter:
     """
     Handles Bluetooth Low Energy communication for the gateway.
     """
-    def __init__(self):
+    def __init__(self, backend: BleBackend = None):
         """
         Initialize the Bluetooth adapter.
+        
+        Args:
+            backend (BleBackend, optional): Where clients and scans come from. Defaults to Bleak.
         """
+        self.backend = backend if backend is not None else BleakBackend()
         self.connected_devices = {}  # MAC address -> BleakClient
         self.mqtt_handler: MqttHandler = None
         self.notification_callbacks = {}  # MAC address -> characteristic UUID -> callback
+        self.device_profiles = {}  # MAC address -> pairing information, kept while the device is paired
+        self.clock = ClockSync()  # Unsynced until inject_clock, timestamps then use the local clock
+        self.boot_id = uuid.uuid4().hex  # Sequence numbers restart with every run
+        self.sequences = {}  # MAC address -> notifications published so far
+        self.gatt = GattScheduler(config.BLE_GATT_CONCURRENCY, config.BLE_GATT_TIMEOUT, config.BLE_GATT_TIMEOUTS)
         
+    async def start(self):
+        """
+        Prepare the adapter before first use. Nothing to do when BLE runs in this process.
+        """
+        pass
+
+    def stop(self):
+        """
+        Release what start acquired.
+        """
+        pass
+
     def inject_mqtt_handler(self, mqtt_handler: MqttHandler):
         """
         Inject the MQTT handler for publishing received data.
@@ -55,6 +171,66 @@ class BluetoothAdapter:
         """
         self.mqtt_handler = mqtt_handler
 
+    def inject_clock(self, clock: ClockSync):
+        """
+        Inject the clock used to timestamp measurements.
+        
+        Args:
+            clock: The ClockSync instance synced with the platform.
+        """
+        self.clock = clock
+
+    def processing_profile(self, address: str) -> Optional[Dict[str, Any]]:
+        """
+        Edge processing profile of a device: the 'processing' entry of its pairing configuration,
+        else its entry in config.SENSOR_PROCESSING, else the "default" entry there.
+        """
+        profile = ((self.device_profiles.get(address) or {}).get('config') or {}).get('processing')
+        if profile is None:
+            profile = config.SENSOR_PROCESSING.get(address, config.SENSOR_PROCESSING.get('default'))
+        return profile or None
+
+    def get_processor(self, address: str) -> Optional[EdgeProcessor]:
+        """
+        Edge processing for a device, see processing_profile.
+        
+        Returns:
+            EdgeProcessor | None: None sends the raw notifications, as before.
+        """
+        profile = self.processing_profile(address)
+        if not profile:
+            return None
+        try:
+            return EdgeProcessor.from_config(profile)
+        except ValueError as e:
+            log.warning("Invalid processing profile for %s, sending raw notifications: %s", address, e)
+            return None
+
+    def _sample_info(self, address: str, data_cache: DataCache) -> Dict[str, Any]:
+        """
+        Timestamps and sequence numbers of the notifications in a cache, so the platform
+        can order batches and drop duplicates by (sensorMac, bootId, seq).
+        """
+        count = data_cache.count
+        first_seq = self.sequences.get(address, 0) + 1
+        self.sequences[address] = first_seq - 1 + count
+
+        info = {
+            'seq': first_seq,
+            'count': count,
+            'bootId': self.boot_id,
+            'clockOffsetMs': round(self.clock.offset * 1000, 1) if self.clock.synced else None,
+        }
+        if data_cache.dropped:
+            info['dropped'] = data_cache.dropped  # not in "value", the ring was full
+        if count:
+            first_at = self.clock.wall_time(data_cache.first_at)
+            last_at = self.clock.wall_time(data_cache.last_at)
+            info['timestamp'] = datetime.datetime.fromtimestamp(last_at, datetime.timezone.utc).isoformat(timespec='milliseconds')
+            info['firstSampleAt'] = int(first_at * 1000)
+            info['lastSampleAt'] = int(last_at * 1000)
+        return info
+
     # deprecated
     async def read_data_obsolete(self, address: str):
         command_uuid = "87654321-1234-f393-e0a9-e50e24dcca9e"
@@ -63,57 +239,102 @@ class BluetoothAdapter:
         client = self.connected_devices[address]
 
         try:
-            print(f"Sending 0x35 command to UUID: {command_uuid}")
-            await client.write_gatt_char(command_uuid, b"\x35")
-            print("Command sent successfully!")
+            log.info("Sending 0x35 command to UUID: %s", command_uuid)
+            await self.gatt.write_gatt_char(client, command_uuid, b"\x35")
+            log.info("Command sent successfully!")
         except Exception as e:
-            print(f"Error sending command: {e}")
+            log.error("Error sending command: %s", e)
 
-        dataCache = DataCache()
+        dataCache = DataCache(address, frames=sample_ring_frames(config.BLE_MEASUREMENT_DURATION, self.processing_profile(address)))
 
         start_time = time.time()
         while (time.time() - start_time) < config.BLE_MEASUREMENT_DURATION:
-            await client.start_notify(RESPONSE_UUID, dataCache.handle_notify) # this command will trigger the simulated measurement generation in the kardinBLU, making it generate measurements.
+            await self.gatt.start_notify(client, RESPONSE_UUID, dataCache.handle_notify) # this command will trigger the simulated measurement generation in the kardinBLU, making it generate measurements.
             await asyncio.sleep(1)
         
-        await client.stop_notify(RESPONSE_UUID)
+        await self.gatt.stop_notify(client, RESPONSE_UUID)
 
-        print("Data reading complete.")
+        log.info("Data reading complete.")
 
         # Publish collected data to MQTT broker
         dataList = dataCache.get_data()
         self.mqtt_handler.publish_data(address, dataList)
 
-    async def read_data(self, address: str):
-        RESPONSE_UUID = "87654321-4321-8765-4321-56789abcdef0"
+    async def measure(self, address: str, duration: float, data_cache: DataCache = None) -> Optional[DataCache]:
+        """
+        Collect the notifications of a connected device.
         
-        try:
-            dataCache = DataCache()
-            client = self.connected_devices[address]
-            if client.is_connected:
-                print(f"Connected to device: {address}")
+        Args:
+            address (str): MAC address of the device.
+            duration (float): Seconds to listen.
+            data_cache (DataCache, optional): Where the notifications go, a new DataCache sized for
+                the duration if not given.
+            
+        Returns:
+            DataCache | None: The notifications, None if the device is not connected.
+        """
+        RESPONSE_UUID = "87654321-4321-8765-4321-56789abcdef0"
 
-                dataCache = DataCache()
+        client = self.connected_devices[address]
+        if not client.is_connected:
+            return None
+        log.info("Connected to device: %s", address)
 
-                start_time = time.time()
-                while (time.time() - start_time) < config.BLE_MEASUREMENT_DURATION:
-                    await client.start_notify(RESPONSE_UUID, dataCache.handle_notify) # this command will trigger the simulated measurement generation in the kardinBLU, making it generate measurements.
-                    print(f"Listening for notifications from UUID '{RESPONSE_UUID}'...")
-                    await asyncio.sleep(1)
+        dataCache = data_cache if data_cache is not None else DataCache(
+            address, frames=sample_ring_frames(duration, self.processing_profile(address)))
 
-                # Stop notifications
-                await client.stop_notify(RESPONSE_UUID)
-                print("Data reception complete.")
+        start_time = time.time()
+        while (time.time() - start_time) < duration:
+            await self.gatt.start_notify(client, RESPONSE_UUID, dataCache.handle_notify) # this command will trigger the simulated measurement generation in the kardinBLU, making it generate measurements.
+            log.debug("Listening for notifications from UUID '%s'...", RESPONSE_UUID)
+            await asyncio.sleep(1)
 
-                # Publish collected data to MQTT broker
-                dataList = dataCache.get_data()
-                self.mqtt_handler.publish_data(address, dataList)
-                print("Data published.")
-            else:
-                print(f"Failed to connect to device: {address}")
+        # Stop notifications
+        await self.gatt.stop_notify(client, RESPONSE_UUID)
+        log.info("Data reception complete.")
+        return dataCache
+
+    def publish_measurement(self, address: str, data_cache: DataCache, processed: Optional[Dict[str, Any]] = None, include_raw: bool = True):
+        """
+        Publish a measurement with its timestamps, sequence numbers and edge processing result.
+        
+        Args:
+            address (str): MAC address of the device.
+            data_cache (DataCache): The notifications of the measurement, or another object with its
+                count, dropped, first_at and last_at attributes and get_raw().
+            processed (Dict[str, Any], optional): Result of EdgeProcessor.process.
+            include_raw (bool, optional): Send the raw notifications as "value".
+        """
+        sample_info = self._sample_info(address, data_cache)
+        if processed is not None:
+            if processed.get('alarmCount'):
+                EDGE_ALARMS.labels(address).inc(processed['alarmCount'])
+                log.warning("%s samples from %s outside thresholds", processed['alarmCount'], address)
+            sample_info['processed'] = processed
+
+        # Publish collected data to MQTT broker
+        self.mqtt_handler.publish_data(address, data_cache.get_raw() if include_raw else b"", sample_info=sample_info)
+        log.info("Data published.")
+
+    async def read_data(self, address: str):
+        try:
+            dataCache = await self.measure(address, config.BLE_MEASUREMENT_DURATION)
+            if dataCache is None:
+                log.warning("Failed to connect to device: %s", address)
+                return
+
+            try:
+                processor = self.get_processor(address)
+                if processor is None:
+                    self.publish_measurement(address, dataCache)
+                else:
+                    processed = processor.process(dataCache.cached_data)
+                    self.publish_measurement(address, dataCache, processed, processor.needs_raw(processed))
+            finally:
+                dataCache.close()
 
         except Exception as e:
-            print(f"An error occurred during the Bluetooth operation: {e}")
+            log.error("An error occurred during the Bluetooth operation: %s", e)
         
     async def scan_devices(self, timeout: float = 5.0) -> List[Dict[str, Any]]:
         """
@@ -125,8 +346,8 @@ class BluetoothAdapter:
         Returns:
             List[Dict[str, Any]]: List of detected devices with their details.
         """
-        print(f"Scanning for BLE devices (timeout: {timeout}s)...")
-        devices = await BleakScanner.discover(timeout=timeout)
+        log.info("Scanning for BLE devices (timeout: %ss)...", timeout)
+        devices = await self.backend.discover(timeout)
         
         device_list = []
         for device in devices:
@@ -136,9 +357,9 @@ class BluetoothAdapter:
                 "rssi": device.rssi,
             }
             device_list.append(device_info)
-            print(f"Found device: {device.name or 'Unknown'} ({device.address}) - RSSI: {device.rssi}")
+            log.info("Found device: %s (%s) - RSSI: %s", device.name or 'Unknown', device.address, device.rssi)
         
-        print(f"Scan complete. Found {len(device_list)} devices.")
+        log.info("Scan complete. Found %s devices.", len(device_list))
         return device_list
     
     def is_device_connected(self, address: str) -> bool:
@@ -165,26 +386,35 @@ class BluetoothAdapter:
             bool: True if connection was successful, False otherwise.
         """
         if address in self.connected_devices and self.connected_devices[address].is_connected:
-            print(f"Device {address} is already connected")
+            log.info("Device %s is already connected", address)
             return True
             
         try:
-            print(f"Connecting to device: {address}")
-            client = BleakClient(address)
+            log.info("Connecting to device: %s", address)
+            client = self.backend.create_client(address, disconnected_callback=self._on_device_disconnected)
             await client.connect()
             
             if client.is_connected:
                 self.connected_devices[address] = client
-                print(f"Connected to {address}")
+                log.info("Connected to %s", address)
                 return True
             else:
-                print(f"Failed to connect to {address}")
+                log.warning("Failed to connect to %s", address)
                 return False
                 
         except Exception as e:
-            print(f"Error connecting to {address}: {e}")
+            log.error("Error connecting to %s: %s", address, e)
             return False
             
+    def _on_device_disconnected(self, client):
+        """
+        Called by the backend when a link drops, so the device is paired again on the next sensor list.
+        """
+        address = getattr(client, 'address', None)
+        if address is not None and self.connected_devices.get(address) is client:
+            log.warning("Device %s disconnected unexpectedly", address)
+            del self.connected_devices[address]
+
     async def disconnect_device(self, address: str) -> bool:
         """
         Disconnect from a BLE device.
@@ -196,19 +426,66 @@ class BluetoothAdapter:
             bool: True if disconnection was successful, False otherwise.
         """
         if address not in self.connected_devices:
-            print(f"Device {address} is not connected")
+            log.info("Device %s is not connected", address)
             return True
             
         client = self.connected_devices[address]
         try:
             await client.disconnect()
-            del self.connected_devices[address]
-            print(f"Disconnected from {address}")
+            self.connected_devices.pop(address, None)
+            log.info("Disconnected from %s", address)
             return True
         except Exception as e:
-            print(f"Error disconnecting from {address}: {e}")
+            log.error("Error disconnecting from %s: %s", address, e)
             return False
     
+    async def start_notify(self, address: str, char_uuid: str, callback: Callable = None):
+        """
+        Subscribe to notifications of a characteristic.
+        
+        Args:
+            address (str): MAC address of the device.
+            char_uuid (str): UUID of the characteristic.
+            callback (Callable, optional): Called with (sender, data), notifications are only logged if not given.
+        """
+        callback = callback or _log_notification
+        await self.gatt.start_notify(self.connected_devices[address], char_uuid, callback)
+        self.notification_callbacks.setdefault(address, {})[char_uuid] = callback
+
+    async def stop_notify(self, address: str, char_uuid: str):
+        """
+        Unsubscribe from notifications of a characteristic.
+        """
+        self.notification_callbacks.get(address, {}).pop(char_uuid, None)
+        client = self.connected_devices.get(address)
+        if client is not None and client.is_connected:
+            await self.gatt.stop_notify(client, char_uuid)
+
+    async def write_characteristic(self, address: str, char_uuid: str, data: bytes):
+        """
+        Write a value to a characteristic.
+        """
+        await self.gatt.write_gatt_char(self.connected_devices[address], char_uuid, data)
+
+    async def sign_challenge(self, address: str, nonce: str) -> Optional[str]:
+        """
+        Have a low-end device sign an attestation nonce with its key, see AttestationCache.
+        The nonce is written to config.ATTESTATION_CHALLENGE_UUID and the signature read back from it.
+
+        Args:
+            address (str): MAC address of the device.
+            nonce (str): Hex nonce.
+
+        Returns:
+            str | None: Hex signature, None if the device is not connected.
+        """
+        client = self.connected_devices.get(address)
+        if client is None or not client.is_connected:
+            return None
+        await self.gatt.write_gatt_char(client, config.ATTESTATION_CHALLENGE_UUID, bytes.fromhex(nonce))
+        signature = await self.gatt.read_gatt_char(client, config.ATTESTATION_CHALLENGE_UUID)
+        return bytes(signature).hex()
+
     async def pair_device(self, device_info):
         """
         Handle pairing with a new device based on instructions.
@@ -217,7 +494,7 @@ class BluetoothAdapter:
             device_info (Dict): Device information including MAC address and configuration.
         """
         if 'address' not in device_info:
-            print("Cannot pair: Missing device address in pairing information")
+            log.warning("Cannot pair: Missing device address in pairing information")
             return False
         
         address = device_info['address']
@@ -226,9 +503,14 @@ class BluetoothAdapter:
         connected = await self.connect_device(address)
         if not connected:
             return False
+
+        profile = {'address': address}
+        if 'config' in device_info:
+            profile['config'] = device_info['config']
+        self.device_profiles[address] = profile
             
         # If device-specific configuration is provided
-        if 'config' in device_info:
+        if device_info.get('config'):
             config = device_info['config']
             
             # Handle configuration (this would be device-specific)
@@ -254,15 +536,47 @@ class BluetoothAdapter:
             device_info (Dict): Device information including MAC address.
         """
         if 'address' not in device_info:
-            print("Cannot unpair: Missing device address in unpairing information")
+            log.warning("Cannot unpair: Missing device address in unpairing information")
             return False
         
         address = device_info['address']
+        self.device_profiles.pop(address, None)
         
         # Stop all notifications first
         if address in self.notification_callbacks:
             for char_uuid in list(self.notification_callbacks[address].keys()):
                 await self.stop_notify(address, char_uuid)
+            del self.notification_callbacks[address]
         
         # Disconnect from the device
-        return await self.disconnect_device(address)
+        disconnected = await self.disconnect_device(address)
+        self.gatt.forget(address)
+        return disconnected
+
+    async def restore_devices(self, profiles: List[Dict[str, Any]], concurrency: int = 4) -> int:
+        """
+        Pair previously paired devices again, several at a time.
+        
+        Args:
+            profiles (List[Dict[str, Any]]): Saved pairing information, as in device_profiles.
+            concurrency (int, optional): Connections attempted at once. BLE controllers
+                only handle a few pending connections, more would just queue or fail.
+            
+        Returns:
+            int: Number of devices paired again.
+        """
+        # Keep the profiles of devices that are out of range now, so they are saved again
+        for profile in profiles:
+            self.device_profiles.setdefault(profile['address'], profile)
+
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def restore(profile):
+            async with semaphore:
+                return await self.pair_device(profile)
+
+        log.info("Restoring %s paired devices...", len(profiles))
+        results = await asyncio.gather(*(restore(profile) for profile in profiles), return_exceptions=True)
+        restored = sum(1 for result in results if result is True)
+        log.info("Restored %s of %s paired devices", restored, len(profiles))
+        return restored
@@ -0,0 +1,145 @@
+"""
+Clock offset estimation for the gateway application.
+Estimates the offset between the gateway clock and the platform clock over MQTT request/response,
+and converts time.monotonic() readings into platform wall-clock time.
+"""
+
+import collections
+import itertools
+import time
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from logger import get_logger
+
+log = get_logger("clock")
+
+
+class ClockSync:
+    """
+    NTP-style offset estimator.
+
+    The gateway publishes {"type": "timesync", "requestId", "t0"} with t0 its wall clock
+    at sending. The platform answers on the gateway topic with the same type and requestId
+    plus "t1" (platform time at receipt) and "t2" (platform time at answering), all in
+    seconds since the epoch. With t3 the gateway time at receipt:
+
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        delay  = (t3 - t0) - (t2 - t1)
+
+    The sample with the lowest delay among the recent ones is used, as its offset has
+    the smallest error bound (delay / 2). t0 and t3 are taken from time.monotonic(),
+    so local clock steps and queueing in the gateway do not distort samples.
+
+    An unanswered request is repeated after request_timeout seconds, doubling up to
+    `interval`. After max_unanswered unanswered requests in a row the gateway stops asking,
+    e.g. on a platform that does not implement time sync, and keeps its last offset.
+    """
+    def __init__(self, interval: float = 300.0, samples: int = 8, request_timeout: float = 30.0,
+                 max_unanswered: Optional[int] = 5):
+        """
+        Initialize the estimator.
+
+        Args:
+            interval (float, optional): Seconds between sync requests once synced.
+            samples (int, optional): Number of recent samples the best one is picked from.
+            request_timeout (float, optional): Seconds after which an unanswered request is forgotten.
+            max_unanswered (int, optional): Unanswered requests in a row after which no more are sent, None for no limit.
+        """
+        self.interval = interval
+        self.request_timeout = request_timeout
+        self.max_unanswered = max_unanswered
+        self.stopped = False  # gave up after max_unanswered requests
+        self.offset: Optional[float] = None  # platform time - gateway time, seconds
+        self.delay: Optional[float] = None  # round-trip delay of the sample in use
+
+        self._samples: Deque[Tuple[float, float]] = collections.deque(maxlen=samples)  # (delay, offset)
+        self._pending: Dict[int, Tuple[float, float]] = {}  # request id -> (monotonic, wall) at sending
+        self._request_ids = itertools.count(1)
+        self._last_request: Optional[float] = None
+        self._unanswered = 0  # requests since the last response
+
+    @property
+    def synced(self) -> bool:
+        return self.offset is not None
+
+    def is_due(self, now: Optional[float] = None) -> bool:
+        """
+        Check whether a sync request should be sent.
+        """
+        if self._last_request is None:
+            return True
+        if self.stopped:
+            return False
+        elapsed = (time.monotonic() if now is None else now) - self._last_request
+        if self.max_unanswered is not None and self._unanswered >= self.max_unanswered:
+            if elapsed >= self.request_timeout:
+                self.stopped = True
+                log.warning("The platform did not answer %d time sync requests, no longer asking. "
+                            "Measurement timestamps use the %s", self._unanswered,
+                            "last clock offset" if self.synced else "local clock")
+            return False
+        if self._unanswered == 0:
+            return elapsed >= self.interval
+        return elapsed >= min(self.interval, self.request_timeout * 2 ** (self._unanswered - 1))
+
+    def request(self, sender: str) -> Dict[str, Any]:
+        """
+        Build a sync request and remember when it was sent.
+
+        Args:
+            sender (str): MAC address of the gateway.
+        """
+        now = time.monotonic()
+        self._pending = {request_id: sent for request_id, sent in self._pending.items() if now - sent[0] < self.request_timeout}
+
+        request_id = next(self._request_ids)
+        wall = time.time()
+        self._pending[request_id] = (now, wall)
+        self._last_request = now
+        self._unanswered += 1
+        return {
+            'from': sender,
+            'type': "timesync",
+            'requestId': request_id,
+            't0': wall,
+        }
+
+    def on_response(self, request_id: Any, t1: float, t2: float, received_at: Optional[float] = None) -> bool:
+        """
+        Add the sample from a sync response.
+
+        Args:
+            request_id: requestId echoed by the platform.
+            t1 (float): Platform time at receipt of the request.
+            t2 (float): Platform time at sending the response.
+            received_at (float, optional): time.monotonic() when the response arrived, now if not given.
+
+        Returns:
+            bool: True if the response matched a pending request.
+        """
+        sent = self._pending.pop(request_id, None)
+        if sent is None:
+            log.debug("Ignoring time sync response for unknown request %s", request_id)
+            return False
+
+        sent_monotonic, t0 = sent
+        self._unanswered = 0
+        t3 = t0 + ((time.monotonic() if received_at is None else received_at) - sent_monotonic)
+        delay = max(0.0, (t3 - t0) - (t2 - t1))
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+
+        self._samples.append((delay, offset))
+        self.delay, self.offset = min(self._samples)
+        log.info("Clock offset %.1f ms (delay %.1f ms)", self.offset * 1000, self.delay * 1000)
+        return True
+
+    def wall_time(self, monotonic: Optional[float] = None) -> float:
+        """
+        Platform wall-clock time of a time.monotonic() reading, the local clock until synced.
+
+        Args:
+            monotonic (float, optional): time.monotonic() value, now if not given.
+        """
+        now = time.monotonic()
+        wall = time.time() - (now - (now if monotonic is None else monotonic))
+        return wall + (self.offset or 0.0)
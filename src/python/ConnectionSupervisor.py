@@ -0,0 +1,76 @@
+"""
+Connection supervisor for the gateway application.
+Spaces out registration, credential and MQTT connection retries with exponential backoff and jitter.
+"""
+
+import asyncio
+import random
+
+from logger import get_logger
+
+log = get_logger("supervisor")
+
+
+class ConnectionSupervisor:
+    """
+    Exponential backoff with decorrelated jitter, reset when a step succeeds.
+
+    Every delay is drawn between min_delay and three times the previous delay,
+    capped at max_delay. The randomness spreads out reconnects of a fleet of
+    gateways that lost the broker at the same moment.
+    """
+    def __init__(self, min_delay: float = 1.0, max_delay: float = 120.0):
+        """
+        Initialize the supervisor.
+
+        Args:
+            min_delay (float, optional): Shortest delay in seconds. Defaults to 1.
+            max_delay (float, optional): Longest delay in seconds. Defaults to 120.
+        """
+        if min_delay <= 0 or max_delay < min_delay:
+            raise ValueError("Invalid reconnect delays")
+
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.attempts = 0  # Failures since the last success
+        self._delay = None
+
+    def next_delay(self) -> float:
+        """
+        Register a failed attempt and get the time to wait before the next one.
+
+        Returns:
+            float: Delay in seconds.
+        """
+        self.attempts += 1
+        previous = self._delay if self._delay is not None else self.min_delay
+        self._delay = min(self.max_delay, random.uniform(self.min_delay, previous * 3))
+        return self._delay
+
+    def reset(self):
+        """
+        Register a successful attempt, the next failure starts again from min_delay.
+        """
+        self.attempts = 0
+        self._delay = None
+
+    async def wait(self) -> float:
+        """
+        Register a failed attempt and sleep for the backoff delay.
+
+        Returns:
+            float: The delay that was waited, in seconds.
+        """
+        delay = self.next_delay()
+        log.info("Retrying in %.1fs (attempt %s)", delay, self.attempts)
+        await asyncio.sleep(delay)
+        return delay
+
+    def apply_to(self, client):
+        """
+        Use the same delay bounds for the automatic reconnects of a paho client.
+
+        Args:
+            client (paho.mqtt.client.Client): The MQTT client.
+        """
+        client.reconnect_delay_set(self.min_delay, self.max_delay)
@@ -0,0 +1,175 @@
+"""
+MQTT credential management for the gateway application.
+Reuses the credentials the onboarding server issued across reconnects and restarts, refreshes them ahead of
+their expiry in the background, and only asks the server again when the broker rejects them.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import metrics
+from logger import get_logger
+
+log = get_logger("credentials")
+
+CREDENTIAL_FETCHES = metrics.counter("gateway_mqtt_credential_fetches_total", "MQTT credential requests to the onboarding server", ["reason", "result"])
+CREDENTIAL_REUSES = metrics.counter("gateway_mqtt_credential_reuses_total", "Connection attempts that reused cached MQTT credentials")
+
+
+class CredentialManager:
+    """
+    Holds the MQTT username and password and decides when they must be fetched.
+
+    Cached credentials are used as long as they have not expired and the broker has not
+    rejected them: a dropped connection, a failed reconnect or a restart (via the state
+    snapshot, see StateStore.py) do not cost an HTTP round trip. They are fetched again when
+      - there are none,
+      - the broker answered CONNACK "not authorized" or "bad user name or password" (reject()),
+      - they expire: `refresh_ahead` seconds before expires_at, run() fetches new ones in the
+        background and hands them to the listeners, so the next (re)connect uses them.
+    Credentials without expires_at are valid until the broker rejects them.
+
+    `fetch` asks the onboarding server and stores the answer with set(). It returns False
+    on failure. Concurrent fetches share one request.
+    """
+    def __init__(self, fetch: Callable[[], Awaitable[bool]], lifetime: Optional[float] = None,
+                 refresh_ahead: float = 300.0, retry_delay: float = 60.0):
+        """
+        Initialize the manager.
+
+        Args:
+            fetch (Callable[[], Awaitable[bool]]): Requests credentials from the server and calls set().
+            lifetime (float, optional): Seconds credentials are valid when the server does not say, None for no expiry.
+            refresh_ahead (float, optional): Seconds before expiry at which they are refreshed.
+            retry_delay (float, optional): Seconds before a failed background refresh is tried again.
+        """
+        self.fetch = fetch
+        self.lifetime = lifetime
+        self.refresh_ahead = refresh_ahead
+        self.retry_delay = retry_delay
+
+        self.username: Optional[str] = None
+        self.password: Optional[str] = None
+        self.expires_at: Optional[float] = None  # unix time, survives restarts
+        self.rejected = False
+
+        self._listeners: List[Callable[[str, str], None]] = []
+        self._fetching: Optional[asyncio.Task] = None
+        self._changed: Optional[asyncio.Event] = None  # created in the event loop by run()
+
+    def add_listener(self, listener: Callable[[str, str], None]):
+        """
+        Call listener(username, password) whenever new credentials are set.
+        """
+        self._listeners.append(listener)
+
+    def set(self, username: str, password: str, expires_at: Optional[float] = None, expires_in: Optional[float] = None):
+        """
+        Store credentials, e.g. from the onboarding server or the state snapshot.
+
+        Args:
+            username (str): MQTT username.
+            password (str): MQTT password.
+            expires_at (float, optional): Unix time at which they expire.
+            expires_in (float, optional): Seconds until they expire, if expires_at is not known.
+                Without either, the configured lifetime applies.
+        """
+        if expires_at is None:
+            lifetime = expires_in if expires_in is not None else self.lifetime
+            expires_at = time.time() + lifetime if lifetime is not None else None
+        changed = (username, password) != (self.username, self.password)
+        self.username, self.password, self.expires_at = username, password, expires_at
+        self.rejected = False
+        if changed:
+            for listener in self._listeners:
+                listener(username, password)
+        if self._changed is not None:
+            self._changed.set()
+
+    @property
+    def valid(self) -> bool:
+        """
+        Whether the cached credentials can be used for a connection attempt.
+        """
+        if self.username is None or self.password is None or self.rejected:
+            return False
+        return self.expires_at is None or time.time() < self.expires_at
+
+    def reject(self):
+        """
+        The broker refused the credentials, the next ensure() fetches new ones.
+        """
+        if not self.rejected:
+            log.warning("Broker rejected the MQTT credentials of %s, requesting new ones", self.username)
+        self.rejected = True
+
+    async def ensure(self) -> bool:
+        """
+        Make sure there are credentials to connect with, fetching them only if the cached ones are unusable.
+
+        Returns:
+            bool: True if valid credentials are available.
+        """
+        if self.valid:
+            CREDENTIAL_REUSES.inc()
+            return True
+        reason = "rejected" if self.rejected else "missing" if self.username is None else "expired"
+        return await self.refresh(reason) and self.valid
+
+    async def refresh(self, reason: str = "refresh") -> bool:
+        """
+        Fetch credentials from the server now, or wait for the fetch already running.
+        """
+        if self._fetching is None or self._fetching.done():
+            self._fetching = asyncio.get_running_loop().create_task(self._fetch(reason))
+        return await asyncio.shield(self._fetching)
+
+    async def _fetch(self, reason: str) -> bool:
+        success = False
+        try:
+            success = bool(await self.fetch())
+            return success
+        finally:
+            CREDENTIAL_FETCHES.labels(reason, 'ok' if success else 'failed').inc()
+
+    def refresh_at(self) -> Optional[float]:
+        """
+        Unix time at which the credentials should be refreshed, None if they do not expire.
+        """
+        if self.expires_at is None:
+            return None
+        return self.expires_at - self.refresh_ahead
+
+    async def run(self):
+        """
+        Refresh credentials ahead of their expiry, until cancelled. Connections are not
+        interrupted, the new credentials are used from the next (re)connect on.
+        """
+        self._changed = asyncio.Event()
+        try:
+            while True:
+                self._changed.clear()
+                refresh_at = self.refresh_at()
+                if refresh_at is not None and not self.rejected and time.time() >= refresh_at:
+                    log.info("MQTT credentials expire at %s, refreshing them", time.strftime("%H:%M:%S", time.localtime(self.expires_at)))
+                    try:
+                        refreshed = await self.refresh()
+                    except Exception as e:
+                        log.warning("MQTT credential refresh failed: %s", e)
+                        refreshed = False
+                    refresh_at = self.refresh_at()
+                    if not refreshed or (refresh_at is not None and time.time() >= refresh_at):
+                        # Failed, or the server keeps handing out credentials that are about to expire
+                        await asyncio.sleep(self.retry_delay)
+                    continue
+                timeout = max(0.0, refresh_at - time.time()) if refresh_at is not None else None
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._changed = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {'mqtt_username': self.username, 'mqtt_password': self.password, 'mqtt_credentials_expire_at': self.expires_at}
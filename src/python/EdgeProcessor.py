@@ -0,0 +1,180 @@
+"""
+Edge processing for the gateway application.
+Turns the raw notifications of a measurement into a decimated series, windowed statistics and threshold alarms,
+so only what the use case needs is sent to the platform.
+"""
+
+import struct
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np  # Optional, vectorised processing of the sample buffer
+except ImportError:
+    np = None
+
+# Most alarms listed per measurement, the count is always complete
+MAX_ALARMS = 100
+
+# struct codes as numpy types, for the standard sizes of the byte orders '<', '>', '!' and '='
+_NUMPY_TYPES = {'b': 'i1', 'B': 'u1', '?': 'b1', 'h': 'i2', 'H': 'u2', 'i': 'i4', 'I': 'u4',
+                'l': 'i4', 'L': 'u4', 'q': 'i8', 'Q': 'u8', 'e': 'f2', 'f': 'f4', 'd': 'f8'}
+_NUMPY_BYTE_ORDERS = {'<': '<', '>': '>', '!': '>', '=': '='}
+
+
+def numpy_dtype(sample_format: str):
+    """
+    numpy dtype that decodes a one-value struct format exactly like struct does,
+    None if numpy is not installed or the format has no such dtype (e.g. padding bytes).
+    """
+    if np is None:
+        return None
+    order, code = ("@", sample_format) if sample_format[:1] not in "@=<>!" else (sample_format[0], sample_format[1:])
+    if code.startswith("1"):
+        code = code[1:]
+    if code not in _NUMPY_TYPES:
+        return None
+    # Without a byte order struct uses native sizes, like numpy's own type codes
+    dtype = np.dtype(code) if order == "@" else np.dtype(_NUMPY_BYTE_ORDERS[order] + _NUMPY_TYPES[code])
+    return dtype if dtype.itemsize == struct.calcsize(sample_format) else None
+
+
+class EdgeProcessor:
+    """
+    Per-sensor processing profile.
+
+    Every notification is `skip` header bytes followed by samples of `sample_format`,
+    a struct format of one value such as "<h" or "<f" (pad bytes "x" may follow it).
+    All samples of a measurement are decoded from one joined buffer, with numpy when
+    it is installed and has a matching dtype, and then:
+      - decimate: every Nth sample is kept in "series".
+      - window: min/max/mean per window of N samples, the last window may be shorter.
+      - thresholds: samples below "min" or above "max" are alarms. When an alarm fires,
+        the raw notifications are forwarded as well.
+    """
+    def __init__(self, sample_format: str = "<h", skip: int = 0, decimate: int = 0, window: int = 0,
+                 thresholds: Optional[Dict[str, float]] = None, forward_raw: bool = False):
+        """
+        Initialize the processor.
+
+        Args:
+            sample_format (str, optional): struct format of one sample, with byte order.
+            skip (int, optional): Header bytes at the start of every notification.
+            decimate (int, optional): Keep every Nth sample in the series, 0 sends no series.
+            window (int, optional): Samples per statistics window, 0 sends no statistics.
+            thresholds (Dict[str, float], optional): "min" and/or "max" alarm limits.
+            forward_raw (bool, optional): Always send the raw notifications too.
+
+        Raises:
+            ValueError: If sample_format is not a struct format of exactly one value.
+        """
+        try:
+            self.item_size = struct.calcsize(sample_format)
+            values = len(struct.unpack(sample_format, bytes(self.item_size)))
+        except struct.error as e:
+            raise ValueError(f"Invalid sample format {sample_format!r}: {e}") from e
+        if values != 1:
+            raise ValueError(f"Sample format {sample_format!r} has {values} values, one sample is one value")
+        self.sample_format = sample_format
+        self._dtype = numpy_dtype(sample_format)
+        self.skip = skip
+        self.decimate = decimate
+        self.window = window
+        self.thresholds = thresholds or {}
+        self.forward_raw = forward_raw
+
+    @classmethod
+    def from_config(cls, profile: Dict[str, Any]) -> "EdgeProcessor":
+        """
+        Build a processor from a profile in config.SENSOR_PROCESSING or a pairing configuration.
+        """
+        return cls(
+            sample_format=profile.get('format', "<h"),
+            skip=profile.get('skip', 0),
+            decimate=profile.get('decimate', 0),
+            window=profile.get('window', 0),
+            thresholds=profile.get('thresholds'),
+            forward_raw=profile.get('forward_raw', False),
+        )
+
+    def _buffer(self, frames: Sequence[bytes]) -> bytes:
+        # Headers dropped and every notification cut to whole samples
+        parts = []
+        for frame in frames:
+            usable = (len(frame) - self.skip) // self.item_size * self.item_size
+            if usable > 0:
+                parts.append(bytes(frame[self.skip:self.skip + usable]))
+        return b"".join(parts)
+
+    def decode(self, frames: Sequence[bytes]):
+        """
+        All samples of the notifications, as a numpy array or a list.
+        """
+        buffer = self._buffer(frames)
+        if self._dtype is not None:
+            return np.frombuffer(buffer, dtype=self._dtype)
+        return [sample for sample, in struct.iter_unpack(self.sample_format, buffer)]
+
+    def process(self, frames: Sequence[bytes]) -> Dict[str, Any]:
+        """
+        Process the notifications of one measurement.
+
+        Returns:
+            Dict[str, Any]: "samples" count, and "series", "windows", "alarms"/"alarmCount"
+                as configured. Sent as the measurement's "processed" field.
+        """
+        samples = self.decode(frames)
+        result: Dict[str, Any] = {'samples': len(samples)}
+        if self.decimate:
+            result['series'] = _to_list(samples[::self.decimate])
+        if self.window:
+            result['windows'] = self._windows(samples)
+        if self.thresholds:
+            result['alarmCount'], result['alarms'] = self._alarms(samples)
+        return result
+
+    def needs_raw(self, result: Dict[str, Any]) -> bool:
+        """
+        Whether the raw notifications should be sent along with the processed result.
+        """
+        return self.forward_raw or bool(result.get('alarmCount'))
+
+    def _windows(self, samples) -> List[Dict[str, Any]]:
+        count = len(samples)
+        if count == 0:
+            return []
+        if self._dtype is not None:
+            full = count // self.window * self.window
+            windows = []
+            if full:
+                blocks = samples[:full].reshape(-1, self.window)
+                for low, high, mean in zip(blocks.min(axis=1).tolist(), blocks.max(axis=1).tolist(), blocks.mean(axis=1).tolist()):
+                    windows.append({'min': low, 'max': high, 'mean': mean, 'count': self.window})
+            if full < count:
+                rest = samples[full:]
+                windows.append({'min': rest.min().item(), 'max': rest.max().item(), 'mean': rest.mean().item(), 'count': count - full})
+            return windows
+        windows = []
+        for start in range(0, count, self.window):
+            block = samples[start:start + self.window]
+            windows.append({'min': min(block), 'max': max(block), 'mean': sum(block) / len(block), 'count': len(block)})
+        return windows
+
+    def _alarms(self, samples) -> Tuple[int, List[Dict[str, Any]]]:
+        low = self.thresholds.get('min')
+        high = self.thresholds.get('max')
+        if self._dtype is not None:
+            mask = np.zeros(len(samples), dtype=bool)
+            if low is not None:
+                mask |= samples < low
+            if high is not None:
+                mask |= samples > high
+            indices = np.flatnonzero(mask)
+            listed = indices[:MAX_ALARMS]
+            return len(indices), [{'index': index, 'value': value} for index, value in zip(listed.tolist(), samples[listed].tolist())]
+        indices = [index for index, value in enumerate(samples)
+                   if (low is not None and value < low) or (high is not None and value > high)]
+        return len(indices), [{'index': index, 'value': samples[index]} for index in indices[:MAX_ALARMS]]
+
+
+def _to_list(samples) -> list:
+    return samples.tolist() if hasattr(samples, 'tolist') else list(samples)
@@ -0,0 +1,311 @@
+"""
+Ring buffer of BLE sample frames for the gateway application.
+Holds notifications as fixed-width frames in one mmap or shared memory block, so memory stays constant
+however long a measurement runs, and other processes can read the frames without pickling or copying them.
+"""
+
+import mmap
+import struct
+import threading
+import zlib
+from typing import Iterator, List, Optional, Tuple
+
+POLICY_BLOCK = "block"  # a full ring makes the writer wait, or refuses the frame when it cannot wait
+POLICY_OVERWRITE = "overwrite"  # a full ring replaces its oldest frame
+_POLICIES = (POLICY_BLOCK, POLICY_OVERWRITE)
+
+_COUNTER = struct.Struct("<Q")
+_CRC = struct.Struct("<I")
+_LAYOUT = struct.Struct("<IIII")  # capacity, payload size, slot size, policy index
+_WRITTEN_OFFSET = 0  # frames written so far, only changed by the producer
+_DROPPED_OFFSET = 8  # frames refused or overwritten because the ring was full, producer
+_LAYOUT_OFFSET = 16
+_STARTED_OFFSET = 32  # frames the producer started writing, bumped before the slot is touched
+_READ_OFFSET = 64  # frames read so far, only changed by the consumer, on its own cache line
+_HEADER_SIZE = 128
+_FRAME_FIELDS = struct.Struct("<QdHH")  # frame index + 1, time.monotonic() at receipt, device index, payload length
+_FRAME_HEADER = struct.Struct("<QdHHI")  # the fields, then the CRC-32 of the fields and the payload
+_RETRIES = 3  # copies of a slot the overwrite consumer tries before it leaves the frame for its next read
+
+Frame = Tuple[float, int, bytes]
+
+
+class FrameRing:
+    """
+    Single-producer/single-consumer ring of fixed-width frames.
+
+    Every slot holds one notification: its frame index, its timestamp, a device index the
+    producer and consumer agreed on, the payload length, a CRC-32 and up to payload_size
+    payload bytes. BLE attribute values are at most 512 bytes, so the default never splits
+    a notification.
+
+    When the ring is full:
+      - POLICY_BLOCK: write waits for the consumer, up to its timeout (0 refuses the
+        frame at once, for callbacks that must not wait). Two semaphores count readable
+        frames and free slots and order the slot writes before the counters.
+      - POLICY_OVERWRITE: write replaces the oldest frame. The consumer skips frames it
+        lost and discards a frame that was overwritten while it was being copied, so a
+        slow consumer never stalls the producer. Reads do not wait. Like a seqlock, the
+        producer announces a frame in `started` before it writes the slot and counts it
+        in `written` after, so the consumer can tell a slot the producer was inside.
+        Plain stores into shared memory are not ordered on weakly ordered CPUs (ARM), so
+        the consumer also checks the frame index and CRC of its copy: a copy that does
+        not match is taken again, and left for the next read if it still does not match.
+    Refused and overwritten frames are counted in `dropped`.
+
+    With shared=True the block is a multiprocessing.shared_memory segment. A ring passed
+    to another process as a multiprocessing.Process argument attaches to the same block;
+    a POLICY_OVERWRITE ring can also be opened by name with attach(). Only the creator
+    unlinks the segment. With shared=False the block is an anonymous mmap, whose pages
+    are only backed by memory once frames are written to them.
+    """
+    def __init__(self, capacity: int = 4096, payload_size: int = 512, policy: str = POLICY_BLOCK,
+                 shared: bool = True, context=None):
+        """
+        Create a ring.
+
+        Args:
+            capacity (int, optional): Number of frames.
+            payload_size (int, optional): Largest notification in bytes.
+            policy (str, optional): POLICY_BLOCK or POLICY_OVERWRITE.
+            shared (bool, optional): Shared memory other processes can attach to, else a private mmap.
+            context (optional): multiprocessing context the semaphores of a shared ring are created in.
+                Defaults to "spawn".
+        """
+        if policy not in _POLICIES:
+            raise ValueError(f"Unknown ring policy {policy!r}")
+        self.capacity = capacity
+        self.payload_size = payload_size
+        self.policy = policy
+        self.shared = shared
+        self._slot_size = -(-(_FRAME_HEADER.size + payload_size) // 8) * 8
+        size = _HEADER_SIZE + capacity * self._slot_size
+
+        if shared:
+            from multiprocessing import shared_memory  # Only shared rings need it
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self._mmap = None
+            self._buffer = self._shm.buf
+        else:
+            self._shm = None
+            self._mmap = mmap.mmap(-1, size)
+            self._buffer = memoryview(self._mmap)
+        self._buffer[:_HEADER_SIZE] = bytes(_HEADER_SIZE)
+        _LAYOUT.pack_into(self._buffer, _LAYOUT_OFFSET, capacity, payload_size, self._slot_size, _POLICIES.index(policy))
+
+        self._items = self._space = None
+        if policy == POLICY_BLOCK:
+            if shared:
+                if context is None:
+                    import multiprocessing
+                    context = multiprocessing.get_context("spawn")
+                self._items, self._space = context.Semaphore(0), context.Semaphore(capacity)
+            else:
+                self._items, self._space = threading.Semaphore(0), threading.Semaphore(capacity)
+        self._owner = True
+
+    @classmethod
+    def attach(cls, name: str) -> "FrameRing":
+        """
+        Open a shared POLICY_OVERWRITE ring created by another process, as its consumer.
+        """
+        ring = cls.__new__(cls)
+        ring._open(name, None, None)
+        if ring.policy != POLICY_OVERWRITE:
+            ring.close()
+            raise ValueError("Only overwrite rings can be attached by name, pass block rings to the process instead")
+        return ring
+
+    def _open(self, name: str, items, space):
+        from multiprocessing import shared_memory
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._mmap = None
+        self._buffer = self._shm.buf
+        self.capacity, self.payload_size, self._slot_size, policy = _LAYOUT.unpack_from(self._buffer, _LAYOUT_OFFSET)
+        self.policy = _POLICIES[policy]
+        self.shared = True
+        self._items, self._space = items, space
+        self._owner = False
+
+    @property
+    def name(self) -> Optional[str]:
+        return self._shm.name if self._shm is not None else None
+
+    def __getstate__(self):
+        if not self.shared:
+            raise TypeError("Only shared rings can be passed to another process")
+        return {'name': self._shm.name, 'items': self._items, 'space': self._space}
+
+    def __setstate__(self, state):
+        self._open(state['name'], state['items'], state['space'])
+
+    def _counter(self, offset: int) -> int:
+        return _COUNTER.unpack_from(self._buffer, offset)[0]
+
+    @property
+    def dropped(self) -> int:
+        return self._counter(_DROPPED_OFFSET)
+
+    def __len__(self) -> int:
+        return min(self._counter(_WRITTEN_OFFSET) - self._counter(_READ_OFFSET), self.capacity)
+
+    def write(self, timestamp: float, device: int, data: bytes, timeout: Optional[float] = None) -> bool:
+        """
+        Append a frame. Producer side only.
+
+        Args:
+            timestamp (float): time.monotonic() at receipt.
+            device (int): Device index, 0 to 65535.
+            data (bytes): Notification payload.
+            timeout (float, optional): POLICY_BLOCK: seconds to wait for a free slot, None waits forever.
+
+        Returns:
+            bool: False if the frame was refused because the ring stayed full.
+        """
+        if len(data) > self.payload_size:
+            raise ValueError(f"Frame of {len(data)} bytes exceeds the ring payload size of {self.payload_size}")
+
+        buffer = self._buffer
+        written = self._counter(_WRITTEN_OFFSET)
+        if self._space is not None:
+            if not self._space.acquire(True, timeout):
+                _COUNTER.pack_into(buffer, _DROPPED_OFFSET, self.dropped + 1)
+                return False
+        elif written - self._counter(_READ_OFFSET) >= self.capacity:
+            _COUNTER.pack_into(buffer, _DROPPED_OFFSET, self.dropped + 1)
+
+        _COUNTER.pack_into(buffer, _STARTED_OFFSET, written + 1)
+        offset = _HEADER_SIZE + written % self.capacity * self._slot_size
+        fields = _FRAME_FIELDS.pack(written + 1, timestamp, device, len(data))
+        buffer[offset:offset + _FRAME_FIELDS.size] = fields
+        start = offset + _FRAME_HEADER.size
+        buffer[start:start + len(data)] = data
+        _CRC.pack_into(buffer, offset + _FRAME_FIELDS.size, zlib.crc32(data, zlib.crc32(fields)))
+        _COUNTER.pack_into(buffer, _WRITTEN_OFFSET, written + 1)
+        if self._items is not None:
+            self._items.release()
+        return True
+
+    def read(self, timeout: Optional[float] = None) -> Optional[Frame]:
+        """
+        Take the oldest frame. Consumer side only.
+
+        Args:
+            timeout (float, optional): POLICY_BLOCK: seconds to wait for a frame, None waits forever.
+
+        Returns:
+            Tuple[float, int, bytes] | None: (timestamp, device, payload), None if the ring is empty.
+        """
+        if self._items is not None:
+            return self._take() if self._items.acquire(True, timeout) else None
+        return self._take_latest()
+
+    def read_many(self, max_frames: int, timeout: Optional[float] = None) -> List[Frame]:
+        """
+        Take up to max_frames frames, waiting only for the first one.
+        """
+        frames = []
+        first = self.read(timeout)
+        if first is None:
+            return frames
+        frames.append(first)
+        while len(frames) < max_frames:
+            frame = self.read(0)
+            if frame is None:
+                break
+            frames.append(frame)
+        return frames
+
+    def frames(self) -> Iterator[Tuple[float, int, memoryview]]:
+        """
+        The unread frames, oldest first, without taking them. Payloads are memoryviews into the
+        ring, no copies; they stay valid until the producer reuses the slot, and keep the ring's memory
+        mapped after close() until they are released. Meant for when the producer is done, e.g. at the end of a measurement.
+        """
+        written = self._counter(_WRITTEN_OFFSET)
+        read = max(self._counter(_READ_OFFSET), written - self.capacity)
+        for index in range(read, written):
+            offset = _HEADER_SIZE + index % self.capacity * self._slot_size
+            _, timestamp, device, length, _ = _FRAME_HEADER.unpack_from(self._buffer, offset)
+            start = offset + _FRAME_HEADER.size
+            yield timestamp, device, self._buffer[start:start + length]
+
+    def clear(self):
+        """
+        Discard the unread frames. Consumer side only.
+        """
+        if self._items is None:
+            _COUNTER.pack_into(self._buffer, _READ_OFFSET, self._counter(_WRITTEN_OFFSET))
+            return
+        while self._items.acquire(True, 0):
+            _COUNTER.pack_into(self._buffer, _READ_OFFSET, self._counter(_READ_OFFSET) + 1)
+            self._space.release()
+
+    def _slot(self, index: int) -> Frame:
+        offset = _HEADER_SIZE + index % self.capacity * self._slot_size
+        _, timestamp, device, length, _ = _FRAME_HEADER.unpack_from(self._buffer, offset)
+        start = offset + _FRAME_HEADER.size
+        return timestamp, device, bytes(self._buffer[start:start + length])
+
+    def _checked_slot(self, index: int) -> Optional[Frame]:
+        """
+        Copy of frame `index`, None if the slot does not hold all of it (yet).
+        """
+        offset = _HEADER_SIZE + index % self.capacity * self._slot_size
+        header = bytes(self._buffer[offset:offset + _FRAME_HEADER.size])
+        sequence, timestamp, device, length, crc = _FRAME_HEADER.unpack(header)
+        if sequence != index + 1 or length > self.payload_size:
+            return None
+        start = offset + _FRAME_HEADER.size
+        data = bytes(self._buffer[start:start + length])
+        if zlib.crc32(data, zlib.crc32(header[:_FRAME_FIELDS.size])) != crc:
+            return None
+        return timestamp, device, data
+
+    def _take(self) -> Frame:
+        read = self._counter(_READ_OFFSET)
+        frame = self._slot(read)
+        _COUNTER.pack_into(self._buffer, _READ_OFFSET, read + 1)
+        self._space.release()
+        return frame
+
+    def _take_latest(self) -> Optional[Frame]:
+        read = self._counter(_READ_OFFSET)
+        attempts = 0
+        while True:
+            written = self._counter(_WRITTEN_OFFSET)
+            read = max(read, written - self.capacity)  # skip what was overwritten
+            if read >= written:
+                break
+            frame = self._checked_slot(read)
+            # The producer may have lapped this slot while it was copied, or still be writing
+            # it: the frame it started last may not be counted in written yet
+            if self._counter(_STARTED_OFFSET) - self.capacity > read:
+                read += 1
+                attempts = 0
+                continue
+            if frame is not None:
+                _COUNTER.pack_into(self._buffer, _READ_OFFSET, read + 1)
+                return frame
+            # Counted in written, but not all of its stores are visible here yet
+            attempts += 1
+            if attempts >= _RETRIES:
+                break
+        _COUNTER.pack_into(self._buffer, _READ_OFFSET, read)
+        return None
+
+    def close(self):
+        """
+        Release the block, and free shared memory in the creating process. Payload views from
+        frames() that are still alive keep the mapping until they are gone.
+        """
+        self._buffer.release()
+        try:
+            if self._mmap is not None:
+                self._mmap.close()
+            else:
+                self._shm.close()
+        except BufferError:
+            pass  # unmapped when the last view is released
+        if self._shm is not None and self._owner:
+            self._shm.unlink()
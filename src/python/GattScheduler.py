@@ -0,0 +1,125 @@
+"""
+GATT operation scheduling for the gateway application.
+Runs the GATT operations of each device one after another, overlaps those of different devices
+up to what the controller handles, and bounds every operation with a timeout.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import metrics
+from logger import get_logger
+
+log = get_logger("ble.gatt")
+
+GATT_QUEUE_SECONDS = metrics.histogram("gateway_ble_gatt_queue_seconds", "Time GATT operations waited for their device and a controller slot", ["operation"])
+GATT_OPERATION_SECONDS = metrics.histogram("gateway_ble_gatt_operation_seconds", "GATT operation latency once started", ["operation"])
+GATT_OPERATION_ERRORS = metrics.counter("gateway_ble_gatt_errors_total", "GATT operations that failed or timed out", ["operation", "reason"])
+
+
+class GattScheduler:
+    """
+    Per-adapter scheduler for GATT operations.
+
+    BlueZ and many controllers handle concurrent GATT traffic badly: operations on one
+    device must not overlap, and only a few may be outstanding on the controller at once.
+    Each device gets a FIFO queue (an asyncio.Lock, whose waiters are served in order),
+    and a semaphore bounds the operations running across all devices, so reads of many
+    sensors pipeline at the controller's capacity instead of failing.
+
+    The timeout of an operation starts when it starts, time spent queued does not count.
+    """
+    def __init__(self, concurrency: int = 4, timeout: float = 10.0, timeouts: Optional[Dict[str, float]] = None):
+        """
+        Initialize the scheduler.
+
+        Args:
+            concurrency (int, optional): GATT operations running at once across all devices.
+            timeout (float, optional): Seconds an operation may run.
+            timeouts (Dict[str, float], optional): Timeouts per operation name, e.g. {'start_notify': 5}.
+        """
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.timeouts = dict(timeouts or {})
+        self.stats = {'operations': 0, 'timeouts': 0, 'errors': 0}
+
+        self._slots: Optional[asyncio.Semaphore] = None  # created in the event loop on first use
+        self._locks: Dict[str, asyncio.Lock] = {}  # MAC address -> lock ordering the device's operations
+        self._queued: Dict[str, int] = {}  # MAC address -> operations waiting
+
+    def queued(self, address: Optional[str] = None) -> int:
+        """
+        Operations waiting for their turn, for one device or all.
+        """
+        if address is not None:
+            return self._queued.get(address, 0)
+        return sum(self._queued.values())
+
+    async def run(self, address: str, operation: str, function: Callable[[], Awaitable[Any]], timeout: Optional[float] = None) -> Any:
+        """
+        Run a GATT operation once the device's earlier operations are done and the controller has a free slot.
+
+        Args:
+            address (str): MAC address of the device.
+            operation (str): Name for timeouts, metrics and logs, e.g. "write_gatt_char".
+            function (Callable[[], Awaitable]): Starts the operation, e.g. lambda: client.write_gatt_char(uuid, data).
+            timeout (float, optional): Overrides the configured timeout.
+
+        Raises:
+            asyncio.TimeoutError: If the operation ran longer than its timeout, it is cancelled.
+            Exception: Whatever the operation raised.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        lock = self._locks.setdefault(address, asyncio.Lock())
+        limit = timeout if timeout is not None else self.timeouts.get(operation, self.timeout)
+
+        queued_at = time.monotonic()
+        self._queued[address] = self._queued.get(address, 0) + 1
+        waiting = True
+        try:
+            async with lock, self._slots:
+                self._queued[address] -= 1
+                waiting = False
+                started = time.monotonic()
+                GATT_QUEUE_SECONDS.labels(operation).observe(started - queued_at)
+                self.stats['operations'] += 1
+                try:
+                    return await asyncio.wait_for(function(), limit)
+                except asyncio.TimeoutError:
+                    self.stats['timeouts'] += 1
+                    GATT_OPERATION_ERRORS.labels(operation, 'timeout').inc()
+                    log.warning("GATT %s on %s timed out after %.1fs", operation, address, limit)
+                    raise
+                except Exception:
+                    self.stats['errors'] += 1
+                    GATT_OPERATION_ERRORS.labels(operation, 'error').inc()
+                    raise
+                finally:
+                    GATT_OPERATION_SECONDS.labels(operation).observe(time.monotonic() - started)
+        finally:
+            if waiting:
+                self._queued[address] -= 1
+            if not self._queued[address]:
+                del self._queued[address]
+
+    async def start_notify(self, client, char_uuid: str, callback: Callable) -> Any:
+        return await self.run(client.address, 'start_notify', lambda: client.start_notify(char_uuid, callback))
+
+    async def stop_notify(self, client, char_uuid: str) -> Any:
+        return await self.run(client.address, 'stop_notify', lambda: client.stop_notify(char_uuid))
+
+    async def write_gatt_char(self, client, char_uuid: str, data: bytes) -> Any:
+        return await self.run(client.address, 'write_gatt_char', lambda: client.write_gatt_char(char_uuid, data))
+
+    async def read_gatt_char(self, client, char_uuid: str) -> bytearray:
+        return await self.run(client.address, 'read_gatt_char', lambda: client.read_gatt_char(char_uuid))
+
+    def forget(self, address: str):
+        """
+        Drop the queue of a device that is gone, unless operations are still using it.
+        """
+        lock = self._locks.get(address)
+        if lock is not None and not lock.locked() and not self._queued.get(address):
+            del self._locks[address]
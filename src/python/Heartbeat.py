@@ -0,0 +1,171 @@
+"""
+Heartbeat scheduling and encoding for the gateway application.
+Sends a full sensor snapshot only when needed, deltas when something changed and a compact keep-alive otherwise.
+"""
+
+import time
+from typing import Any, Dict, Optional
+
+from logger import get_logger
+
+log = get_logger("heartbeat")
+
+
+class Heartbeat:
+    """
+    Decides when the next heartbeat is due and what it contains.
+
+    Every heartbeat is one of three modes:
+      - "full": the complete sensor list with atl and rtl, like the original heartbeat.
+        Sent on start, every `full_every` heartbeats, on request and after a heartbeat was lost.
+      - "delta": only sensors added, removed or with a changed pairing state since the
+        previous heartbeat, plus atl/rtl if they changed. `base` is the seq of the last full heartbeat.
+      - "keepalive": nothing changed, only the gateway identity and seq.
+
+    The interval adapts to the link: each acknowledged heartbeat with a healthy round-trip
+    time stretches it by `growth` up to max_interval, a slow acknowledgement halves it, and
+    a lost heartbeat drops it to min_interval. Sensor changes are sent early, but never more
+    often than min_interval.
+    """
+    def __init__(self, gateway_mac: str, interval: float = 60.0, min_interval: float = 15.0, max_interval: float = 300.0,
+                 full_every: int = 10, slow_ack: float = 2.0, growth: float = 1.25):
+        """
+        Initialize the heartbeat.
+
+        Args:
+            gateway_mac (str): MAC address of the gateway.
+            interval (float, optional): Starting interval in seconds.
+            min_interval (float, optional): Shortest interval in seconds.
+            max_interval (float, optional): Longest interval in seconds.
+            full_every (int, optional): Send a full heartbeat at least every this many heartbeats.
+            slow_ack (float, optional): Acknowledgement time in seconds above which the link counts as degraded.
+            growth (float, optional): Factor the interval grows by after a healthy acknowledgement.
+        """
+        if min_interval <= 0 or not min_interval <= interval <= max_interval:
+            raise ValueError("Invalid heartbeat intervals")
+
+        self.gateway_mac = gateway_mac
+        self.base_interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.full_every = max(1, full_every)
+        self.slow_ack = slow_ack
+        self.growth = growth
+
+        self.interval = interval
+        self.seq = 0
+        self._full_seq = 0
+        self._since_full = 0
+        self._full_requested = True  # The platform has no state for this gateway yet
+        self._last_sent: Optional[float] = None
+        self._sensors: Dict[str, bool] = {}  # address -> ispaired, as last sent
+        self._atl = None
+        self._rtl = None
+
+    def request_full(self):
+        """
+        Make the next heartbeat a full one and send it on the next check.
+        """
+        self._full_requested = True
+        self._last_sent = None
+
+    def is_due(self, sensors: Dict[str, bool], atl: Any, rtl: Any, now: Optional[float] = None) -> bool:
+        """
+        Check whether a heartbeat should be sent now.
+
+        Args:
+            sensors (Dict[str, bool]): Current sensors, address -> ispaired.
+            atl: Current actual trust level.
+            rtl: Current required trust level.
+            now (float, optional): time.monotonic() value, read if not given.
+        """
+        if self._last_sent is None:
+            return True
+        elapsed = (time.monotonic() if now is None else now) - self._last_sent
+        if elapsed >= self.interval:
+            return True
+        return elapsed >= self.min_interval and self._has_changes(sensors, atl, rtl)
+
+    def _has_changes(self, sensors: Dict[str, bool], atl: Any, rtl: Any) -> bool:
+        return sensors != self._sensors or atl != self._atl or rtl != self._rtl
+
+    def build(self, sensors: Dict[str, bool], atl: Any, rtl: Any, now: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Build the next heartbeat payload and remember it as sent.
+
+        Args:
+            sensors (Dict[str, bool]): Current sensors, address -> ispaired.
+            atl: Current actual trust level.
+            rtl: Current required trust level.
+            now (float, optional): time.monotonic() value, read if not given.
+
+        Returns:
+            Dict[str, Any]: The payload, `seq` identifies it in on_result.
+        """
+        self.seq += 1
+        payload = {
+            'from': self.gateway_mac,
+            'timestamp': int(time.time()),
+            'type': "heartbeat",
+            'gatewayMac': self.gateway_mac,
+            'seq': self.seq,
+        }
+
+        if self._full_requested or self._since_full + 1 >= self.full_every:
+            payload['mode'] = "full"
+            payload['sensorlist'] = [{"address": address, "ispaired": paired} for address, paired in sensors.items()]
+            payload['atl'] = atl
+            payload['rtl'] = rtl
+            self._full_seq = self.seq
+            self._since_full = 0
+            self._full_requested = False
+
+        elif self._has_changes(sensors, atl, rtl):
+            payload['mode'] = "delta"
+            payload['base'] = self._full_seq
+            added = [{"address": address, "ispaired": paired} for address, paired in sensors.items() if address not in self._sensors]
+            removed = [address for address in self._sensors if address not in sensors]
+            changed = [{"address": address, "ispaired": paired} for address, paired in sensors.items()
+                       if address in self._sensors and self._sensors[address] != paired]
+            if added:
+                payload['added'] = added
+            if removed:
+                payload['removed'] = removed
+            if changed:
+                payload['changed'] = changed
+            if atl != self._atl:
+                payload['atl'] = atl
+            if rtl != self._rtl:
+                payload['rtl'] = rtl
+            self._since_full += 1
+
+        else:
+            payload['mode'] = "keepalive"
+            self._since_full += 1
+
+        self._sensors = dict(sensors)
+        self._atl = atl
+        self._rtl = rtl
+        self._last_sent = time.monotonic() if now is None else now
+        return payload
+
+    def on_result(self, seq: int, delivered: bool, ack_time: Optional[float] = None):
+        """
+        Adapt the interval to the outcome of a heartbeat.
+
+        Args:
+            seq (int): seq of the heartbeat.
+            delivered (bool): True if the broker acknowledged it.
+            ack_time (float, optional): Seconds from publish to acknowledgement.
+        """
+        if not delivered:
+            # The platform may have missed a delta, resynchronise with a full heartbeat soon
+            self._full_requested = True
+            self.interval = self.min_interval
+            log.warning("Heartbeat %s was not delivered, next heartbeat in %.0fs", seq, self.interval)
+        elif ack_time is not None and ack_time > self.slow_ack:
+            self.interval = max(self.min_interval, self.interval / 2)
+            log.info("Heartbeat %s acknowledged after %.1fs, interval lowered to %.0fs", seq, ack_time, self.interval)
+        else:
+            self.interval = min(self.max_interval, self.interval * self.growth)
+            log.debug("Heartbeat %s acknowledged, interval %.0fs", seq, self.interval)
@@ -0,0 +1,165 @@
+"""
+Adaptive in-flight window for QoS>0 publishing.
+Starts from the broker-advertised Receive Maximum and resizes with the measured ack round-trip time.
+"""
+
+import collections
+import threading
+from typing import Deque, Dict, Optional, Any
+
+
+class InflightWindow:
+    """
+    Tracks unacknowledged messages and decides how many may be in flight at once.
+
+    Once per window of acknowledgements the smoothed RTT is compared with the
+    lowest RTT seen recently: if acks are much slower than that baseline the
+    broker is queueing, so the window shrinks multiplicatively; if the window
+    was fully used and RTT is healthy it grows again, up to the ceiling.
+
+    The window is changed on the event loop thread and read by the metrics server
+    thread: changes and snapshot() hold a lock, so a scrape sees a consistent state.
+    """
+    def __init__(self, max_window: int = 65535, min_window: int = 1, congestion_ratio: float = 2.0, rtt_samples: int = 256):
+        """
+        Initialize the window.
+
+        Args:
+            max_window (int, optional): Upper bound regardless of what the broker advertises.
+            min_window (int, optional): The window never shrinks below this value.
+            congestion_ratio (float, optional): Smoothed RTT over baseline RTT at which the window shrinks.
+            rtt_samples (int, optional): Number of recent RTT samples kept for baseline and percentiles.
+        """
+        self.max_window = max_window
+        self.min_window = min_window
+        self.congestion_ratio = congestion_ratio
+
+        self.receive_maximum: Optional[int] = None
+        self.ceiling = max_window
+        self.window = max_window
+
+        self._sent: Dict[int, float] = {}  # mid -> send time
+        self._rtts: Deque[float] = collections.deque(maxlen=rtt_samples)
+        self._srtt: Optional[float] = None
+        self._acks_since_adjust = 0
+        self._saturated = False
+        self._lock = threading.Lock()
+
+    def set_receive_maximum(self, receive_maximum: Optional[int]):
+        """
+        Restart the window from the Receive Maximum advertised in CONNACK.
+
+        Args:
+            receive_maximum (int, optional): Broker value, None if not advertised (MQTT 3.1.1).
+        """
+        with self._lock:
+            self.receive_maximum = receive_maximum
+            if receive_maximum:
+                self.ceiling = max(self.min_window, min(receive_maximum, self.max_window))
+            else:
+                self.ceiling = self.max_window
+            self.window = self.ceiling
+            self._acks_since_adjust = 0
+            self._saturated = False
+
+    def clear(self):
+        """
+        Forget all in-flight messages, e.g. when the session they belonged to is gone.
+        """
+        with self._lock:
+            self._sent.clear()
+            self._acks_since_adjust = 0
+
+    @property
+    def inflight(self) -> int:
+        return len(self._sent)
+
+    def has_capacity(self) -> bool:
+        return len(self._sent) < self.window
+
+    def on_send(self, mid: int, sent_at: float):
+        """
+        Record that a message left the gateway.
+
+        Args:
+            mid (int): MQTT message id.
+            sent_at (float): time.monotonic() when the message was handed to the client.
+        """
+        with self._lock:
+            self._sent[mid] = sent_at
+            if len(self._sent) >= self.window:
+                self._saturated = True
+
+    def on_ack(self, mid: int, acked_at: float) -> Optional[float]:
+        """
+        Record the acknowledgement of a message and adapt the window.
+
+        Args:
+            mid (int): MQTT message id.
+            acked_at (float): time.monotonic() when PUBACK/PUBCOMP arrived.
+
+        Returns:
+            float: The round-trip time in seconds, or None if the message was not tracked.
+        """
+        with self._lock:
+            sent_at = self._sent.pop(mid, None)
+            if sent_at is None:
+                return None
+
+            rtt = max(0.0, acked_at - sent_at)
+            self._rtts.append(rtt)
+            self._srtt = rtt if self._srtt is None else self._srtt * 0.875 + rtt * 0.125
+
+            self._acks_since_adjust += 1
+            if self._acks_since_adjust >= self.window:
+                self._adjust()
+            return rtt
+
+    def _adjust(self):
+        baseline = min(self._rtts)
+        if baseline > 0 and self._srtt > baseline * self.congestion_ratio:
+            self.window = max(self.min_window, int(self.window * 0.75))
+        elif self._saturated:
+            self.window = min(self.ceiling, self.window + max(1, self.window // 8))
+
+        self._acks_since_adjust = 0
+        self._saturated = len(self._sent) >= self.window
+
+    def rtt_percentiles(self, percentiles=(50, 90, 99)) -> Dict[int, Optional[float]]:
+        """
+        Compute RTT percentiles over the recent samples.
+
+        Returns:
+            Dict[int, Optional[float]]: Percentile -> RTT in seconds, None without samples.
+        """
+        with self._lock:
+            samples = sorted(self._rtts)
+        return self._percentiles(samples, percentiles)
+
+    @staticmethod
+    def _percentiles(samples, percentiles) -> Dict[int, Optional[float]]:
+        if not samples:
+            return {p: None for p in percentiles}
+        last = len(samples) - 1
+        return {p: samples[min(last, int(round(p / 100 * last)))] for p in percentiles}
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Current window state and ack latency, for metrics.
+        """
+        with self._lock:
+            state = {
+                'window': self.window,
+                'ceiling': self.ceiling,
+                'receive_maximum': self.receive_maximum,
+                'inflight': len(self._sent),
+                'rtt_srtt': self._srtt,
+            }
+            samples = sorted(self._rtts)
+        percentiles = self._percentiles(samples, (50, 90, 99))
+        return {
+            **state,
+            'rtt_p50': percentiles[50],
+            'rtt_p90': percentiles[90],
+            'rtt_p99': percentiles[99],
+        }
@@ -0,0 +1,504 @@
+"""
+Multi-process BLE ingestion for the gateway application.
+Worker processes own the BLE connections of a share of the sensors, collect and edge-process measurements,
+and return the raw notifications through shared-memory rings. The main process keeps MQTT and orchestration.
+"""
+
+import asyncio
+import itertools
+import logging
+import threading
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import config as config
+import metrics
+from BleBackend import BleBackend
+from BluetoothAdapter import BLE_NOTIFICATION_BYTES, BLE_NOTIFICATIONS, BluetoothAdapter, DataCache, sample_ring_frames
+from EdgeProcessor import EdgeProcessor
+from FrameRing import POLICY_BLOCK, FrameRing
+from logger import ROOT_LOGGER, get_logger, setup_logging
+
+log = get_logger("ingest")
+
+INGEST_RING_FRAMES = metrics.gauge("gateway_ingest_ring_frames", "Notification frames waiting in a worker's shared-memory ring", ["worker"])
+INGEST_WORKERS_ALIVE = metrics.gauge("gateway_ingest_workers_alive", "BLE ingestion worker processes running")
+
+# Seconds a worker waits for a free ring slot before giving up on a measurement
+RING_WRITE_TIMEOUT = 30.0
+# Frames the main process takes from a ring per batch
+READ_BATCH = 256
+
+
+class _WorkerAdapter(BluetoothAdapter):
+    """
+    BluetoothAdapter inside a worker process, tells the main process about dropped links.
+    """
+    def __init__(self, backend: BleBackend, index: int, results):
+        super().__init__(backend)
+        self.index = index
+        self.results = results
+
+    def _on_device_disconnected(self, client):
+        address = getattr(client, 'address', None)
+        dropped = address is not None and self.connected_devices.get(address) is client
+        super()._on_device_disconnected(client)
+        if dropped:
+            self.results.put((self.index, None, 'disconnected', address))
+
+
+class _Worker:
+    """
+    Event loop of one worker process. Commands arrive as (request id, name, args) and are
+    answered with (worker index, request id, ok, result) on the shared results queue.
+    """
+    def __init__(self, index: int, backend_factory: Callable[[], BleBackend], ring: FrameRing, commands, results):
+        self.index = index
+        self.ring = ring
+        self.commands = commands
+        self.results = results
+        self.adapter = _WorkerAdapter(backend_factory(), index, results)
+        self._ring_lock: Optional[asyncio.Lock] = None  # one measurement written to the ring at a time
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._ring_lock = asyncio.Lock()
+        tasks = set()
+        while True:
+            request_id, command, args = await loop.run_in_executor(None, self.commands.get)
+            if command == 'stop':
+                break
+            task = asyncio.create_task(self.handle(request_id, command, args))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        for task in tasks:
+            task.cancel()
+        for address in list(self.adapter.connected_devices):
+            await self.adapter.disconnect_device(address)
+
+    async def handle(self, request_id: int, command: str, args: tuple):
+        try:
+            result = await getattr(self, f"do_{command}")(*args)
+        except Exception as e:
+            self.results.put((self.index, request_id, False, f"{type(e).__name__}: {e}"))
+        else:
+            self.results.put((self.index, request_id, True, result))
+
+    async def do_pair(self, device_info: Dict[str, Any]) -> bool:
+        return await self.adapter.pair_device(device_info)
+
+    async def do_unpair(self, device_info: Dict[str, Any]) -> bool:
+        return await self.adapter.unpair_device(device_info)
+
+    async def do_connect(self, address: str) -> bool:
+        return await self.adapter.connect_device(address)
+
+    async def do_disconnect(self, address: str) -> bool:
+        return await self.adapter.disconnect_device(address)
+
+    async def do_scan(self, timeout: float) -> List[Dict[str, Any]]:
+        return await self.adapter.scan_devices(timeout)
+
+    async def do_challenge(self, address: str, nonce: str) -> Optional[str]:
+        return await self.adapter.sign_challenge(address, nonce)
+
+    async def do_stats(self) -> Dict[str, int]:
+        return dict(getattr(self.adapter.backend, 'stats', {}))
+
+    async def do_read(self, address: str, device: int, duration: float, profile: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        data_cache = await self.adapter.measure(address, duration, DataCache(address, frames=sample_ring_frames(duration, profile)))
+        if data_cache is None:
+            return None
+
+        try:
+            result = {
+                'count': data_cache.count,
+                'dropped': data_cache.dropped,
+                'bytes': sum(len(data) for data in data_cache.cached_data),
+                'first_at': data_cache.first_at,
+                'last_at': data_cache.last_at,
+                'processed': None,
+                'raw': True,
+                'frames': 0,
+            }
+            processor = None
+            if profile:
+                try:
+                    processor = EdgeProcessor.from_config(profile)
+                except ValueError as e:
+                    log.warning("Invalid processing profile for %s, sending raw notifications: %s", address, e)
+            if processor is not None:
+                result['processed'] = processor.process(data_cache.cached_data)
+                result['raw'] = processor.needs_raw(result['processed'])
+
+            if result['raw'] and data_cache.count:
+                async with self._ring_lock:
+                    result['frames'] = await asyncio.get_running_loop().run_in_executor(None, self._write_frames, device, data_cache)
+            return result
+        finally:
+            data_cache.close()
+
+    def _write_frames(self, device: int, data_cache: DataCache) -> int:
+        written = 0
+        for timestamp, _, data in data_cache.ring.frames():
+            if not self.ring.write(timestamp, device, data, RING_WRITE_TIMEOUT):
+                raise RuntimeError("Shared-memory ring stayed full, is the main process reading?")
+            written += 1
+        return written
+
+
+def _worker_main(index: int, backend_factory: Callable[[], BleBackend], ring: FrameRing, commands, results, log_level: str):
+    setup_logging(level=log_level)
+    try:
+        asyncio.run(_Worker(index, backend_factory, ring, commands, results).run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ring.close()
+
+
+class _Collection:
+    """
+    Frames of one measurement arriving from a ring.
+    """
+    def __init__(self):
+        self.frames: List[Tuple[float, bytes]] = []  # (receipt time, notification)
+        self.event = asyncio.Event()
+
+
+class _Measurement:
+    """
+    A measurement taken in a worker, published straight from the frames its ring delivered
+    instead of copying them into a DataCache. Has what publish_measurement uses of one.
+    """
+    __slots__ = ('count', 'dropped', 'first_at', 'last_at', 'frames')
+
+    def __init__(self, result: Dict[str, Any], frames: List[Tuple[float, bytes]]):
+        # As counted in the worker, which may have kept fewer than it received
+        self.count = result['count']
+        self.dropped = result['dropped']
+        self.first_at = result['first_at']
+        self.last_at = result['last_at']
+        self.frames = frames
+
+    def get_raw(self) -> bytes:
+        return b''.join(data for _, data in self.frames)
+
+
+class IngestPool:
+    """
+    Worker processes running the BLE stack, each owning the sensors whose address hashes to it.
+
+    Connections, GATT traffic, notification callbacks and edge processing happen in the
+    workers, so they use all cores. A measurement comes back as a small result over a
+    multiprocessing queue; its raw notifications, when they are needed, through the
+    worker's FrameRing. Workers are started with the "spawn" method, as forking a process
+    that runs the MQTT network and logging threads is not safe.
+    """
+    def __init__(self, workers: int, backend_factory: Callable[[], BleBackend], ring_frames: int = 4096,
+                 frame_size: int = 512, timeout: float = 60.0):
+        """
+        Initialize the pool.
+
+        Args:
+            workers (int): Number of worker processes.
+            backend_factory (Callable[[], BleBackend]): Picklable function that creates the BLE backend in a worker.
+            ring_frames (int, optional): Frames per worker ring.
+            frame_size (int, optional): Largest notification in bytes.
+            timeout (float, optional): Seconds to wait for a worker to answer, on top of the measurement duration.
+        """
+        self.workers = max(1, workers)
+        self.backend_factory = backend_factory
+        self.ring_frames = ring_frames
+        self.frame_size = frame_size
+        self.timeout = timeout
+        self.disconnected_callback: Optional[Callable[[str], None]] = None  # called with the address of a dropped link
+
+        import multiprocessing  # Only a gateway with ingestion workers needs it
+        self._context = multiprocessing.get_context("spawn")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._processes = []
+        self._rings: List[FrameRing] = []
+        self._commands = []
+        self._results = None
+        self._threads: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        self._request_ids = itertools.count(1)
+        self._requests: Dict[int, asyncio.Future] = {}
+        self._devices: List[Dict[str, int]] = [{} for _ in range(self.workers)]  # per worker: address -> device index
+        self._collections: Dict[Tuple[int, int], _Collection] = {}  # (worker, device index) -> frames being received
+
+    @property
+    def started(self) -> bool:
+        return bool(self._processes)
+
+    def worker_for(self, address: str) -> int:
+        # Stable across runs, unlike hash()
+        return zlib.crc32(address.encode()) % self.workers
+
+    def device_index(self, worker: int, address: str) -> int:
+        devices = self._devices[worker]
+        return devices.setdefault(address, len(devices) % 65536)
+
+    async def start(self):
+        """
+        Start the worker processes. Does nothing if they are running.
+        """
+        if self.started:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._stopping.clear()
+        self._results = self._context.Queue()
+        log_level = logging.getLevelName(logging.getLogger(ROOT_LOGGER).getEffectiveLevel())
+
+        for index in range(self.workers):
+            ring = FrameRing(self.ring_frames, self.frame_size, POLICY_BLOCK, context=self._context)
+            commands = self._context.Queue()
+            process = self._context.Process(target=_worker_main, args=(index, self.backend_factory, ring, commands, self._results, log_level),
+                                            name=f"ble-ingest-{index}", daemon=True)
+            process.start()
+            self._rings.append(ring)
+            self._commands.append(commands)
+            self._processes.append(process)
+            INGEST_RING_FRAMES.labels(str(index)).set_function(lambda ring=ring: len(ring))
+
+            reader = threading.Thread(target=self._read_ring, args=(index, ring), name=f"ble-ingest-ring-{index}", daemon=True)
+            reader.start()
+            self._threads.append(reader)
+
+        listener = threading.Thread(target=self._read_results, name="ble-ingest-results", daemon=True)
+        listener.start()
+        self._threads.append(listener)
+        INGEST_WORKERS_ALIVE.set_function(lambda: sum(process.is_alive() for process in self._processes))
+        log.info("Started %s BLE ingestion workers", self.workers)
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Stop the workers, they disconnect their devices first.
+        """
+        if not self.started:
+            return
+        for commands in self._commands:
+            commands.put((0, 'stop', ()))
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                log.warning("Ingestion worker %s did not stop, terminating it", process.name)
+                process.terminate()
+
+        self._stopping.set()
+        self._results.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        for ring in self._rings:
+            ring.close()
+        for future in self._requests.values():
+            future.cancel()
+
+        self._processes, self._rings, self._commands, self._threads = [], [], [], []
+        self._requests.clear()
+        self._collections.clear()
+        log.info("Stopped BLE ingestion workers")
+
+    async def call(self, worker: int, command: str, *args, timeout: Optional[float] = None) -> Any:
+        """
+        Run a command in a worker and wait for its result.
+
+        Raises:
+            RuntimeError: If the worker is not running or the command failed in the worker.
+            asyncio.TimeoutError: If the worker did not answer in time.
+        """
+        if not self.started or not self._processes[worker].is_alive():
+            raise RuntimeError(f"BLE ingestion worker {worker} is not running")
+
+        request_id = next(self._request_ids)
+        future = self._loop.create_future()
+        self._requests[request_id] = future
+        try:
+            self._commands[worker].put((request_id, command, args))
+            return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        finally:
+            self._requests.pop(request_id, None)
+
+    async def read(self, address: str, duration: float, profile: Optional[Dict[str, Any]] = None) -> Optional[Tuple[Dict[str, Any], List[Tuple[float, bytes]]]]:
+        """
+        Take a measurement in the worker that owns the device.
+
+        Returns:
+            Tuple[Dict[str, Any], List[Tuple[float, bytes]]] | None: The worker's result and the raw
+                notifications with their receipt times, None if the device is not connected.
+        """
+        worker = self.worker_for(address)
+        key = (worker, self.device_index(worker, address))
+        collection = self._collections[key] = _Collection()
+        try:
+            result = await self.call(worker, 'read', address, key[1], duration, profile, timeout=duration + self.timeout)
+            if result is None:
+                return None
+            # The worker answers after writing its frames, the ring reader may still be behind
+            while len(collection.frames) < result['frames']:
+                collection.event.clear()
+                await asyncio.wait_for(collection.event.wait(), self.timeout)
+            return result, collection.frames
+        finally:
+            if self._collections.get(key) is collection:
+                del self._collections[key]
+
+    async def backend_stats(self) -> Dict[str, int]:
+        """
+        Sum of the backend statistics of all workers, e.g. FakeBleBackend.stats.
+        """
+        totals: Dict[str, int] = {}
+        for stats in await asyncio.gather(*(self.call(worker, 'stats') for worker in range(self.workers))):
+            for name, value in stats.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def _read_ring(self, worker: int, ring: FrameRing):
+        """
+        Ring reader thread: hands batches of frames to the event loop.
+        """
+        while not self._stopping.is_set():
+            frames = ring.read_many(READ_BATCH, timeout=0.2)
+            if frames:
+                self._loop.call_soon_threadsafe(self._on_frames, worker, frames)
+
+    def _on_frames(self, worker: int, frames: List[Tuple[float, int, bytes]]):
+        updated = set()
+        for timestamp, device, data in frames:
+            collection = self._collections.get((worker, device))
+            if collection is not None:
+                collection.frames.append((timestamp, data))
+                updated.add(collection)
+        for collection in updated:
+            collection.event.set()
+
+    def _read_results(self):
+        """
+        Results listener thread: resolves the futures of call() on the event loop.
+        """
+        while True:
+            message = self._results.get()
+            if message is None:
+                return
+            self._loop.call_soon_threadsafe(self._on_result, *message)
+
+    def _on_result(self, worker: int, request_id: Optional[int], ok: Any, result: Any):
+        if request_id is None:
+            if ok == 'disconnected' and self.disconnected_callback is not None:
+                self.disconnected_callback(result)
+            return
+
+        future = self._requests.get(request_id)
+        if future is None or future.done():
+            return
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(RuntimeError(f"Worker {worker}: {result}"))
+
+
+class WorkerBluetoothAdapter(BluetoothAdapter):
+    """
+    BluetoothAdapter whose BLE work runs in an IngestPool. connected_devices maps each
+    connected address to the index of the worker that holds the connection.
+    """
+    def __init__(self, pool: IngestPool):
+        """
+        Initialize the adapter.
+
+        Args:
+            pool (IngestPool): The worker processes, started by start().
+        """
+        super().__init__()
+        self.pool = pool
+        self.pool.disconnected_callback = self._on_worker_disconnected
+
+    async def start(self):
+        await self.pool.start()
+
+    def stop(self):
+        self.pool.stop()
+
+    def _on_worker_disconnected(self, address: str):
+        if self.connected_devices.pop(address, None) is not None:
+            log.warning("Device %s disconnected unexpectedly", address)
+
+    async def _call(self, address: str, command: str, *args) -> bool:
+        try:
+            return await self.pool.call(self.pool.worker_for(address), command, *args)
+        except Exception as e:
+            log.error("BLE %s of %s failed: %s", command, address, e)
+            return False
+
+    async def connect_device(self, address: str) -> bool:
+        connected = await self._call(address, 'connect', address)
+        if connected:
+            self.connected_devices[address] = self.pool.worker_for(address)
+        return connected
+
+    async def disconnect_device(self, address: str) -> bool:
+        disconnected = await self._call(address, 'disconnect', address)
+        if disconnected:
+            self.connected_devices.pop(address, None)
+        return disconnected
+
+    async def sign_challenge(self, address: str, nonce: str) -> Optional[str]:
+        if not self.is_device_connected(address):
+            return None
+        # Errors reach the attestation cache, which retries
+        return await self.pool.call(self.pool.worker_for(address), 'challenge', address, nonce)
+
+    async def pair_device(self, device_info):
+        if 'address' not in device_info:
+            log.warning("Cannot pair: Missing device address in pairing information")
+            return False
+
+        address = device_info['address']
+        paired = await self._call(address, 'pair', device_info)
+        if paired:
+            self.connected_devices[address] = self.pool.worker_for(address)
+            profile = {'address': address}
+            if 'config' in device_info:
+                profile['config'] = device_info['config']
+            self.device_profiles[address] = profile
+        return paired
+
+    async def unpair_device(self, device_info):
+        if 'address' not in device_info:
+            log.warning("Cannot unpair: Missing device address in unpairing information")
+            return False
+
+        address = device_info['address']
+        self.device_profiles.pop(address, None)
+        self.connected_devices.pop(address, None)
+        return await self._call(address, 'unpair', {'address': address})
+
+    async def scan_devices(self, timeout: float = 5.0) -> List[Dict[str, Any]]:
+        # One scanner per controller, the first worker scans
+        try:
+            return await self.pool.call(0, 'scan', timeout, timeout=timeout + self.pool.timeout)
+        except Exception as e:
+            log.error("BLE scan failed: %s", e)
+            return []
+
+    async def read_data(self, address: str):
+        try:
+            if not self.is_device_connected(address):
+                log.warning("Failed to connect to device: %s", address)
+                return
+
+            response = await self.pool.read(address, config.BLE_MEASUREMENT_DURATION, self.processing_profile(address))
+            if response is None:
+                log.warning("Failed to connect to device: %s", address)
+                return
+
+            result, frames = response
+            BLE_NOTIFICATIONS.labels(address).inc(result['count'])
+            BLE_NOTIFICATION_BYTES.labels(address).inc(result['bytes'])
+
+            self.publish_measurement(address, _Measurement(result, frames), result['processed'], result['raw'])
+
+        except Exception as e:
+            log.error("An error occurred during the Bluetooth operation: %s", e)
@@ -0,0 +1,290 @@
+"""
+Instruction queue for the gateway application.
+Orders instructions by priority, drops expired ones and drops duplicate and redundant instructions before they reach the BLE adapter.
+"""
+
+import asyncio
+import collections
+import heapq
+import threading
+import time
+from typing import Callable, Collection, Dict, Hashable, List, Optional, Tuple
+
+import metrics
+from Instructions import Instruction, TrustInstruction
+from logger import get_logger
+
+log = get_logger("queue")
+
+INSTRUCTIONS_COALESCED = metrics.counter("gateway_instructions_coalesced_total", "Instructions dropped as duplicate or redundant", ["type", "reason"])
+INSTRUCTIONS_EXPIRED = metrics.counter("gateway_instructions_expired_total", "Instructions dropped because their deadline passed", ["type"])
+
+# Instruction types whose repeated execution has no further effect
+IDEMPOTENT_TYPES = ('read', 'scan', 'sensorlist', 'getheartbeat')
+
+# Priority classes, lower runs first
+PRIORITY_CONTROL = 0  # trust level updates and gateway control
+PRIORITY_PAIRING = 1
+PRIORITY_READ = 2
+PRIORITY_SCAN = 3
+
+DEFAULT_PRIORITIES = {
+    'trust': PRIORITY_CONTROL,
+    'getheartbeat': PRIORITY_CONTROL,
+    'timesync': PRIORITY_CONTROL,
+    'pair': PRIORITY_PAIRING,
+    'unpair': PRIORITY_PAIRING,
+    'sensorlist': PRIORITY_PAIRING,
+    'read': PRIORITY_READ,
+    'scan': PRIORITY_SCAN,
+}
+
+
+class InstructionQueue:
+    """
+    Priority queue of instructions, used in place of asyncio.Queue.
+
+    Instructions are taken by priority class (control and trust, then pair/unpair,
+    then reads, then scans) and in arrival order within a class. A trust level (`atl`)
+    carried by a pairing, read or scan instruction is split off into a separate `trust`
+    instruction, so it is applied without waiting behind BLE work.
+
+    An instruction may carry a deadline: `deadline` as a unix timestamp and/or `ttl`
+    in seconds after arrival; instructions without either use the default TTL of their
+    type, if any. Instructions whose deadline passed while queued are not returned by
+    get_nowait but passed to expired_callback, so they can be reported.
+
+    An instruction is not queued when:
+      - "duplicate": its message id (`messageId` or `id`) was seen within the dedupe window,
+        e.g. a QoS 1 redelivery or a platform retry.
+      - "pending": an idempotent instruction with the same key is still waiting. Reads
+        coalesce per address, scans and heartbeat requests globally, sensor lists when
+        they list the same sensors.
+      - "in_progress": an idempotent instruction with the same key is being handled
+        right now, its result is shared.
+
+    put_nowait may be called from any thread (the MQTT network thread); wait, get_nowait
+    and task_done from the event loop. wait() returns as soon as an instruction is queued,
+    so the consumer does not have to poll.
+
+    A consumer that cannot take instructions of some type right now (e.g. reads while
+    every read slot is busy) passes them as `held` to get_nowait: the first one stays
+    queued, and so does everything behind it. wait(since=arrivals) then returns only for
+    instructions queued later, which may be more urgent.
+    """
+    def __init__(self, dedupe_window: float = 60.0, priorities: Optional[Dict[str, int]] = None,
+                 default_ttls: Optional[Dict[str, float]] = None,
+                 expired_callback: Optional[Callable[[Instruction], None]] = None):
+        """
+        Initialize the queue.
+
+        Args:
+            dedupe_window (float, optional): Seconds a message id is remembered.
+            priorities (Dict[str, int], optional): Priority class per instruction type, overriding the defaults.
+                Unknown types are handled like reads.
+            default_ttls (Dict[str, float], optional): Seconds an instruction of a type may wait when it has no deadline.
+            expired_callback (Callable, optional): Called from get_nowait with every expired instruction.
+        """
+        self.dedupe_window = dedupe_window
+        self.priorities = dict(DEFAULT_PRIORITIES, **(priorities or {}))
+        self.default_ttls = dict(default_ttls or {})
+        self.expired_callback = expired_callback
+        self.stats = {'duplicate': 0, 'pending': 0, 'in_progress': 0, 'expired': 0}
+
+        self._lock = threading.Lock()
+        self._heap: List[Tuple[int, int, float, Instruction]] = []  # (priority, arrival, expires at, instruction)
+        self._arrivals = 0
+        self._pending: Dict[Hashable, Instruction] = {}  # coalesce key -> queued instruction
+        self._running: Dict[Hashable, int] = {}  # coalesce key -> instructions being handled
+        self._seen: "collections.OrderedDict[Hashable, float]" = collections.OrderedDict()  # message id -> time seen
+        self._loop: Optional[asyncio.AbstractEventLoop] = None  # of the consumer, set by wait()
+        self._queued: Optional[asyncio.Event] = None
+
+    @staticmethod
+    def coalesce_key(instruction: Instruction) -> Optional[Tuple]:
+        """
+        Key under which equivalent instructions are merged, None if the instruction is never merged.
+        """
+        instruction_type = instruction.type
+        if instruction_type not in IDEMPOTENT_TYPES:
+            return None
+        if instruction_type == 'read':
+            return (instruction_type, instruction.address)
+        if instruction_type == 'sensorlist':
+            return (instruction_type, tuple(sorted(sensor['address'] for sensor in instruction.sensors)))
+        return (instruction_type,)
+
+    @staticmethod
+    def message_id(instruction: Instruction) -> Optional[Hashable]:
+        message_id = instruction.message_id
+        return message_id if isinstance(message_id, (str, int)) else None
+
+    def priority(self, instruction: Instruction) -> int:
+        return self.priorities.get(instruction.type, PRIORITY_READ)
+
+    def put_nowait(self, instruction: Instruction) -> bool:
+        """
+        Queue an instruction unless it is a duplicate or already covered.
+
+        Returns:
+            bool: True if the instruction was queued.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire_seen(now)
+            message_id = self.message_id(instruction)
+            if message_id is not None:
+                if message_id in self._seen:
+                    return self._drop(instruction, 'duplicate')
+                self._seen[message_id] = now
+
+            trust = self._split_trust(instruction)
+            if trust is not None:
+                self._push(trust, now)
+
+            key = self.coalesce_key(instruction)
+            if key is not None and (key in self._pending or key in self._running):
+                queued = self._drop(instruction, 'pending' if key in self._pending else 'in_progress')
+            else:
+                if key is not None:
+                    self._pending[key] = instruction
+                self._push(instruction, now)
+                queued = True
+        if queued or trust is not None:
+            self._notify()
+        return queued
+
+    @property
+    def arrivals(self) -> int:
+        """
+        Number of instructions queued so far.
+        """
+        return self._arrivals
+
+    async def wait(self, timeout: Optional[float] = None, since: Optional[int] = None) -> bool:
+        """
+        Wait until an instruction is queued, at most `timeout` seconds.
+
+        Args:
+            timeout (float, optional): Seconds to wait at most.
+            since (int, optional): A value of `arrivals`: wait for an instruction queued after it,
+                even if older ones are waiting.
+
+        Returns:
+            bool: True if an instruction is waiting (queued after `since`, if given).
+        """
+        if self._queued is None:
+            self._loop = asyncio.get_running_loop()
+            self._queued = asyncio.Event()
+
+        def ready():
+            return self._arrivals > since if since is not None else bool(self._heap)
+
+        if ready():
+            return True
+        self._queued.clear()
+        try:
+            await asyncio.wait_for(self._queued.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return ready()
+
+    def get_nowait(self, held: Collection[str] = ()) -> Instruction:
+        """
+        Take the most urgent instruction that has not expired. Call task_done(instruction)
+        once it has been handled.
+
+        Args:
+            held (Collection[str], optional): Instruction types to leave queued. When the most
+                urgent instruction is one of them, nothing is taken.
+
+        Raises:
+            asyncio.QueueEmpty: If no instruction is waiting, or the most urgent one is held.
+        """
+        expired = []
+        try:
+            with self._lock:
+                now = time.monotonic()
+                while self._heap:
+                    _, _, expires_at, instruction = self._heap[0]
+                    if expires_at > now and instruction.type in held:
+                        raise asyncio.QueueEmpty()
+                    heapq.heappop(self._heap)
+                    key = self.coalesce_key(instruction)
+                    if key is not None and self._pending.get(key) is instruction:
+                        del self._pending[key]
+                    if expires_at <= now:
+                        self.stats['expired'] += 1
+                        INSTRUCTIONS_EXPIRED.labels(instruction.type).inc()
+                        expired.append(instruction)
+                        continue
+                    if key is not None:
+                        self._running[key] = self._running.get(key, 0) + 1
+                    return instruction
+                raise asyncio.QueueEmpty()
+        finally:
+            # Outside the lock, the callback may publish
+            for instruction in expired:
+                log.warning("Dropped expired %s instruction", instruction.type)
+                if self.expired_callback is not None:
+                    self.expired_callback(instruction)
+
+    def task_done(self, instruction: Optional[Instruction] = None):
+        """
+        Mark an instruction from get_nowait as handled, later equivalent instructions run again.
+        """
+        if instruction is None:
+            return
+        key = self.coalesce_key(instruction)
+        with self._lock:
+            if key in self._running:
+                self._running[key] -= 1
+                if self._running[key] <= 0:
+                    del self._running[key]
+
+    def qsize(self) -> int:
+        return len(self._heap)
+
+    def empty(self) -> bool:
+        return not self._heap
+
+    def _notify(self):
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._queued.set)
+
+    def _push(self, instruction: Instruction, now: float):
+        self._arrivals += 1
+        heapq.heappush(self._heap, (self.priority(instruction), self._arrivals, self._expires_at(instruction, now), instruction))
+
+    def _expires_at(self, instruction: Instruction, now: float) -> float:
+        """
+        Deadline on the time.monotonic() clock, infinity if there is none.
+        """
+        expires_at = float('inf')
+        ttl = instruction.ttl if instruction.ttl is not None else self.default_ttls.get(instruction.type)
+        if ttl is not None:
+            expires_at = now + ttl
+        if instruction.deadline is not None:
+            expires_at = min(expires_at, now + (instruction.deadline - time.time()))
+        return expires_at
+
+    def _split_trust(self, instruction: Instruction) -> Optional[Instruction]:
+        if instruction.atl is None or self.priority(instruction) == PRIORITY_CONTROL:
+            return None
+        trust = TrustInstruction(type='trust', sender=instruction.sender, atl=instruction.atl, received_at=instruction.received_at)
+        instruction.atl = None
+        return trust
+
+    def _drop(self, instruction: Instruction, reason: str) -> bool:
+        self.stats[reason] += 1
+        INSTRUCTIONS_COALESCED.labels(instruction.type, reason).inc()
+        log.debug("Dropped %s %s instruction", reason, instruction.type)
+        return False
+
+    def _expire_seen(self, now: float):
+        while self._seen:
+            message_id, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.dedupe_window:
+                break
+            del self._seen[message_id]
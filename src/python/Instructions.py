@@ -0,0 +1,252 @@
+"""
+Typed instructions for the gateway application.
+Decodes MQTT payloads once into one small slotted object per instruction type.
+"""
+
+import dataclasses
+import json
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import orjson  # Optional, decodes several times faster than json
+except ImportError:
+    orjson = None
+
+# Slotted dataclasses need Python 3.10, older interpreters get regular ones
+_instruction = dataclasses.dataclass(slots=True) if sys.version_info >= (3, 10) else dataclasses.dataclass
+
+
+class InstructionError(ValueError):
+    """
+    Raised for payloads that are not a valid instruction. `reason` is a short metric label.
+    """
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+def loads(payload: bytes) -> Any:
+    """
+    Decode JSON from bytes without an intermediate str.
+    """
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+def self_prefixes(mac_address: str) -> Tuple[bytes, ...]:
+    """
+    Payload prefixes of messages published by this gateway, which always start with its 'from' field.
+    Covers the json.dumps and the compact orjson formatting.
+    """
+    return (
+        b'{"from": "' + mac_address.encode() + b'"',
+        b'{"from":"' + mac_address.encode() + b'"',
+    )
+
+
+@_instruction
+class Instruction:
+    type: str
+    sender: Optional[str] = None  # 'from'
+    message_id: Any = None  # 'messageId' or 'id', used for deduplication
+    atl: Optional[float] = None
+    create_technical: bool = False
+    deadline: Optional[float] = None  # unix time
+    ttl: Optional[float] = None  # seconds after arrival
+    received_at: Optional[float] = None  # time.monotonic() when received, set by MqttHandler
+
+    @classmethod
+    def _fields_from(cls, message: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Type-specific fields, overridden per instruction type.
+        """
+        return {}
+
+
+@_instruction
+class AddressInstruction(Instruction):
+    address: str = ""
+
+    @classmethod
+    def _fields_from(cls, message):
+        return {'address': _require_str(message, 'address')}
+
+
+@_instruction
+class PairInstruction(AddressInstruction):
+    config: Optional[Dict[str, Any]] = None
+
+    @classmethod
+    def _fields_from(cls, message):
+        fields = {'address': _require_str(message, 'address')}
+        config = message.get('config')
+        if config is not None and not isinstance(config, dict):
+            raise InstructionError("invalid_field", "'config' must be an object")
+        fields['config'] = config
+        return fields
+
+    def device_info(self) -> Dict[str, Any]:
+        """
+        Pairing information in the form BluetoothAdapter.pair_device takes.
+        """
+        info = {'address': self.address}
+        if self.config is not None:
+            info['config'] = self.config
+        return info
+
+
+@_instruction
+class UnpairInstruction(AddressInstruction):
+    pass
+
+
+@_instruction
+class ReadInstruction(AddressInstruction):
+    pass
+
+
+@_instruction
+class ScanInstruction(Instruction):
+    pass
+
+
+@_instruction
+class SensorListInstruction(Instruction):
+    sensors: List[Dict[str, Any]] = dataclasses.field(default_factory=list)
+
+    @classmethod
+    def _fields_from(cls, message):
+        sensors = message.get('sensors')
+        if not isinstance(sensors, list):
+            raise InstructionError("invalid_field", "'sensors' must be a list")
+        for sensor in sensors:
+            if not isinstance(sensor, dict) or not isinstance(sensor.get('address'), str):
+                raise InstructionError("invalid_field", "every sensor needs an 'address'")
+        return {'sensors': sensors}
+
+
+@_instruction
+class GetHeartbeatInstruction(Instruction):
+    pass
+
+
+@_instruction
+class TimeSyncInstruction(Instruction):
+    """
+    Platform answer to a ClockSync request.
+    """
+    request_id: Any = None
+    t1: float = 0.0  # platform time at receipt of the request
+    t2: float = 0.0  # platform time at sending the answer
+
+    @classmethod
+    def _fields_from(cls, message):
+        fields = {'request_id': message.get('requestId')}
+        for field in ('t1', 't2'):
+            fields[field] = _number(message, field)
+            if fields[field] is None:
+                raise InstructionError("missing_field", f"'{field}' is required")
+        return fields
+
+
+@_instruction
+class TrustInstruction(Instruction):
+    """
+    Trust level update, also split off other instructions by the InstructionQueue.
+    """
+    pass
+
+
+INSTRUCTION_TYPES = {
+    'pair': PairInstruction,
+    'unpair': UnpairInstruction,
+    'read': ReadInstruction,
+    'scan': ScanInstruction,
+    'sensorlist': SensorListInstruction,
+    'getheartbeat': GetHeartbeatInstruction,
+    'timesync': TimeSyncInstruction,
+    'trust': TrustInstruction,
+}
+
+
+def _require_str(message: Dict[str, Any], field: str) -> str:
+    value = message.get(field)
+    if not isinstance(value, str) or not value:
+        raise InstructionError("missing_field", f"'{field}' is required")
+    return value
+
+
+def _number(message: Dict[str, Any], field: str) -> Optional[float]:
+    value = message.get(field)
+    if value is None:
+        return None
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        raise InstructionError("invalid_field", f"'{field}' must be a number")
+    return value
+
+
+def from_message(message: Any) -> Instruction:
+    """
+    Validate a decoded message and build the instruction for its type.
+
+    Raises:
+        InstructionError: If the message is not a valid instruction.
+    """
+    if not isinstance(message, dict):
+        raise InstructionError("not_object", "instruction is not a JSON object")
+    cls = INSTRUCTION_TYPES.get(message.get('type'))
+    if cls is None:
+        raise InstructionError("unknown_type", f"unknown instruction type {message.get('type')!r}")
+
+    create_technical = message.get('createTechnical')
+    return cls(
+        type=message['type'],
+        sender=message.get('from'),
+        message_id=message.get('messageId', message.get('id')),
+        atl=_number(message, 'atl'),
+        create_technical=create_technical is True,
+        deadline=_number(message, 'deadline'),
+        ttl=_number(message, 'ttl'),
+        **cls._fields_from(message)
+    )
+
+
+class InstructionParser:
+    """
+    Turns MQTT payloads into instructions for one gateway.
+    """
+    def __init__(self, mac_address: Optional[str] = None):
+        """
+        Initialize the parser.
+
+        Args:
+            mac_address (str, optional): This gateway's MAC address. Messages it sent itself are skipped.
+        """
+        self.mac_address = mac_address
+        self._self_prefixes = self_prefixes(mac_address) if mac_address else ()
+
+    def parse(self, payload: bytes) -> Optional[Instruction]:
+        """
+        Decode and validate an MQTT payload.
+
+        Args:
+            payload (bytes): Raw payload.
+
+        Returns:
+            Instruction | None: The instruction, None for messages from this gateway.
+
+        Raises:
+            InstructionError: If the payload is not a valid instruction.
+        """
+        # Own messages are recognised without parsing them
+        if self._self_prefixes and payload.startswith(self._self_prefixes):
+            return None
+        try:
+            message = loads(payload)
+        except ValueError:
+            raise InstructionError("invalid_json", "payload is not valid JSON")
+        if self.mac_address is not None and isinstance(message, dict) and message.get('from') == self.mac_address:
+            return None
+        return from_message(message)
@@ -4,18 +4,47 @@ Handles MQTT connection, publishing, subscribing, and message processing.
 """
 
 import asyncio
+import collections
 import datetime
 import json
 import time
 import paho.mqtt.client as mqtt
-from typing import Callable, Optional, Dict, Any, List
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.subscribeoptions import SubscribeOptions
+from typing import Callable, Optional, Dict, Any, List, Tuple, Deque
+
+import metrics
+from InflightWindow import InflightWindow
+from Instructions import InstructionError, InstructionParser
+from PayloadCodec import CONTENT_TYPE_JSON, PayloadCodec
+from logger import get_logger
+
+log = get_logger("mqtt")
+traffic_log = get_logger("mqtt.traffic")  # full payloads, one record per message
+
+PUBLISHED_MESSAGES = metrics.counter("gateway_mqtt_published_messages_total", "Messages handed to the MQTT client")
+PUBLISHED_BYTES = metrics.counter("gateway_mqtt_published_bytes_total", "Payload bytes handed to the MQTT client")
+PUBLISH_ACK_SECONDS = metrics.histogram("gateway_mqtt_publish_ack_seconds", "Time from publish to PUBACK/PUBCOMP")
+RECONNECTS = metrics.counter("gateway_mqtt_reconnects_total", "MQTT connections established after the first one")
+INSTRUCTIONS_RECEIVED = metrics.counter("gateway_instructions_received_total", "Instructions received over MQTT", ["type"])
+SELF_MESSAGES = metrics.counter("gateway_mqtt_self_messages_total", "Own messages echoed back by the broker and dropped")
+INSTRUCTIONS_REJECTED = metrics.counter("gateway_instructions_rejected_total", "Received messages that are not a valid instruction", ["reason"])
+
+# CONNACK reason codes for refused credentials: "Bad user name or password" and "Not authorized".
+# paho reports the MQTTv3.1.1 return codes 4 and 5 with the same codes.
+_AUTH_REJECTED = (134, 135)
+# CONNACK "Unsupported Protocol Version". paho reports the return code 1 of an MQTTv3.1.1 broker
+# answering an MQTTv5 CONNECT with the same code.
+_UNSUPPORTED_PROTOCOL = 132
 
 
 class MqttHandler:
     """
     Handles MQTT communication for the gateway.
     """
-    def __init__(self, queue: asyncio.Queue, mac_address: str, broker: str, port: int, keep_alive: int = 60):
+    def __init__(self, queue: asyncio.Queue, mac_address: str, broker: str, port: int, keep_alive: int = 60,
+                 protocol: int = mqtt.MQTTv311, max_inflight: int = 65535):
         """
         Initialize the MQTT handler.
         
@@ -24,25 +53,42 @@ class MqttHandler:
             broker (str): MQTT broker address.
             port (int): MQTT broker port.
             keep_alive (int, optional): Keep alive time in seconds. Defaults to 60.
+            protocol (int, optional): MQTT protocol version (mqtt.MQTTv311 or mqtt.MQTTv5).
+            max_inflight (int, optional): Upper bound for the adaptive in-flight window.
         """
         self.mac_address = mac_address
+        self._parser = InstructionParser(mac_address)  # Drops messages from this gateway before parsing
         self.broker = broker
         self.port = port
         self.keep_alive = keep_alive
+        self.protocol = protocol
         
         # This will be filled in when credentials are received
         self.username = None
         self.password = None
         self.connected = False
+        self.auth_rejected = False  # The broker refused the credentials on the last connection attempt
         self.first_connect = True
         self.client = None
 
+        self.reconnect_min_delay = 1
+        self.reconnect_max_delay = 120
+
         self.queue = queue  # Queue for handling messages
         self.auto_subscribe_on_connect = True
         
         # Callback for handling pairing instructions
         self.pairing_callback = None
 
+        # Flow control state. Only touched from the event loop thread; the paho
+        # network thread hands acknowledgements over with call_soon_threadsafe.
+        # Without a loop (handler used outside asyncio) messages go straight to paho.
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._flow = InflightWindow(max_window=max_inflight)
+        self._inflight: Dict[int, Tuple[str, str, Optional[asyncio.Future], Optional[Properties]]] = {}  # mid -> (topic, message, future, properties)
+        self._backlog: Deque[Tuple[str, str, Optional[asyncio.Future], Optional[Properties]]] = collections.deque()
+        self.payload_codec: Optional[PayloadCodec] = None
+
     def set_auto_subscribe_on_connect(self, enabled: bool):
         """
         Control whether the handler subscribes to its default topic immediately after connect.
@@ -62,6 +108,22 @@ class MqttHandler:
         """
         self.username = username
         self.password = password
+        # The client's own reconnects use the new credentials too
+        if self.client is not None:
+            self.client.username_pw_set(username, password)
+    
+    def set_reconnect_delay(self, min_delay: float, max_delay: float):
+        """
+        Set the delay bounds for the client's automatic reconnects.
+        
+        Args:
+            min_delay (float): First delay in seconds, doubled on every failed attempt.
+            max_delay (float): Longest delay in seconds.
+        """
+        self.reconnect_min_delay = min_delay
+        self.reconnect_max_delay = max_delay
+        if self.client is not None:
+            self.client.reconnect_delay_set(min_delay, max_delay)
     
     def set_pairing_callback(self, callback: Callable[[Dict[str, Any]], None]):
         """
@@ -80,30 +142,53 @@ class MqttHandler:
             bool: True if connection was successful, False otherwise.
         """
         if self.username is None or self.password is None:
-            print("Cannot connect to MQTT broker: credentials not set")
+            log.warning("Cannot connect to MQTT broker: credentials not set")
             return False
             
-        self.client = mqtt.Client()
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+
+        # Stop the previous client, otherwise its network thread keeps reconnecting in parallel
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+            self.connected = False
+
+        # Acks for messages sent on a previous client will never arrive, send them again
+        self._requeue_inflight()
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=self.protocol)
         self.client.username_pw_set(self.username, self.password)
+        # The handler's adaptive window decides what is in flight, paho should not queue on top of it
+        self.client.max_inflight_messages_set(0)
+        self.client.reconnect_delay_set(self.reconnect_min_delay, self.reconnect_max_delay)
         
         # Set up callbacks
         self.client.on_connect = self._on_connect
         self.client.on_disconnect = self._on_disconnect
         self.client.on_message = self._on_message
+        self.client.on_publish = self._on_publish
         
         try:
+            self.auth_rejected = False
+            protocol = self.protocol
             self.client.connect(self.broker, self.port, self.keep_alive)
             self.client.loop_start()
             
             # Wait for connection to establish (with timeout)
             start_time = time.time()
-            while not self.connected and time.time() - start_time < 10:
+            while not self.connected and not self.auth_rejected and self.protocol == protocol and time.time() - start_time < 10:
                 time.sleep(0.1)
-                
+
+            if not self.connected and self.protocol != protocol:
+                # The broker refused MQTTv5, connect again with MQTTv3.1.1
+                return self.connect()
             return self.connected
             
         except Exception as e:
-            print(f"Failed to connect to MQTT broker: {e}")
+            log.warning("Failed to connect to MQTT broker: %s", e)
             return False
     
     def disconnect(self):
@@ -114,38 +199,111 @@ class MqttHandler:
             self.client.loop_stop()
             self.client.disconnect()
             self.connected = False
+        self._fail_pending_acks()
+        self._flow.clear()
     
-    def publish(self, message: str, topic: str = None):
+    def publish(self, message: str, topic: str = None, wait_for_ack: bool = False, properties: Optional[Properties] = None):
         """
         Publish a message to the MQTT broker.
         
         Args:
             message (object): Message to publish.
             topic (str, optional): Topic to publish to. If None, uses the MAC address as topic.
+            wait_for_ack (bool, optional): If True, return an asyncio future instead of a bool.
+                The future resolves to True once the broker acknowledged the message
+                (PUBACK/PUBCOMP) and to False if it could not be delivered.
+                Must be called from the event loop thread.
+            properties (Properties, optional): MQTTv5 PUBLISH properties, e.g. Content Type.
+
+        Returns:
+            bool | asyncio.Future: True if the message was queued, or a delivery future.
         """
+        future = None
+        if wait_for_ack:
+            if self._loop is None:
+                self._loop = asyncio.get_running_loop()
+            future = self._loop.create_future()
+
         if not self.connected:
-            print("Cannot publish: not connected to MQTT broker")
-            return False
+            log.warning("Cannot publish: not connected to MQTT broker")
+            return self._publish_result(False, future)
             
         if topic is None:
             topic = self.mac_address
-            
-        result = self.client.publish(topic, message, qos=1)
+
+        if self._loop is not None and (self._backlog or not self._flow.has_capacity()):
+            # Window is full, sent as soon as acknowledgements free a slot
+            self._backlog.append((topic, message, future, properties))
+            return future if future is not None else True
+
+        return self._send(topic, message, future, properties)
+
+    def _send(self, topic: str, message: str, future: Optional[asyncio.Future], properties: Optional[Properties] = None):
+        result = self.client.publish(topic, message, qos=1, properties=properties)
         if result.rc != mqtt.MQTT_ERR_SUCCESS:
-            print(f"Failed to publish message: {result.rc}")
-            return False
-        else:
-            print(f"Published message to {topic}: {message}")
-            return True
+            log.warning("Failed to publish message: %s", result.rc)
+            return self._publish_result(False, future)
+
+        traffic_log.debug("Published message to %s: %s", topic, message)
+        PUBLISHED_MESSAGES.inc()
+        PUBLISHED_BYTES.inc(len(message))
+        if self._loop is not None:
+            # Registered before control returns to the loop, so the ack
+            # callback scheduled by the network thread always finds it.
+            self._flow.on_send(result.mid, time.monotonic())
+            self._inflight[result.mid] = (topic, message, future, properties)
+        return future if future is not None else True
+
+    async def publish_many(self, messages: List[str], topic: str = None, timeout: Optional[float] = None) -> List[bool]:
+        """
+        Publish several messages back to back and wait for all acknowledgements together.
+
+        Args:
+            messages (List[str]): Messages to publish.
+            topic (str, optional): Topic to publish to. If None, uses the MAC address as topic.
+            timeout (float, optional): Seconds to wait for the acknowledgements. None waits forever.
+
+        Returns:
+            List[bool]: Per message, True if it was acknowledged by the broker within the timeout.
+        """
+        futures = [self.publish(message, topic=topic, wait_for_ack=True) for message in messages]
+        if not futures:
+            return []
+
+        await asyncio.wait(futures, timeout=timeout)
+
+        delivered = []
+        for future in futures:
+            if future.done():
+                delivered.append(future.result())
+            else:
+                future.cancel()
+                delivered.append(False)
+        return delivered
     
-    def publish_data(self, device_mac: str, data: str, topic: str = None):
+    def set_payload_codec(self, codec: Optional[PayloadCodec]):
+        """
+        Set how measurements with raw sensor bytes are encoded. Compression needs MQTTv5,
+        the codec is announced in the Content Type property.
+        
+        Args:
+            codec (PayloadCodec, optional): The codec, None sends plain JSON.
+        """
+        self.payload_codec = codec
+
+    def publish_data(self, device_mac: str, data, topic: str = None, wait_for_ack: bool = False,
+                     sample_info: Optional[Dict[str, Any]] = None):
         """
         Format and publish data from a Bluetooth device.
         
         Args:
             device_mac (str): MAC address of the Bluetooth device.
-            data (Dict[str, Any]): Data to publish.
+            data (str | bytes): Data to publish, hex encoded or raw sensor bytes. Raw bytes may be
+                compressed, see set_payload_codec.
             topic (str, optional): Topic to publish to. If None, uses the default gateway topic.
+            wait_for_ack (bool, optional): Return a delivery future, see `publish`.
+            sample_info (Dict[str, Any], optional): Sample timestamps and sequence numbers, added to the
+                payload. Its 'timestamp' replaces the publishing time.
         """
         
         payload = {
@@ -154,11 +312,41 @@ class MqttHandler:
             'sensorMac': device_mac,
             'value': data,
             'externalUrl': "https://lh3.googleusercontent.com/pw/AP1GczM6vlQ4njxv2pGSQ56z_opnBVoi13LjdzpFJ5XoZeNNab-WhgWDo1C1OVsZ7u7HZSfW0bExeOFpXUY_r31nMjx8aS7WTJjZ89qUWMBUCTM4RvAkm05OrCl1S3zLmceTD1yso_5yRzaaVP6pHFyW1xfYkQ=w1024-h723-s-no-gm?authuser=0",
-            'timestamp': datetime.time().isoformat(),
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'),
             'type': 'measurement',
         }
+        if sample_info:
+            payload.update(sample_info)
+
+        if isinstance(data, (bytes, bytearray)):
+            if self.payload_codec is not None and self.protocol == mqtt.MQTTv5:
+                envelope = {key: value for key, value in payload.items() if key != 'value'}
+                message, content_type = self.payload_codec.encode(envelope, bytes(data))
+                return self.publish(message, topic=topic, wait_for_ack=wait_for_ack,
+                                    properties=self._content_type_properties(content_type))
+            payload['value'] = data.hex(',')
         
-        self.publish(json.dumps(payload), topic=topic)
+        return self.publish(json.dumps(payload), topic=topic, wait_for_ack=wait_for_ack,
+                            properties=self._content_type_properties(CONTENT_TYPE_JSON))
+
+    def _content_type_properties(self, content_type: str) -> Optional[Properties]:
+        # Content Type is an MQTTv5 property, MQTTv3.1.1 has nowhere to put it
+        if self.protocol != mqtt.MQTTv5:
+            return None
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.ContentType = content_type
+        return properties
+
+    def get_flow_metrics(self) -> Dict[str, Any]:
+        """
+        Get the state of the adaptive in-flight window.
+
+        Returns:
+            Dict[str, Any]: Window size, in-flight and backlog counts and ack RTT percentiles in seconds.
+        """
+        metrics = self._flow.snapshot()
+        metrics['backlog'] = len(self._backlog)
+        return metrics
     
     def subscribe(self, topic: str = None):
         """
@@ -168,25 +356,91 @@ class MqttHandler:
             topic (str, optional): Topic to subscribe to. If None, uses the MAC address + "/1234" as topic.
         """
         if not self.connected:
-            print("Cannot subscribe: not connected to MQTT broker")
+            log.warning("Cannot subscribe: not connected to MQTT broker")
             return False
             
         if topic is None:
             topic = f"{self.mac_address}" # topic is same as mac address
             
-        result = self.client.subscribe(topic)
+        if self.protocol == mqtt.MQTTv5:
+            # The gateway publishes on the topic it listens to, No Local stops the broker
+            # from sending every heartbeat and measurement straight back
+            result = self.client.subscribe(topic, options=SubscribeOptions(qos=0, noLocal=True))
+        else:
+            result = self.client.subscribe(topic)
         if result[0] != mqtt.MQTT_ERR_SUCCESS:
-            print(f"Failed to subscribe to {topic}: {result[0]}")
+            log.warning("Failed to subscribe to %s: %s", topic, result[0])
             return False
         else:
-            print(f"Subscribed to {topic}")
+            log.info("Subscribed to %s", topic)
             return True
     
+    def _publish_result(self, success: bool, future: Optional[asyncio.Future]):
+        if future is None:
+            return success
+        future.set_result(success)
+        return future
+
+    def _handle_ack(self, mid: int, acked_at: float, delivered: bool):
+        entry = self._inflight.pop(mid, None)
+        if entry is None:
+            return
+        rtt = self._flow.on_ack(mid, acked_at)
+        if rtt is not None:
+            PUBLISH_ACK_SECONDS.observe(rtt)
+
+        future = entry[2]
+        if future is not None and not future.done():
+            future.set_result(delivered)
+        self._drain_backlog()
+
+    def _handle_session_start(self, receive_maximum: Optional[int]):
+        self._flow.set_receive_maximum(receive_maximum)
+        self._drain_backlog()
+
+    def _drain_backlog(self):
+        while self._backlog and self.connected and self._flow.has_capacity():
+            topic, message, future, properties = self._backlog.popleft()
+            self._send(topic, message, future, properties)
+
+    def _requeue_inflight(self):
+        """
+        Put unacknowledged messages back at the front of the backlog, in their original order.
+        """
+        for entry in reversed(list(self._inflight.values())):
+            self._backlog.appendleft(entry)
+        self._inflight.clear()
+        self._flow.clear()
+
+    def _fail_pending_acks(self):
+        """
+        Resolve every outstanding delivery future as not delivered and drop unsent messages.
+        """
+        pending = [entry[2] for entry in self._inflight.values()] + [entry[2] for entry in self._backlog]
+        self._inflight.clear()
+        self._backlog.clear()
+
+        for future in pending:
+            if future is not None and not future.done():
+                future.get_loop().call_soon_threadsafe(self._settle_future, future, False)
+
+    @staticmethod
+    def _settle_future(future: asyncio.Future, result: bool):
+        if not future.done():
+            future.set_result(result)
+
     # Callback methods
-    def _on_connect(self, client, userdata, flags, rc):
+    def _on_connect(self, client, userdata, flags, rc, properties):
         if rc == 0:
-            print("Connected to MQTT broker successfully.")
+            log.info("Connected to MQTT broker successfully.")
             self.connected = True
+            self.auth_rejected = False
+
+            # MQTTv5 brokers advertise how many unacknowledged QoS>0 messages they accept
+            receive_maximum = getattr(properties, 'ReceiveMaximum', None)
+            loop = self._loop
+            if loop is not None and not loop.is_closed():
+                loop.call_soon_threadsafe(self._handle_session_start, receive_maximum)
             
             # Subscribe to the topic
             if self.auto_subscribe_on_connect:
@@ -197,46 +451,52 @@ class MqttHandler:
                 # Send connected message on first connect (debug purposes or request sensor list)
                 # self.publish("connected!")
                 self.first_connect = False
+            else:
+                RECONNECTS.inc()
                 
         else:
-            print(f"Failed to connect to MQTT broker, return code: {rc}")
             self.connected = False
+            self.auth_rejected = rc in _AUTH_REJECTED
+            if rc == _UNSUPPORTED_PROTOCOL and self.protocol == mqtt.MQTTv5:
+                log.warning("MQTT broker does not support MQTTv5, falling back to MQTTv3.1.1")
+                self.protocol = mqtt.MQTTv311
+                client.disconnect()  # its own reconnects would keep offering MQTTv5
+                return
+            log.warning("Failed to connect to MQTT broker, return code: %s", rc)
     
-    def _on_disconnect(self, client, userdata, rc):
+    def _on_disconnect(self, client, userdata, flags, rc, properties):
         if rc != 0:
-            print(f"Unexpected disconnection: {rc}")
+            log.warning("Unexpected disconnection: %s", rc)
         self.connected = False
     
+    def _on_publish(self, client, userdata, mid, rc, properties):
+        # Runs on the paho network thread once the broker acknowledged a QoS>0 message
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._handle_ack, mid, time.monotonic(), not rc.is_failure)
+    
     def _on_message(self, client, userdata, msg):
         """
         Handle incoming MQTT messages.
         """
         try:
-            message_str = msg.payload.decode()
-
-
-            # Try to parse message as JSON
             try:
-                message = json.loads(message_str)
+                instruction = self._parser.parse(msg.payload)
+            except InstructionError as e:
+                INSTRUCTIONS_REJECTED.labels(e.reason).inc()
+                log.warning("Rejected message on %s: %s", msg.topic, e)
+                return
 
-                if message['from'] == self.mac_address:
-                    # print(f"Message from self ({self.mac_address}), ignoring.")
-                    return
+            if instruction is None:
+                # Message from self, only seen without No Local (MQTT 3.1.1)
+                SELF_MESSAGES.inc()
+                return
 
-                print(f"Message received on {msg.topic}: {message_str}")
-                
-                # Handle pairing/unpairing instructions
-                if 'type' in message:
-                    # if message['type'] == 'pair' and self.pairing_callback is not None:
-                    #     self.pairing_callback(message)
-                    # elif message['type'] == 'unpair' and self.pairing_callback is not None:
-                    #     self.pairing_callback(message)
-                    # elif message['type'] == 'scan' and self.pairing_callback is not None:
-                    #     self.pairing_callback(message)
-
-                    self.queue.put_nowait(message)  # Put message in the queue for further processing
-            except json.JSONDecodeError:
-                print("Received message is not valid JSON")
+            traffic_log.debug("Message received on %s: %s", msg.topic, msg.payload)
+
+            INSTRUCTIONS_RECEIVED.labels(instruction.type).inc()
+            instruction.received_at = time.monotonic()  # for the queue wait time metric
+            self.queue.put_nowait(instruction)  # Put instruction in the queue for further processing
                 
         except Exception as e:
-            print(f"Error processing message: {e}")
+            log.error("Error processing message: %s", e)
@@ -0,0 +1,101 @@
+"""
+Measurement payload compression for the gateway application.
+Large measurements are sent as a binary frame: the JSON envelope deflated with a preset dictionary,
+followed by the sensor bytes deflated on their own instead of hex encoded.
+"""
+
+import json
+import struct
+import zlib
+from typing import Any, Dict, Tuple
+
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_DEFLATE = "application/vnd.gateway.measurement+deflate;v=1"
+
+FRAME_VERSION = 1  # First byte of a frame, JSON payloads start with '{'
+_HEADER = struct.Struct("!BI")  # version, length of the compressed envelope
+
+# Preset dictionary with the strings every measurement envelope repeats. deflate finds
+# matches from the end of the dictionary most cheaply, so the most common strings are last.
+ENVELOPE_DICTIONARY = (
+    b'"processed": {"samples": , "series": [], "windows": [{"min": , "max": , "mean": , "count": }], "alarmCount": 0, "alarms": []}'
+    b'"clockOffsetMs": null, "firstSampleAt": 17, "lastSampleAt": 17, '
+    b'"timestamp": "20T:00.000+00:00", "seq": 1, "count": , "bootId": "'
+    b'"externalUrl": "https://lh3.googleusercontent.com/pw/AP1GczM6vlQ4njxv2pGSQ56z_opnBVoi13LjdzpFJ5XoZeNNab-WhgWDo1C1OVsZ7u7HZSfW0bExeOFpXUY_r31nMjx8aS7WTJjZ89qUWMBUCTM4RvAkm05OrCl1S3zLmceTD1yso_5yRzaaVP6pHFyW1xfYkQ=w1024-h723-s-no-gm?authuser=0", '
+    b'"type": "measurement", '
+    b'{"from": "", "gatewayMac": "", "sensorMac": "'
+)
+
+
+class PayloadCodec:
+    """
+    Encodes measurements as JSON, or as a compressed frame once the sensor data is large enough.
+
+    Frame layout (all integers big endian):
+        1 byte   version (1)
+        4 bytes  length N of the compressed envelope
+        N bytes  envelope JSON without "value", raw deflate with ENVELOPE_DICTIONARY
+        rest     sensor bytes, raw deflate
+
+    The frame is announced with the MQTTv5 Content Type CONTENT_TYPE_DEFLATE, plain JSON
+    with CONTENT_TYPE_JSON. decode() turns a frame back into the JSON message, with "value"
+    in the usual comma separated hex form.
+    """
+    def __init__(self, enabled: bool = True, min_size: int = 1024, level: int = 6):
+        """
+        Initialize the codec.
+
+        Args:
+            enabled (bool, optional): Compress at all, False always produces JSON.
+            min_size (int, optional): Compress when the hex "value" would be at least this many bytes.
+                Below it the frame overhead and CPU time are not worth it.
+            level (int, optional): zlib compression level, 1 (fast) to 9 (small).
+        """
+        self.enabled = enabled
+        self.min_size = min_size
+        self.level = level
+
+    def should_compress(self, data: bytes) -> bool:
+        # Hex with separators takes three characters per byte
+        return self.enabled and len(data) * 3 >= self.min_size
+
+    def encode(self, envelope: Dict[str, Any], data: bytes) -> Tuple[bytes, str]:
+        """
+        Encode a measurement.
+
+        Args:
+            envelope (Dict[str, Any]): Message fields, without "value".
+            data (bytes): Raw sensor bytes.
+
+        Returns:
+            Tuple[bytes, str]: The payload and its Content Type.
+        """
+        if not self.should_compress(data):
+            message = dict(envelope, value=data.hex(','))
+            return json.dumps(message).encode(), CONTENT_TYPE_JSON
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=ENVELOPE_DICTIONARY)
+        compressed_envelope = compressor.compress(json.dumps(envelope).encode()) + compressor.flush()
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed_data = compressor.compress(data) + compressor.flush()
+        return _HEADER.pack(FRAME_VERSION, len(compressed_envelope)) + compressed_envelope + compressed_data, CONTENT_TYPE_DEFLATE
+
+
+def is_frame(payload: bytes) -> bool:
+    return len(payload) >= _HEADER.size and payload[0] == FRAME_VERSION
+
+
+def decode(payload: bytes) -> Dict[str, Any]:
+    """
+    Decode a measurement payload, plain JSON or a compressed frame.
+    """
+    if not is_frame(payload):
+        return json.loads(payload)
+
+    _, envelope_length = _HEADER.unpack_from(payload)
+    start = _HEADER.size
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=ENVELOPE_DICTIONARY)
+    envelope = json.loads(decompressor.decompress(payload[start:start + envelope_length]))
+    data = zlib.decompress(payload[start + envelope_length:], -zlib.MAX_WBITS)
+    envelope['value'] = data.hex(',')
+    return envelope
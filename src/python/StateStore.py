@@ -0,0 +1,112 @@
+"""
+Persistent state for the gateway application.
+Keeps a JSON snapshot of credentials, paired sensors and trust levels so a restart can resume where it stopped.
+"""
+
+import json
+import os
+import tempfile
+from typing import Any, Dict, Optional
+
+from logger import get_logger
+
+log = get_logger("state")
+
+SNAPSHOT_VERSION = 1
+
+
+class StateStore:
+    """
+    Snapshot file that is replaced atomically: the new state is written to a temporary
+    file in the same directory, flushed to disk and renamed over the old one, so a power
+    loss leaves either the previous or the new snapshot, never a partial one.
+
+    The file holds the MQTT credentials, so it is created readable by the owner only.
+    """
+    def __init__(self, path: str):
+        """
+        Initialize the store.
+
+        Args:
+            path (str): Snapshot file path.
+        """
+        self.path = os.path.abspath(path)
+        self._last_saved: Optional[Dict[str, Any]] = None
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """
+        Read the snapshot.
+
+        Returns:
+            Dict[str, Any] | None: The saved state, None if there is no usable snapshot.
+        """
+        try:
+            with open(self.path, 'r') as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring unreadable state snapshot %s: %s", self.path, e)
+            return None
+
+        if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+            log.warning("Ignoring state snapshot %s with unsupported version", self.path)
+            return None
+
+        self._last_saved = snapshot
+        return snapshot
+
+    def save(self, snapshot: Dict[str, Any]) -> bool:
+        """
+        Write the snapshot if it differs from the last one written.
+
+        Args:
+            snapshot (Dict[str, Any]): JSON-serialisable state.
+
+        Returns:
+            bool: True if the file was written.
+        """
+        snapshot = dict(snapshot, version=SNAPSHOT_VERSION)
+        if snapshot == self._last_saved:
+            return False
+
+        directory = os.path.dirname(self.path)
+        fd, temp_path = tempfile.mkstemp(prefix=".state-", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(snapshot, file, indent=2)
+                file.flush()
+                os.fsync(file.fileno())
+            os.chmod(temp_path, 0o600)
+            os.replace(temp_path, self.path)
+        except (OSError, TypeError, ValueError) as e:
+            log.error("Failed to save state snapshot %s: %s", self.path, e)
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            return False
+
+        # Make the rename itself durable
+        try:
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+
+        self._last_saved = snapshot
+        log.debug("Saved state snapshot to %s", self.path)
+        return True
+
+    def clear(self):
+        """
+        Remove the snapshot, e.g. after the gateway was wiped from the server.
+        """
+        self._last_saved = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,248 @@
+"""
+TCB verification service client for the gateway application.
+Collects the device verifications requested close together and sends them to the TCB as one batch request.
+"""
+
+import asyncio
+import hmac
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+from logger import get_logger
+
+log = get_logger("tcb")
+
+TCB_REQUEST_SECONDS = metrics.histogram("gateway_tcb_request_seconds", "TCB service request latency", ["endpoint"])
+TCB_BATCH_DEVICES = metrics.histogram("gateway_tcb_batch_devices", "Devices per batch verification request",
+                                      buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+TCB_VERIFICATIONS = metrics.counter("gateway_tcb_verifications_total", "Device verifications by result", ["result"])
+
+
+class TcbError(Exception):
+    """
+    Raised when the TCB service did not sign a nonce, for a whole batch or for one device.
+    `status` is the HTTP status of the answer, None if there was none.
+    """
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class TcbRefused(TcbError):
+    """
+    Raised when the TCB answered but would not sign for a device, e.g. an unknown UID.
+    Unlike other TcbErrors, asking again does not help.
+    """
+
+
+class TcbClient:
+    """
+    Batching client of the TCB verification service (see mock_lowend_tcb.py).
+
+    sign_nonce() queues the device and waits for its signed nonce. The first device queued
+    starts a batch, which is sent batch_delay seconds later, or as soon as batch_size devices
+    are waiting, as one POST to /lowenddevice_verification_batch. Verifying N devices that
+    are onboarded or re-attested together so costs one round trip instead of N, and batches
+    that are still in flight do not hold up the next one.
+
+    Requests run in the default executor on keep-alive connections, the event loop never
+    waits on the service. A TCB without the batch endpoint (404) is asked one device at a time.
+    """
+    def __init__(self, base_url: str, batch_size: int = 100, batch_delay: float = 0.05, timeout: float = 10.0):
+        """
+        Initialize the client.
+
+        Args:
+            base_url (str): URL of the TCB service, e.g. "http://192.168.1.152:8000".
+            batch_size (int, optional): Most devices per batch request.
+            batch_delay (float, optional): Seconds the first device of a batch waits for others.
+            timeout (float, optional): Seconds a request to the service may take.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.batch_size = max(1, batch_size)
+        self.batch_delay = batch_delay
+        self.timeout = timeout
+        self.batch_supported = True
+
+        self._pending: List[Tuple[str, str, asyncio.Future]] = []  # (uid, nonce, future) of the next batch
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()  # batches in flight
+        self._local = threading.local()  # one requests.Session per executor thread
+
+    @staticmethod
+    def new_nonce() -> str:
+        return os.urandom(16).hex()
+
+    async def sign_nonce(self, uid: str, nonce: str) -> str:
+        """
+        Nonce signed by the TCB with the key of the device.
+
+        Args:
+            uid (str): UID of the low-end device.
+            nonce (str): Hex nonce.
+
+        Raises:
+            TcbRefused: If the service refused the device.
+            TcbError: If the service could not be reached.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((uid, nonce, future))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_delay, self._flush)
+        return await future
+
+    async def verify(self, uid: str, nonce: str, signature: str) -> bool:
+        """
+        Check the signature a device returned for a nonce against the one of the TCB.
+        Verifications of several devices awaited together share one batch request.
+
+        Raises:
+            TcbRefused: If the service refused the device.
+            TcbError: If the service could not be reached.
+        """
+        expected = await self.sign_nonce(uid, nonce)
+        valid = hmac.compare_digest(expected.lower(), signature.lower())
+        TCB_VERIFICATIONS.labels('valid' if valid else 'invalid').inc()
+        return valid
+
+    async def sign_nonces(self, devices: Dict[str, str]) -> Dict[str, str]:
+        """
+        Signed nonces of many devices, as UID -> nonce. Devices the TCB refused are left out.
+
+        Raises:
+            TcbError: If the service could not be reached.
+        """
+        uids = list(devices)
+        results = await asyncio.gather(*(self.sign_nonce(uid, devices[uid]) for uid in uids), return_exceptions=True)
+        signed = {}
+        for uid, result in zip(uids, results):
+            if isinstance(result, TcbRefused):
+                log.warning("TCB did not sign the nonce of %s: %s", uid, result)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                signed[uid] = result
+        return signed
+
+    async def conformity_certificate(self, uid: str) -> Dict:
+        """
+        Conformity certificate of a device, decoded from the hex JSON the TCB returns.
+
+        Raises:
+            TcbError: If the service refused the device or could not be reached.
+        """
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, self._post, "cc", "/lowenddevice_cc", {'uid': uid})
+        try:
+            return json.loads(bytes.fromhex(response['conformity_certificate']))
+        except (KeyError, TypeError, ValueError) as e:
+            raise TcbError(f"Invalid conformity certificate for {uid}: {e}") from e
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self._pending:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            task = asyncio.get_running_loop().create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[str, str, asyncio.Future]]):
+        loop = asyncio.get_running_loop()
+        devices = [{'uid': uid, 'nonce': nonce} for uid, nonce, _ in batch]
+        try:
+            if self.batch_supported:
+                results = await loop.run_in_executor(None, self._post_batch, devices)
+            else:
+                results = await asyncio.gather(*(loop.run_in_executor(None, self._post_single, device) for device in devices))
+        except Exception as e:
+            TCB_VERIFICATIONS.labels('failed').inc(len(batch))
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(TcbError(f"TCB request failed: {e}", getattr(e, 'status', None)))
+            return
+
+        for (uid, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            # Checked per device, a malformed entry fails only its own device
+            if not isinstance(result, dict) or result.get('uid', uid) != uid:
+                signed_nonce = error = None
+            else:
+                signed_nonce, error = result.get('signednonce'), result.get('error')
+            if isinstance(signed_nonce, str):
+                future.set_result(signed_nonce)
+            elif signed_nonce is None and isinstance(error, str):
+                TCB_VERIFICATIONS.labels('refused').inc()
+                future.set_exception(TcbRefused(error, 400))
+            else:
+                TCB_VERIFICATIONS.labels('failed').inc()
+                future.set_exception(TcbError(f"Malformed TCB result for {uid}: {str(result)[:100]}"))
+
+    def _post_batch(self, devices: List[Dict]) -> List[Dict]:
+        """
+        One batch request, in an executor thread. Falls back to single requests on a TCB without batches.
+        """
+        TCB_BATCH_DEVICES.observe(len(devices))
+        try:
+            results = self._post("verification_batch", "/lowenddevice_verification_batch", devices)['results']
+        except TcbError as e:
+            if e.status != 404:
+                raise
+            if self.batch_supported:
+                log.warning("TCB has no batch endpoint, verifying devices one at a time")
+                self.batch_supported = False
+            return [self._post_single(device) for device in devices]
+        if not isinstance(results, list):
+            raise TcbError(f"Batch answered with {type(results).__name__} results instead of a list")
+        if len(results) != len(devices):
+            raise TcbError(f"Batch of {len(devices)} devices answered with {len(results)} results")
+        return results
+
+    def _post_single(self, device: Dict) -> Dict:
+        try:
+            return self._post("verification", "/lowenddevice_verification", device)
+        except TcbError as e:
+            # A refused device is that device's result, not a failure of the others
+            if e.status == 400:
+                return {'uid': device['uid'], 'error': str(e)}
+            raise
+
+    def _post(self, endpoint: str, path: str, body) -> Dict:
+        """
+        Blocking POST to the TCB, timed per endpoint.
+
+        Raises:
+            TcbError: If the service could not be reached, or did not answer 200 with JSON.
+        """
+        import requests  # Imported on first use, in the executor thread instead of at start-up
+
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+
+        start_time = time.monotonic()
+        try:
+            response = session.post(self.base_url + path, json=body, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise TcbError(str(e)) from e
+        finally:
+            TCB_REQUEST_SECONDS.labels(endpoint).observe(time.monotonic() - start_time)
+
+        if response.status_code != 200:
+            try:
+                message = response.json().get('error', response.text)
+            except ValueError:
+                message = response.text
+            raise TcbError(f"{response.status_code} - {message}", response.status_code)
+        try:
+            return response.json()
+        except ValueError as e:
+            raise TcbError(f"Invalid answer from {path}: {e}") from e
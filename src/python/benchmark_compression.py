@@ -0,0 +1,110 @@
+"""
+CPU cost against bytes saved of measurement compression (PayloadCodec).
+Run it on the gateway hardware (e.g. a Raspberry Pi), the numbers differ a lot between ARM and x86.
+
+Example:
+    python3 benchmark_compression.py --samples 50 500 5000 --levels 1 6 9
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import struct
+import time
+from typing import Callable, Dict, List
+
+import PayloadCodec
+from PayloadCodec import PayloadCodec as Codec
+
+ENVELOPE = {
+    'from': "B827EBB63381",
+    'gatewayMac': "B827EBB63381",
+    'sensorMac': "AA:BB:CC:DD:EE:FF",
+    'externalUrl': "https://lh3.googleusercontent.com/pw/AP1GczM6vlQ4njxv2pGSQ56z_opnBVoi13LjdzpFJ5XoZeNNab-WhgWDo1C1OVsZ7u7HZSfW0bExeOFpXUY_r31nMjx8aS7WTJjZ89qUWMBUCTM4RvAkm05OrCl1S3zLmceTD1yso_5yRzaaVP6pHFyW1xfYkQ=w1024-h723-s-no-gm?authuser=0",
+    'timestamp': "2026-01-01T12:00:00.000+00:00",
+    'type': 'measurement',
+    'seq': 1,
+    'count': 0,
+    'bootId': "3f0c1d2e4b5a69788796a5b4c3d2e1f0",
+    'clockOffsetMs': 12.5,
+    'firstSampleAt': 1767268800000,
+    'lastSampleAt': 1767268801000,
+}
+
+
+def signal_data(samples: int) -> bytes:
+    # Slow int16 waveform with a little noise, like an ECG or accelerometer channel
+    values = [int(800 * math.sin(index / 25) + (index * 7919) % 13) for index in range(samples)]
+    return struct.pack(f"<{samples}h", *values)
+
+
+def counter_data(samples: int) -> bytes:
+    # 20-byte notifications of a timestamp and a repeated sequence byte, like the simulated sensors
+    frames = []
+    for index in range(samples // 10 or 1):
+        frames.append(struct.pack("!d", 1000.0 + index * 0.02) + bytes([index % 256]) * 12)
+    return b"".join(frames)
+
+
+def random_data(samples: int) -> bytes:
+    return os.urandom(samples * 2)
+
+
+GENERATORS: Dict[str, Callable[[int], bytes]] = {
+    'signal': signal_data,
+    'counter': counter_data,
+    'random': random_data,
+}
+
+
+def measure(codec: Codec, data: bytes, min_time: float) -> Dict[str, float]:
+    envelope = dict(ENVELOPE, count=len(data))
+    plain = json.dumps(dict(envelope, value=data.hex(','))).encode()
+
+    iterations = 0
+    start = time.process_time()
+    while True:
+        payload, _ = codec.encode(envelope, data)
+        iterations += 1
+        elapsed = time.process_time() - start
+        if elapsed >= min_time:
+            break
+
+    assert PayloadCodec.decode(payload)['value'] == data.hex(',')
+    return {
+        'raw_bytes': len(data),
+        'json_bytes': len(plain),
+        'compressed_bytes': len(payload),
+        'ratio': round(len(plain) / len(payload), 2),
+        'encode_us': round(elapsed / iterations * 1e6, 1),
+        'cpu_us_per_kb_saved': round(elapsed / iterations * 1e6 / max(1e-9, (len(plain) - len(payload)) / 1024), 2),
+    }
+
+
+def main(arguments):
+    results: List[Dict] = []
+    for name in arguments.data:
+        for samples in arguments.samples:
+            data = GENERATORS[name](samples)
+            for level in arguments.levels:
+                result = measure(Codec(True, 0, level), data, arguments.min_time)
+                result.update({'data': name, 'samples': samples, 'level': level})
+                results.append(result)
+                print(f"{name:8} {samples:6} samples  level {level}  {result['json_bytes']:8} -> {result['compressed_bytes']:7} bytes"
+                      f"  x{result['ratio']:<6} {result['encode_us']:9} us/message  {result['cpu_us_per_kb_saved']:7} us/KB saved")
+
+    if arguments.json_path:
+        with open(arguments.json_path, "w") as file:
+            json.dump({'machine': platform.machine(), 'python': platform.python_version(), 'results': results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure compression ratio and CPU time of measurement payloads.")
+    parser.add_argument("--data", nargs="+", default=list(GENERATORS), choices=list(GENERATORS), help="Kinds of sensor data.")
+    parser.add_argument("--samples", nargs="+", type=int, default=[50, 500, 5000], help="Samples per measurement.")
+    parser.add_argument("--levels", nargs="+", type=int, default=[1, 6, 9], help="zlib compression levels.")
+    parser.add_argument("--min-time", type=float, default=0.5, help="CPU seconds per measurement point.")
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write the results to this file.")
+    main(parser.parse_args())
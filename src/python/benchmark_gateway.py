@@ -0,0 +1,297 @@
+"""
+End-to-end gateway benchmark with a simulated broker and simulated BLE sensors.
+Drives Gateway, MqttHandler and BluetoothAdapter with a configurable sensor fleet and instruction mix,
+and reports instruction latency, measurement latency, message throughput, CPU and RSS.
+
+Example:
+    python3 benchmark_gateway.py --sensors 20 --rate 50 --duration 60 --mix read=6,sensorlist=2,pair=2 --link-drop-rate 0.01
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import resource
+import struct
+import threading
+import time
+from typing import Dict, List
+
+import config
+from logger import setup_logging
+from mock_broker import MockBroker
+import PayloadCodec
+from BleBackend import FakeBleBackend
+
+
+def percentiles(values: List[float], scale: float = 1000.0) -> Dict[str, float]:
+    """
+    p50/p90/p99/max of a list of seconds, in milliseconds by default.
+    """
+    if not values:
+        return {}
+    ordered = sorted(values)
+    last = len(ordered) - 1
+    result = {f"p{p}": round(ordered[min(last, int(round(p / 100 * last)))] * scale, 2) for p in (50, 90, 99)}
+    result["max"] = round(ordered[-1] * scale, 2)
+    return result
+
+
+def current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return round(pages * resource.getpagesize() / 1024 / 1024, 1)
+    except OSError:
+        return 0.0
+
+
+def process_cpu_seconds(pid: int) -> float:
+    """
+    User plus system CPU time of another process, 0 if it is gone.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+
+def fake_backend(options: Dict, sensors: int) -> FakeBleBackend:
+    """
+    Simulated sensors, also used inside BLE ingestion worker processes.
+    """
+    backend = FakeBleBackend(**options)
+    backend.add_devices(sensors)
+    return backend
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+class MeasurementObserver:
+    """
+    Collects what the gateway publishes, on the broker thread.
+    """
+    def __init__(self, gateway_mac: str, payload_size: int):
+        self.gateway_mac = gateway_mac
+        self.payload_size = payload_size
+        self.messages = 0
+        self.bytes = 0
+        self.newest_latencies: List[float] = []
+        self.oldest_latencies: List[float] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, topic: str, payload: bytes, client_id: str, received_at: float):
+        with self._lock:
+            self.messages += 1
+            self.bytes += len(payload)
+        try:
+            message = PayloadCodec.decode(payload)
+        except ValueError:
+            return
+        if message.get('type') != 'measurement' or not message.get('value'):
+            return
+
+        raw = bytes.fromhex(message['value'].replace(',', ''))
+        if len(raw) < self.payload_size:
+            return
+        oldest, = struct.unpack_from("!d", raw, 0)
+        newest, = struct.unpack_from("!d", raw, (len(raw) // self.payload_size - 1) * self.payload_size)
+        with self._lock:
+            self.oldest_latencies.append(received_at - oldest)
+            self.newest_latencies.append(received_at - newest)
+
+
+async def run_benchmark(arguments) -> Dict:
+    broker = MockBroker(receive_maximum=arguments.receive_maximum, ack_delay=arguments.ack_delay)
+    port = broker.start()
+
+    # Point the gateway at the simulated environment before it is constructed
+    config.MQTT_BROKER = broker.host
+    config.MQTT_PORT = port
+    config.MQTT_PROTOCOL_VERSION = arguments.protocol
+    config.BLE_MEASUREMENT_DURATION = arguments.measurement_duration
+    config.BLE_SCAN_TIMEOUT = arguments.scan_timeout
+    config.STATE_PERSISTENCE = False
+    config.MQTT_COMPRESSION = arguments.compression
+    config.BLE_INGEST_WORKERS = arguments.ingest_workers
+    if arguments.processing:
+        config.SENSOR_PROCESSING = {'default': json.loads(arguments.processing)}
+    import main
+
+    gateway = main.Gateway()
+    observer = MeasurementObserver(gateway.mac_address, arguments.payload)
+    broker.add_observer(observer)
+
+    backend_options = {'rate': arguments.rate, 'payload_size': arguments.payload, 'connect_latency': arguments.connect_latency,
+                       'link_drop_rate': arguments.link_drop_rate, 'gatt_error_rate': arguments.gatt_error_rate, 'seed': arguments.seed}
+    backend = fake_backend(backend_options, arguments.sensors)
+    devices = list(backend.devices.values())
+    if arguments.ingest_workers:
+        gateway.ble_adapter.pool.backend_factory = functools.partial(fake_backend, backend_options, arguments.sensors)
+        await gateway.ble_adapter.start()
+    else:
+        gateway.ble_adapter.backend = backend
+
+    pairing_start = time.monotonic()
+    await asyncio.gather(*(gateway.ble_adapter.pair_device({'address': device.address}) for device in devices))
+    pairing_time = time.monotonic() - pairing_start
+
+    # Instruction latency: from injection at the broker until handle_instruction returns
+    injected: Dict[int, float] = {}
+    completed: Dict[int, float] = {}
+    handle_instruction = gateway.handle_instruction
+
+    async def timed_handle_instruction(instruction):
+        try:
+            await handle_instruction(instruction)
+        finally:
+            bench_id = instruction.message_id
+            if bench_id in injected:
+                completed[bench_id] = time.monotonic()
+
+    gateway.handle_instruction = timed_handle_instruction
+
+    if not await gateway.connect_mqtt():
+        broker.stop()
+        raise RuntimeError("Gateway could not connect to the mock broker")
+    gateway.state = main.GatewayState.CONNECTED
+    gateway.isFirstBoot = False
+
+    worker_pids = [process.pid for process in getattr(getattr(gateway.ble_adapter, 'pool', None), '_processes', [])]
+    workers_cpu_start = sum(process_cpu_seconds(pid) for pid in worker_pids)
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    wall_start = time.monotonic()
+    gateway_task = asyncio.create_task(gateway.run())
+
+    weights = parse_mix(arguments.mix)
+    types, type_weights = list(weights), list(weights.values())
+    addresses = [device.address for device in devices]
+    bench_id = 0
+    interval = 1.0 / arguments.instruction_rate
+    next_time = time.monotonic()
+    while time.monotonic() - wall_start < arguments.duration:
+        instruction_type = random.choices(types, type_weights)[0]
+        instruction = {'from': 'benchmark', 'type': instruction_type, 'messageId': bench_id}
+        if instruction_type in ('read', 'pair', 'unpair'):
+            instruction['address'] = random.choice(addresses)
+        elif instruction_type == 'sensorlist':
+            instruction['sensors'] = [{'address': address} for address in addresses]
+
+        injected[bench_id] = time.monotonic()
+        broker.publish(gateway.mac_address, json.dumps(instruction))
+        bench_id += 1
+
+        next_time += interval
+        await asyncio.sleep(max(0.0, next_time - time.monotonic()))
+
+    # Let queued instructions finish
+    drain_deadline = time.monotonic() + arguments.drain
+    while len(completed) + sum(main.queue.stats.values()) < len(injected) and time.monotonic() < drain_deadline:
+        await asyncio.sleep(0.1)
+
+    wall = time.monotonic() - wall_start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    workers_cpu = sum(process_cpu_seconds(pid) for pid in worker_pids) - workers_cpu_start
+    rss_mb = current_rss_mb()
+    ble_stats = await gateway.ble_adapter.pool.backend_stats() if arguments.ingest_workers else backend.stats
+
+    gateway.running = False
+    gateway_task.cancel()
+    for address in list(gateway.ble_adapter.connected_devices):
+        await gateway.ble_adapter.disconnect_device(address)
+    gateway.stop()
+    broker.stop()
+
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    notifications = ble_stats['notifications']
+    latencies = [completed[i] - injected[i] for i in completed]
+    return {
+        'setup': {
+            'sensors': arguments.sensors,
+            'notification_rate_hz': arguments.rate,
+            'payload_bytes': arguments.payload,
+            'instruction_rate_hz': arguments.instruction_rate,
+            'mix': weights,
+            'measurement_duration_s': arguments.measurement_duration,
+            'mqtt_protocol': config.MQTT_PROTOCOL_VERSION,
+            'ingest_workers': arguments.ingest_workers,
+        },
+        'wall_s': round(wall, 2),
+        'instructions': {
+            'sent': len(injected),
+            'handled': len(completed),
+            'dropped': dict(main.queue.stats),
+            'latency_ms': percentiles(latencies),
+        },
+        'measurements': {
+            'published': len(observer.newest_latencies),
+            'newest_sample_latency_ms': percentiles(observer.newest_latencies),
+            'oldest_sample_latency_ms': percentiles(observer.oldest_latencies),
+        },
+        'mqtt': {
+            'messages': observer.messages,
+            'messages_per_s': round(observer.messages / wall, 2),
+            'bytes_per_s': round(observer.bytes / wall, 1),
+            'flow': gateway.mqtt_handler.get_flow_metrics(),
+        },
+        'ble': {
+            'initial_pairing_s': round(pairing_time, 2),
+            'notifications': notifications,
+            'notifications_per_s': round(notifications / wall, 1),
+            'connects': ble_stats['connects'],
+            'link_drops': ble_stats['link_drops'],
+            'gatt_errors': ble_stats['gatt_errors'],
+        },
+        'process': {
+            'cpu_s': round(cpu, 2),
+            'cpu_percent': round(100 * cpu / wall, 1),
+            'rss_mb': rss_mb,
+            'max_rss_mb': round(usage_end.ru_maxrss / 1024, 1),
+            'ingest_workers': arguments.ingest_workers,
+            'workers_cpu_s': round(workers_cpu, 2),
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the gateway against a simulated broker and simulated BLE sensors.")
+    parser.add_argument("--sensors", type=int, default=10, help="Number of simulated sensors.")
+    parser.add_argument("--rate", type=float, default=20.0, help="Notifications per second per sensor while notifying.")
+    parser.add_argument("--payload", type=int, default=20, help="Notification payload size in bytes (at least 8).")
+    parser.add_argument("--instruction-rate", type=float, default=1.0, help="Instructions per second sent by the simulated platform.")
+    parser.add_argument("--mix", default="read=6,sensorlist=2,pair=2", help="Instruction mix as type=weight pairs.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to send instructions.")
+    parser.add_argument("--drain", type=float, default=60.0, help="Seconds to wait for queued instructions afterwards.")
+    parser.add_argument("--measurement-duration", type=float, default=1.0, help="Overrides config.BLE_MEASUREMENT_DURATION.")
+    parser.add_argument("--scan-timeout", type=float, default=2.0, help="Overrides config.BLE_SCAN_TIMEOUT.")
+    parser.add_argument("--connect-latency", type=float, default=0.5, help="Seconds a simulated BLE connect takes.")
+    parser.add_argument("--link-drop-rate", type=float, default=0.0, help="Expected link drops per second per notifying sensor.")
+    parser.add_argument("--gatt-error-rate", type=float, default=0.0, help="Probability that a simulated GATT operation fails.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the simulated sensors and the instruction mix.")
+    parser.add_argument("--processing", default=None, help="Edge processing profile for all sensors as JSON, e.g. '{\"decimate\": 10, \"window\": 50}'.")
+    parser.add_argument("--compression", action="store_true", help="Compress large measurements (config.MQTT_COMPRESSION).")
+    parser.add_argument("--ingest-workers", type=int, default=0, help="BLE ingestion worker processes (config.BLE_INGEST_WORKERS).")
+    parser.add_argument("--protocol", type=int, choices=(4, 5), default=config.MQTT_PROTOCOL_VERSION,
+                        help="MQTT protocol level, 5 for Receive Maximum and compression.")
+    parser.add_argument("--receive-maximum", type=int, default=None, help="Receive Maximum advertised by the broker.")
+    parser.add_argument("--ack-delay", type=float, default=0.0, help="Seconds the broker delays every PUBACK.")
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write the results to this file.")
+    arguments = parser.parse_args()
+
+    setup_logging(level="WARNING")
+    random.seed(arguments.seed)
+    results = asyncio.run(run_benchmark(arguments))
+    print(json.dumps(results, indent=2))
+    if arguments.json_path:
+        with open(arguments.json_path, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,126 @@
+"""
+Start-up benchmark of the gateway entry points: how long importing them takes, and which imports cost the most.
+Every run imports the module in a fresh interpreter with `python -X importtime`, so nothing is cached in memory.
+A temporary copy of the tree is byte-compiled first, like an installed gateway, so source compilation is not counted
+and the checkout gets no __pycache__ directories.
+
+Example:
+    python3 benchmark_imports.py
+    python3 benchmark_imports.py --modules main --repeat 20 --top 15
+    python3 benchmark_imports.py --modules onlyRegisterGateway onlyWipeGateway --budget-ms 60
+"""
+
+import argparse
+import compileall
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from benchmark_gateway import percentiles
+
+ENTRY_POINTS = ("main", "onlyRegisterGateway", "onlyWipeGateway")
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, float, float]]:
+    """
+    Lines of `-X importtime` as (module, depth, self seconds, cumulative seconds), in import order.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        if not self_us.strip().isdigit():  # the header line
+            continue
+        module = name.strip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((module, depth, int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return imports
+
+
+def import_once(module: str, directory: str) -> Tuple[float, List[Tuple[str, int, float, float]]]:
+    """
+    Import a module in a new interpreter.
+
+    Returns:
+        Tuple[float, List]: Wall time of the whole process in seconds, and its parsed import times.
+    """
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             cwd=directory, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{process.stderr.strip().splitlines()[-1]}")
+    return wall, parse_importtime(process.stderr)
+
+
+def measure(module: str, directory: str, repeat: int, top: int) -> Dict:
+    totals: List[float] = []
+    walls: List[float] = []
+    cumulative: Dict[str, List[float]] = {}
+    own: Dict[str, List[float]] = {}
+    for _ in range(repeat):
+        wall, imports = import_once(module, directory)
+        walls.append(wall)
+        below = []
+        for name, depth, self_seconds, cumulative_seconds in imports:
+            # A module is listed after its own imports. Only those below the entry point
+            # count, not the ones of site.py at interpreter start.
+            if depth > 0:
+                below.append((name, self_seconds, cumulative_seconds))
+                continue
+            if name == module:
+                totals.append(cumulative_seconds)
+                for child, self_child, cumulative_child in below:
+                    cumulative.setdefault(child, []).append(cumulative_child)
+                    own.setdefault(child, []).append(self_child)
+            below = []
+
+    def median(values: List[float]) -> float:
+        return sorted(values)[len(values) // 2]
+
+    slowest = sorted(cumulative, key=lambda name: median(cumulative[name]), reverse=True)[:top]
+    return {
+        'import_ms': percentiles(totals),
+        'process_ms': percentiles(walls),
+        'modules_imported': len(cumulative),
+        'slowest': [{'module': name,
+                     'cumulative_ms': round(median(cumulative[name]) * 1000, 2),
+                     'self_ms': round(median(own[name]) * 1000, 2)} for name in slowest],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time importing the gateway entry points in fresh interpreters.")
+    parser.add_argument("--modules", nargs="+", default=list(ENTRY_POINTS), help="Modules to import.")
+    parser.add_argument("--repeat", type=int, default=10, help="Fresh interpreters per module.")
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to list per module.")
+    parser.add_argument("--budget-ms", type=float, default=None, help="Exit with status 1 if a median import takes longer.")
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write the results to this file.")
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="gateway-imports-") as scratch:
+        directory = os.path.join(scratch, "python")
+        shutil.copytree(os.path.dirname(os.path.abspath(__file__)), directory,
+                        ignore=shutil.ignore_patterns("__pycache__", "tests", "*.pyc"))
+        compileall.compile_dir(directory, quiet=1)
+        results = {
+            'python': sys.version.split()[0],
+            'repeat': arguments.repeat,
+            'modules': {module: measure(module, directory, arguments.repeat, arguments.top) for module in arguments.modules},
+        }
+    print(json.dumps(results, indent=2))
+    if arguments.json_path:
+        with open(arguments.json_path, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if arguments.budget_ms is not None:
+        over = [module for module, result in results['modules'].items() if result['import_ms']['p50'] > arguments.budget_ms]
+        if over:
+            print(f"Over the {arguments.budget_ms} ms budget: {', '.join(over)}", file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,299 @@
+"""
+Load generator for fleet onboarding, to size the onboarding server before a manufacturing batch.
+Simulates N gateways with distinct MAC addresses, each doing register -> getCredentials -> MQTT connect -> wipe,
+the requests of run_manufacturer_onboarding.sh (onlyRegisterGateway.py, onlyWipeGateway.py) and of the gateway itself.
+By default it runs against a local MockOnboardingServer and MockBroker, --server and --broker point it elsewhere.
+
+Example:
+    python3 benchmark_onboarding.py --gateways 500 --concurrency 100 --server-latency 0.02 --server-concurrency 16
+    python3 benchmark_onboarding.py --gateways 50 --server http://192.168.1.152:3010 --broker 34.240.4.8:1885
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import config
+from benchmark_gateway import percentiles
+from logger import setup_logging
+from mock_broker import CONNACK, CONNECT, DISCONNECT, MockBroker, encode_string, encode_varint
+from mock_onboarding_server import MockOnboardingServer
+
+STEPS = ('register', 'getCredentials', 'mqtt_connect', 'wipe')
+
+
+class StepError(Exception):
+    """
+    A failed onboarding step. `reason` is a short label for the report, e.g. "http_503" or "timeout".
+    """
+    def __init__(self, reason: str, message: str = ""):
+        super().__init__(message or reason)
+        self.reason = reason
+
+
+async def read_chunked(reader: asyncio.StreamReader) -> bytes:
+    """
+    Body sent with Transfer-Encoding: chunked, trailers skipped.
+    """
+    body = bytearray()
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if size == 0:
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            return bytes(body)
+        body += await reader.readexactly(size)
+        await reader.readline()  # CRLF after the chunk
+
+
+async def http_get(host: str, port: int, target: str) -> Tuple[int, bytes]:
+    """
+    One GET on a new connection, as a freshly booted gateway would do it. Asked as HTTP/1.0,
+    so the server closes the connection after the body; chunked bodies are decoded all the same.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"GET {target} HTTP/1.0\r\nHost: {host}:{port}\r\n\r\n".encode('latin-1'))
+        await writer.drain()
+        status_line = await reader.readline()
+        length = None
+        chunked = False
+        while True:
+            header = await reader.readline()
+            if header in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = header.decode('latin-1').partition(':')
+            name = name.strip().lower()
+            if name == 'content-length':
+                length = int(value)
+            elif name == 'transfer-encoding':
+                chunked = 'chunked' in value.lower()
+        if chunked:
+            body = await read_chunked(reader)
+        else:
+            body = await (reader.readexactly(length) if length is not None else reader.read())
+        return int(status_line.split()[1]), body
+    except (IndexError, ValueError, asyncio.IncompleteReadError) as e:
+        raise StepError("invalid_response", str(e)) from e
+    finally:
+        writer.close()
+
+
+async def read_remaining_length(reader: asyncio.StreamReader) -> int:
+    """
+    Remaining length of an MQTT fixed header, a variable byte integer of up to four bytes.
+    """
+    multiplier, value = 1, 0
+    for _ in range(4):
+        byte = (await reader.readexactly(1))[0]
+        value += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            return value
+        multiplier *= 128
+    raise StepError("invalid_response", "malformed remaining length")
+
+
+async def mqtt_connect(host: str, port: int, client_id: str, username: str, password: str, protocol: int) -> int:
+    """
+    MQTT CONNECT with the gateway's credentials, then DISCONNECT.
+
+    Returns:
+        int: CONNACK return code (3.1.1) or reason code (5), 0 is accepted.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        variable_header = encode_string("MQTT") + bytes([protocol, 0xC2]) + config.MQTT_KEEPALIVE.to_bytes(2, 'big')
+        if protocol == 5:
+            variable_header += encode_varint(0)  # no properties
+        body = variable_header + encode_string(client_id) + encode_string(username) + encode_string(password)
+        writer.write(bytes([CONNECT << 4]) + encode_varint(len(body)) + body)
+        await writer.drain()
+
+        first = await reader.readexactly(1)
+        # An MQTTv5 CONNACK with properties (reason string, user properties) can exceed 127 bytes
+        connack = await reader.readexactly(await read_remaining_length(reader))
+        if first[0] >> 4 != CONNACK or len(connack) < 2:
+            raise StepError("invalid_response", "expected CONNACK")
+        if connack[1] == 0:
+            writer.write(bytes([DISCONNECT << 4, 0]))
+            await writer.drain()
+        return connack[1]
+    finally:
+        writer.close()
+
+
+class OnboardingRun:
+    """
+    Onboards gateways and collects per-step latencies and errors.
+    """
+    def __init__(self, server_url: str, broker: Tuple[str, int], protocol: int, timeout: float):
+        url = urlsplit(server_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.prefix = url.path.rstrip('/')
+        self.broker = broker
+        self.protocol = protocol
+        self.timeout = timeout
+        self.latencies: Dict[str, List[float]] = {step: [] for step in STEPS}
+        self.errors: Dict[str, Dict[str, int]] = {step: {} for step in STEPS}
+        self.totals: List[float] = []
+        self.onboarded = 0
+
+    async def _get_json(self, target: str) -> Dict:
+        status, body = await http_get(self.host, self.port, self.prefix + target)
+        if status not in (200, 201):
+            raise StepError(f"http_{status}")
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            raise StepError("invalid_response", str(e)) from e
+
+    async def register(self, mac: str) -> Dict:
+        return await self._get_json(f"/register?macAddress={mac}")
+
+    async def get_credentials(self, mac: str, secret: str) -> Dict:
+        return await self._get_json(f"/getCredentials?macAddress={mac}&secret={secret}")
+
+    async def connect(self, mac: str, username: str, password: str):
+        code = await mqtt_connect(self.broker[0], self.broker[1], mac, username, password, self.protocol)
+        if code in (0x05, 0x87):
+            raise StepError("not_authorized")
+        if code:
+            raise StepError(f"connack_{code}")
+
+    async def wipe(self, mac: str) -> Dict:
+        return await self._get_json(f"/wipe?macAddress={mac};onlydb=True")
+
+    async def _step(self, step: str, coroutine):
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(coroutine, self.timeout)
+        except asyncio.TimeoutError:
+            reason = "timeout"
+        except StepError as e:
+            reason = e.reason
+        except (OSError, asyncio.IncompleteReadError):  # refused, reset or closed early
+            reason = "connection"
+        else:
+            self.latencies[step].append(time.perf_counter() - start)
+            return result
+        self.errors[step][reason] = self.errors[step].get(reason, 0) + 1
+        raise StepError(reason)
+
+    async def onboard(self, mac: str) -> bool:
+        """
+        All steps for one gateway. A failed step ends its onboarding, but the wipe is still tried.
+        """
+        start = time.perf_counter()
+        try:
+            registration = await self._step('register', self.register(mac))
+            credentials = await self._step('getCredentials', self.get_credentials(mac, registration.get('secret', mac + 'abcd')))
+            await self._step('mqtt_connect', self.connect(mac, credentials.get('username', mac), credentials.get('password', mac + '1234')))
+        except StepError:
+            try:
+                await self._step('wipe', self.wipe(mac))
+            except StepError:
+                pass
+            return False
+        try:
+            await self._step('wipe', self.wipe(mac))
+        except StepError:
+            return False
+        self.totals.append(time.perf_counter() - start)
+        self.onboarded += 1
+        return True
+
+
+async def run_load(arguments) -> Dict:
+    server = broker = None
+    server_url = arguments.server
+    broker_address = None
+    if arguments.broker:
+        host, _, port = arguments.broker.rpartition(':')
+        broker_address = (host, int(port))
+    else:
+        credentials: Dict[str, str] = {}
+        broker = MockBroker(credentials=credentials)
+        broker_address = (broker.host, broker.start())
+    if not server_url:
+        # Shares the credentials dict, the broker accepts exactly the gateways onboarded so far
+        server = MockOnboardingServer(arguments.server_latency, arguments.server_concurrency, arguments.failure_rate,
+                                      credentials=broker.credentials if broker is not None else None, seed=arguments.seed)
+        server.start()
+        server_url = server.url
+
+    run = OnboardingRun(server_url, broker_address, arguments.protocol, arguments.timeout)
+    prefix = arguments.mac_prefix.upper()
+    macs = [f"{prefix}{index:0{12 - len(prefix)}X}" for index in range(arguments.gateways)]
+    slots = asyncio.Semaphore(arguments.concurrency)
+
+    async def gateway(mac: str, start_at: float):
+        await asyncio.sleep(max(0.0, start_at - time.monotonic()))
+        async with slots:
+            await run.onboard(mac)
+
+    started = time.monotonic()
+    interval = 1.0 / arguments.arrival_rate if arguments.arrival_rate else 0.0
+    await asyncio.gather(*(gateway(mac, started + index * interval) for index, mac in enumerate(macs)))
+    wall = time.monotonic() - started
+
+    if server is not None:
+        server.stop()
+    if broker is not None:
+        broker.stop()
+
+    steps = {}
+    for step in STEPS:
+        failed = sum(run.errors[step].values())
+        attempts = len(run.latencies[step]) + failed
+        steps[step] = {
+            'attempts': attempts,
+            'errors': run.errors[step],
+            'error_rate': round(failed / attempts, 4) if attempts else 0.0,
+            'latency_ms': percentiles(run.latencies[step]),
+        }
+    return {
+        'setup': {
+            'gateways': arguments.gateways,
+            'concurrency': arguments.concurrency,
+            'arrival_rate_per_s': arguments.arrival_rate,
+            'server': arguments.server or "mock",
+            'server_latency_s': arguments.server_latency if server is not None else None,
+            'server_concurrency': arguments.server_concurrency if server is not None else None,
+            'broker': arguments.broker or "mock",
+            'mqtt_protocol': arguments.protocol,
+        },
+        'wall_s': round(wall, 2),
+        'onboarded': run.onboarded,
+        'failed': arguments.gateways - run.onboarded,
+        'onboarded_per_s': round(run.onboarded / wall, 1),
+        'onboarding_latency_ms': percentiles(run.totals),
+        'steps': steps,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Onboard many simulated gateways at once and time every step.")
+    parser.add_argument("--gateways", type=int, default=200, help="Number of gateways, each with its own MAC address.")
+    parser.add_argument("--concurrency", type=int, default=50, help="Gateways onboarding at the same time.")
+    parser.add_argument("--arrival-rate", type=float, default=0.0, help="Gateways starting per second, 0 starts all at once.")
+    parser.add_argument("--mac-prefix", default=config.GATEWAY_MAC[:6], help="Hex prefix of the simulated MAC addresses.")
+    parser.add_argument("--server", default=None, help="Onboarding server base URL, by default a local MockOnboardingServer.")
+    parser.add_argument("--broker", default=None, help="MQTT broker as host:port, by default a local MockBroker.")
+    parser.add_argument("--protocol", type=int, choices=(4, 5), default=config.MQTT_PROTOCOL_VERSION, help="MQTT protocol level.")
+    parser.add_argument("--timeout", type=float, default=10.0, help="Seconds a step may take.")
+    parser.add_argument("--server-latency", type=float, default=0.0, help="Mock server: seconds of work per request.")
+    parser.add_argument("--server-concurrency", type=int, default=None, help="Mock server: requests worked on at once.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Mock server: share of requests answered with 503.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the mock server's failure injection.")
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write the results to this file.")
+    arguments = parser.parse_args()
+
+    setup_logging(level="WARNING")
+    results = asyncio.run(run_load(arguments))
+    print(json.dumps(results, indent=2))
+    if arguments.json_path:
+        with open(arguments.json_path, "w") as file:
+            json.dump(results, file, indent=2)
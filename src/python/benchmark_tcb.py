@@ -0,0 +1,166 @@
+"""
+Load test of the TCB verification service (mock_lowend_tcb.py), as a fleet of devices onboarding at once.
+Every client thread keeps one HTTP connection open and sends requests back to back.
+
+Example:
+    python3 benchmark_tcb.py --start-server --concurrency 32 --duration 10 --mix verification=3,cc=1
+    python3 benchmark_tcb.py --url http://tcb.local:8000 --concurrency 64
+    python3 benchmark_tcb.py --start-server --mix verification=1 --batch 100
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+from benchmark_gateway import parse_mix, percentiles
+
+ENDPOINTS = {
+    'verification': "/lowenddevice_verification",
+    'cc': "/lowenddevice_cc",
+    'verification_batch': "/lowenddevice_verification_batch",
+}
+
+
+def request_body(endpoint: str, uids: List[str], rng: random.Random) -> bytes:
+    if endpoint == 'verification_batch':
+        return json.dumps([{'uid': uid, 'nonce': rng.randbytes(16).hex()} for uid in uids]).encode()
+    if endpoint == 'verification':
+        return json.dumps({'uid': uids[0], 'nonce': rng.randbytes(16).hex()}).encode()
+    return json.dumps({'uid': uids[0]}).encode()
+
+
+def client(url, uids: List[str], mix: Dict[str, float], batch: int, deadline: float, seed: int, results: Dict):
+    """
+    Send requests over one keep-alive connection until the deadline, reconnecting after errors.
+    With batch > 1, verifications go to the batch endpoint, batch devices per request.
+    """
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    latencies: Dict[str, List[float]] = {}
+    statuses: Dict[str, int] = {}
+    devices = 0
+    errors = 0
+    connection = None
+    while time.monotonic() < deadline:
+        endpoint = rng.choices(names, weights)[0]
+        if endpoint == 'verification' and batch > 1:
+            endpoint = 'verification_batch'
+        targets = rng.sample(uids, batch) if endpoint == 'verification_batch' else [rng.choice(uids)]
+        body = request_body(endpoint, targets, rng)
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=10)
+            start = time.perf_counter()
+            connection.request("POST", ENDPOINTS[endpoint], body, {'Content-Type': "application/json"})
+            response = connection.getresponse()
+            response.read()
+            latencies.setdefault(endpoint, []).append(time.perf_counter() - start)
+            devices += len(targets)
+            statuses[str(response.status)] = statuses.get(str(response.status), 0) + 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            if connection is not None:
+                connection.close()
+                connection = None
+    if connection is not None:
+        connection.close()
+
+    with results['lock']:
+        for name, values in latencies.items():
+            results['latencies'].setdefault(name, []).extend(values)
+        for status, count in statuses.items():
+            results['statuses'][status] = results['statuses'].get(status, 0) + count
+        results['devices'] += devices
+        results['errors'] += errors
+
+
+def wait_for_port(host: str, port: int, timeout: float):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def main(arguments) -> Dict:
+    url = urlsplit(arguments.url)
+    mix = {name: weight for name, weight in parse_mix(arguments.mix).items() if weight > 0}
+    unknown = set(mix) - {'verification', 'cc'}
+    if unknown:
+        raise SystemExit(f"Unknown endpoints in --mix: {', '.join(sorted(unknown))}")
+    rng = random.Random(arguments.seed)
+    # The first character of a UID selects one of the nine keys
+    uids = [f"{index % 9}{rng.getrandbits(60):015x}" for index in range(max(arguments.devices, arguments.batch))]
+
+    server = None
+    if arguments.start_server:
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_lowend_tcb.py"),
+             "--host", url.hostname, "--port", str(url.port or 80), "--threads", str(arguments.server_threads), "--no-timing"],
+            stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(url.hostname, url.port or 80, 15)
+        results = {'lock': threading.Lock(), 'latencies': {}, 'statuses': {}, 'devices': 0, 'errors': 0}
+        started = time.monotonic()
+        deadline = started + arguments.duration
+        threads = [threading.Thread(target=client, args=(url, uids, mix, arguments.batch, deadline, arguments.seed + index, results))
+                   for index in range(arguments.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    completed = sum(len(values) for values in results['latencies'].values())
+    report = {
+        'url': arguments.url,
+        'concurrency': arguments.concurrency,
+        'devices': arguments.devices,
+        'batch': arguments.batch,
+        'duration_s': round(elapsed, 2),
+        'requests': completed,
+        'requests_per_s': round(completed / elapsed, 1),
+        'devices_per_s': round(results['devices'] / elapsed, 1),
+        'statuses': results['statuses'],
+        'errors': results['errors'],
+        'latency_ms': percentiles([value for values in results['latencies'].values() for value in values]),
+        'endpoints': {name: {'requests': len(values), 'latency_ms': percentiles(values)}
+                      for name, values in results['latencies'].items()},
+    }
+    print(json.dumps(report, indent=2))
+    if arguments.json_path:
+        with open(arguments.json_path, "w") as file:
+            json.dump(report, file, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the TCB verification service.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of the service.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Client threads, each with its own connection.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to send requests for.")
+    parser.add_argument("--devices", type=int, default=1000, help="Distinct device UIDs.")
+    parser.add_argument("--mix", default="verification=1,cc=1", help="Endpoint weights, e.g. verification=3,cc=1.")
+    parser.add_argument("--batch", type=int, default=1, help="Devices per verification request, > 1 uses the batch endpoint.")
+    parser.add_argument("--start-server", action="store_true", help="Start mock_lowend_tcb.py on the URL's port first.")
+    parser.add_argument("--server-threads", type=int, default=16, help="Worker threads of the started server.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write the results to this file.")
+    main(parser.parse_args())
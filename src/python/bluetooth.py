@@ -2,6 +2,7 @@ from bleak import BleakClient
 import asyncio
 # from typing import Type;
 from abc import ABC, abstractmethod
+from BleBackend import FakeBleBackend
 
 class IBluetoothAdapter(ABC):
     @abstractmethod
@@ -26,6 +27,8 @@ class BluetoothAdapterFactory:
     def create_adapter(adapter_type: str, macAddress: str):
         if adapter_type == "mock":
             return AdapterMock(macAddress)
+        elif adapter_type == "simulated":
+            return AdapterSimulated(macAddress)
         else:
             raise ValueError("Unsupported adapter type")
 
@@ -85,6 +88,30 @@ class AdapterMock(IBluetoothAdapter):
         await asyncio.sleep(1)
         print("Data written.")
 
+
+class AdapterSimulated(IBluetoothAdapter):
+    """
+    Adapter backed by a FakeBleBackend device instead of hardware.
+    """
+    def __init__(self, macAddress: str, backend: FakeBleBackend = None):
+        self.macAddress = macAddress
+        self.backend = backend if backend is not None else FakeBleBackend()
+        if macAddress not in self.backend.devices:
+            self.backend.add_device(macAddress)
+        self.client = self.backend.create_client(macAddress)
+
+    async def connect(self):
+        await self.client.connect()
+
+    async def disconnect(self):
+        await self.client.disconnect()
+
+    async def read_data(self):
+        return await self.client.read_gatt_char("00002a37-0000-1000-8000-00805f9b34fb")
+
+    async def write_data(self, data):
+        await self.client.write_gatt_char("00002a37-0000-1000-8000-00805f9b34fb", data)
+
 # end adapters
 
 
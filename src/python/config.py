@@ -3,7 +3,10 @@ Configuration file for the gateway application.
 """
 
 INITIAL_STATE = "connected"  # Initial state of the gateway: "unregistered" | "registered" | "connected"
-MAX_REGISTRATION_ATTEMPTS = 10
+
+# Reconnect backoff (registration, credentials and MQTT), with jitter
+RECONNECT_MIN_DELAY = 1  # seconds
+RECONNECT_MAX_DELAY = 120  # seconds
  
 # Gateway identification
 GATEWAY_MAC = "B827EBB63381"  # Replace with your actual MAC address or device ID
@@ -18,13 +21,113 @@ REGISTRATION_ENDPOINT = "http://192.168.1.152:3010/register"  # Replace with act
 WIPE_ENDPOINT = "http://192.168.1.152:3010/wipe"  # Replace with actual registration endpoint
 GET_CREDENTIALS_ENDPOINT = "http://192.168.1.152:3010/getCredentials"  # Replace with actual credentials endpoint
 
+# TCB verification service of low-end devices (see TcbClient.py), verifications close together are sent as one batch
+TCB_ENDPOINT = "http://192.168.1.152:8000"  # Replace with actual TCB address
+TCB_BATCH_SIZE = 100  # Most devices per batch request
+TCB_BATCH_DELAY = 0.05  # Seconds a verification waits for others to share its request
+TCB_TIMEOUT = 10.0  # Seconds a TCB request may take
+# Attestation of paired low-end devices (pairing config with a "uid"), see AttestationCache.py
+ATTESTATION_TTL = 3600  # Seconds a verified conformity certificate and its trust level are valid
+ATTESTATION_REFRESH_AHEAD = 300  # Seconds before expiry at which it is refreshed in the background
+ATTESTATION_RETRY_DELAY = 30  # Seconds before a failed attestation is tried again
+ATTESTATION_REQUIRED = False  # Reject pair/read of low-end devices without a valid attestation, else only a low one rejects
+# Characteristic a low-end device is challenged on: the gateway writes the nonce, the device answers HMAC-SHA256(its key, nonce)
+ATTESTATION_CHALLENGE_UUID = "87654321-1234-f393-e0a9-e50e24dcca9f"
+
 # MQTT Configuration
 MQTT_BROKER = "34.240.4.8"  # Replace with actual MQTT broker address
 MQTT_PORT = 1885  # Replace with actual MQTT port
 MQTT_KEEPALIVE = 60  # Keep alive time in seconds
+# These need MQTT_PROTOCOL_VERSION = 5, on MQTTv3.1.1 they are off:
+#   - the broker's Receive Maximum bounding the in-flight window (MQTT_MAX_INFLIGHT is the only bound)
+#   - No Local on the instruction topic (the gateway's own messages are then dropped by their prefix, see Instructions.py)
+#   - compressed measurements and their Content-Type (MQTT_COMPRESSION has no effect)
+MQTT_PROTOCOL_VERSION = 4  # 4 = MQTTv3.1.1, 5 = MQTTv5, falls back to 4 if the broker refuses it
+MQTT_MAX_INFLIGHT = 100  # Upper bound for the adaptive in-flight window, the broker Receive Maximum may lower it
+MQTT_COMPRESSION = False  # Compress large measurements (MQTTv5 only, see PayloadCodec.py), the platform must decode them
+MQTT_COMPRESSION_MIN_BYTES = 1024  # Size of the hex value from which measurements are compressed
+MQTT_COMPRESSION_LEVEL = 6  # zlib level, 1 = fastest, 9 = smallest
+# MQTT credentials are reused across reconnects and restarts until they expire or the broker rejects them
+MQTT_CREDENTIALS_LIFETIME = None  # Seconds they are valid if the server sends no expiresIn/expiresAt, None = until rejected
+MQTT_CREDENTIALS_REFRESH_AHEAD = 300  # Seconds before expiry at which new ones are fetched in the background
+MQTT_CREDENTIALS_RETRY_DELAY = 60  # Seconds before a failed background refresh is tried again
+
+# Heartbeat: full snapshot on start and every HEARTBEAT_FULL_EVERY heartbeats, deltas or keep-alives in between
+HEARTBEAT_INTERVAL = 60  # Starting interval in seconds
+HEARTBEAT_MIN_INTERVAL = 15  # Used after a lost heartbeat, also the fastest rate for sending sensor changes
+HEARTBEAT_MAX_INTERVAL = 300  # Reached while heartbeats are acknowledged quickly
+HEARTBEAT_FULL_EVERY = 10
+
+# Instructions with a messageId/id seen within this many seconds are dropped as duplicates
+INSTRUCTION_DEDUPE_WINDOW = 60.0
+# Priority class per instruction type, lower runs first (0 control/trust, 1 pair/unpair, 2 read, 3 scan)
+INSTRUCTION_PRIORITIES = {}  # Overrides of the defaults in InstructionQueue.py
+# Seconds an instruction may wait in the queue when it carries no 'deadline' or 'ttl'
+INSTRUCTION_DEFAULT_TTLS = {
+    'read': 300,
+    'scan': 120,
+}
+
+# Clock sync with the platform over MQTT ('timesync' request/response), for measurement timestamps
+CLOCK_SYNC_ENABLED = False  # Only if the platform answers 'timesync' requests, else the local clock is used
+CLOCK_SYNC_INTERVAL = 300  # seconds between sync requests once synced
+CLOCK_SYNC_MAX_UNANSWERED = 5  # Unanswered requests in a row after which the gateway stops asking, None = never
 
 # Bluetooth Configuration
+BLE_BACKEND = "bleak"  # "bleak" for real hardware, "fake" for the in-memory simulation
 BLE_SCAN_TIMEOUT = 30.0  # Scanning timeout in seconds
 BLE_MEASUREMENT_DURATION = 5  # Measurement duration in seconds
+BLE_RESTORE_CONCURRENCY = 4  # Saved sensors connected at once after a restart
+BLE_CONCURRENT_READS = 4  # Read instructions handled at once, 1 handles them one after another like all others
+# GATT operations are queued per device and overlapped across devices (see GattScheduler.py)
+BLE_GATT_CONCURRENCY = 4  # Operations outstanding on the controller at once
+BLE_GATT_TIMEOUT = 10.0  # Seconds a GATT operation may take once started
+BLE_GATT_TIMEOUTS = {}  # Per operation overrides, e.g. {"start_notify": 5.0}
+# BLE in worker processes (see IngestWorkers.py), for gateways with many sensors. 0 = everything in one process
+BLE_INGEST_WORKERS = 0  # e.g. 3 on a 4-core Pi, leaving a core for MQTT
+BLE_INGEST_RING_FRAMES = 4096  # Notifications per worker shared-memory ring
+# Notifications of a measurement are kept in a fixed-capacity ring (see FrameRing.py), memory does not grow with the rate.
+# The ring holds the notifications expected at the processing profile's "rate" (notifications per second) over the
+# measurement duration, with headroom
+BLE_SAMPLE_RATE = 100  # Notifications per second expected when the processing profile has no "rate"
+BLE_SAMPLE_RING_HEADROOM = 1.5  # Ring capacity relative to the expected notifications
+BLE_SAMPLE_RING_FRAMES = 8192  # Most notifications kept per measurement, however high the rate
+BLE_SAMPLE_FRAME_SIZE = 512  # Largest notification in bytes (the BLE attribute maximum)
+BLE_SAMPLE_RING_POLICY = "overwrite"  # When full: "overwrite" keeps the newest notifications, "block" keeps the oldest
+BLE_SAMPLE_RING_SHARED = False  # Shared memory other processes can attach to (FrameRing.attach), else a private mmap
+
+# Edge processing per sensor address ("default" for all others), see EdgeProcessor.py.
+# A 'processing' entry in a pairing instruction's config takes precedence. Without a profile the raw
+# notifications are sent. Example:
+#   "default": {
+#       "format": "<h",          # struct format of one sample
+#       "skip": 0,               # header bytes per notification
+#       "rate": 50,              # notifications per second, sizes the sample ring
+#       "decimate": 10,          # every 10th sample as "series"
+#       "window": 50,            # min/max/mean per 50 samples
+#       "thresholds": {"min": -500, "max": 500},  # alarms, and the raw data is sent along
+#   }
+SENSOR_PROCESSING = {}
+
+# Persistent state for warm restarts (credentials, gateway state, trust levels, paired sensors)
+STATE_PERSISTENCE = True
+STATE_FILE = "gateway_state.json"  # Contains the MQTT credentials, written with owner-only permissions
+
+# Metrics (Prometheus text format on http://<gateway>:METRICS_PORT/metrics)
+METRICS_ENABLED = True
+METRICS_PORT = 9105
+
+# Logging
+LOG_LEVEL = "INFO"  # Level of all gateway loggers
+LOG_LEVELS = {  # Per-module overrides, e.g. "gateway.mqtt.traffic": "DEBUG" logs every payload
+    "gateway.mqtt.traffic": "INFO",
+    "gateway.ble.notify": "INFO",
+}
+LOG_RATE_LIMITS = {  # Logger -> (records, seconds) for hot-path loggers
+    "gateway.mqtt.traffic": (20, 1.0),
+    "gateway.ble.notify": (5, 1.0),
+}
+LOG_QUEUE_SIZE = 10000  # Records waiting for the writer thread, further records are dropped
+LOG_JSON = False  # One JSON object per line instead of plain text
 
 DEBUG_MODE = True
@@ -0,0 +1,131 @@
+"""
+Logging setup for the gateway application.
+Records are handed to a background thread through a bounded queue, so hot paths never block on stdout.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from typing import Dict, Optional, Tuple
+
+import config as config
+
+ROOT_LOGGER = "gateway"
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Get a logger below the gateway root logger.
+
+    Args:
+        name (str): Dotted module name, e.g. "mqtt" or "ble.notify".
+
+    Returns:
+        logging.Logger: The logger "gateway.<name>".
+    """
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most `rate` records per message template every `per` seconds.
+
+    The number of suppressed records is appended to the first record of the next window.
+    """
+    def __init__(self, rate: int, per: float = 1.0):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self._windows: Dict[str, list] = {}  # message template -> [window start, passed, suppressed]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        key = str(record.msg)
+        window = self._windows.get(key)
+
+        if window is None or now - window[0] >= self.per:
+            suppressed = window[2] if window is not None else 0
+            window = self._windows[key] = [now, 0, 0]
+            if suppressed:
+                record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+
+        if window[1] >= self.rate:
+            window[2] += 1
+            return False
+        window[1] += 1
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that drops records instead of blocking or raising when the queue is full.
+    """
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, for log collectors that parse structured output.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def setup_logging(level: str = None, levels: Dict[str, str] = None, rate_limits: Dict[str, Tuple[int, float]] = None):
+    """
+    Configure the gateway loggers. Safe to call more than once, only the first call has an effect.
+
+    Args:
+        level (str, optional): Level of the gateway root logger. Defaults to config.LOG_LEVEL.
+        levels (Dict[str, str], optional): Per-logger levels. Defaults to config.LOG_LEVELS.
+        rate_limits (Dict[str, Tuple[int, float]], optional): Logger name -> (records, seconds).
+            Defaults to config.LOG_RATE_LIMITS.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level or config.LOG_LEVEL)
+    root.propagate = False
+
+    for name, logger_level in (levels if levels is not None else config.LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    for name, (rate, per) in (rate_limits if rate_limits is not None else config.LOG_RATE_LIMITS).items():
+        logging.getLogger(name).addFilter(RateLimitFilter(rate, per))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if config.LOG_JSON:
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+    root.addHandler(DroppingQueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)  # flush what is still queued on exit
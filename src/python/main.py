@@ -4,9 +4,9 @@ Manages the gateway state machine and coordinates MQTT and Bluetooth communicati
 """
 
 import asyncio
+import functools
 import json
 import time
-import requests
 from typing import Dict, Optional, Any
 
 # Import configuration
@@ -15,6 +15,27 @@ import config as config
 # Import handlers
 from MqttHandler import MqttHandler
 from BluetoothAdapter import BluetoothAdapter
+from BleBackend import BleBackendFactory
+from IngestWorkers import IngestPool, WorkerBluetoothAdapter
+from ConnectionSupervisor import ConnectionSupervisor
+from Heartbeat import Heartbeat
+from ClockSync import ClockSync
+from PayloadCodec import PayloadCodec
+from StateStore import StateStore
+from InstructionQueue import InstructionQueue
+from TcbClient import TcbClient
+from CredentialManager import CredentialManager
+from AttestationCache import AttestationCache
+from Instructions import Instruction
+from logger import get_logger, setup_logging
+import metrics
+
+log = get_logger("main")
+
+INSTRUCTIONS_HANDLED = metrics.counter("gateway_instructions_handled_total", "Instructions taken from the queue and handled", ["type"])
+INSTRUCTION_WAIT_SECONDS = metrics.histogram("gateway_instruction_wait_seconds", "Time instructions waited in the queue")
+INSTRUCTION_DURATION_SECONDS = metrics.histogram("gateway_instruction_duration_seconds", "Time spent handling an instruction", ["type"])
+HTTP_REQUEST_SECONDS = metrics.histogram("gateway_http_request_seconds", "Onboarding HTTP request latency", ["endpoint"])
 
 
 class GatewayState:
@@ -23,7 +44,8 @@ class GatewayState:
     REGISTERED = "registered"
     CONNECTED = "connected"
 
-queue = asyncio.Queue()  # Global queue for events
+# Global queue for events, by priority, drops duplicate and expired instructions
+queue = InstructionQueue(config.INSTRUCTION_DEDUPE_WINDOW, config.INSTRUCTION_PRIORITIES, config.INSTRUCTION_DEFAULT_TTLS)
 
 
 
@@ -37,8 +59,15 @@ class Gateway:
         
         # Credentials and secret (would be stored persistently in production)
         self.secret = config.MOCK_SECRET
-        self.mqtt_username = config.GATEWAY_MAC
-        self.mqtt_password = config.MOCK_PASSWORD
+        # MQTT credentials, reused until they expire or the broker rejects them
+        self.credentials = CredentialManager(
+            self.get_mqtt_credentials,
+            config.MQTT_CREDENTIALS_LIFETIME,
+            config.MQTT_CREDENTIALS_REFRESH_AHEAD,
+            config.MQTT_CREDENTIALS_RETRY_DELAY
+        )
+        self.credentials.set(config.GATEWAY_MAC, config.MOCK_PASSWORD)
+        self.credentials_task = None
         self.atl = config.ATL
         self.rtl = config.RTL
         
@@ -48,11 +77,40 @@ class Gateway:
             self.mac_address,
             config.MQTT_BROKER,
             config.MQTT_PORT,
-            config.MQTT_KEEPALIVE
+            config.MQTT_KEEPALIVE,
+            protocol=config.MQTT_PROTOCOL_VERSION,
+            max_inflight=config.MQTT_MAX_INFLIGHT
         )
         
-        self.ble_adapter = BluetoothAdapter()
+        # Backoff shared by registration, credential and MQTT connection retries
+        self.supervisor = ConnectionSupervisor(config.RECONNECT_MIN_DELAY, config.RECONNECT_MAX_DELAY)
+        self.mqtt_handler.set_reconnect_delay(self.supervisor.min_delay, self.supervisor.max_delay)
+        self.mqtt_handler.set_payload_codec(PayloadCodec(config.MQTT_COMPRESSION, config.MQTT_COMPRESSION_MIN_BYTES, config.MQTT_COMPRESSION_LEVEL))
+        # Credentials refreshed in the background are used from the next reconnect on
+        self.credentials.add_listener(self.mqtt_handler.set_credentials)
+        
+        if config.BLE_INGEST_WORKERS:
+            # BLE and edge processing in worker processes, this process keeps MQTT and the state machine
+            self.ble_adapter = WorkerBluetoothAdapter(IngestPool(
+                config.BLE_INGEST_WORKERS,
+                functools.partial(BleBackendFactory.create_backend, config.BLE_BACKEND),
+                config.BLE_INGEST_RING_FRAMES,
+                config.BLE_SAMPLE_FRAME_SIZE
+            ))
+        else:
+            self.ble_adapter = BluetoothAdapter(BleBackendFactory.create_backend(config.BLE_BACKEND))
         self.ble_adapter.inject_mqtt_handler(self.mqtt_handler)
+
+        # Signs device nonces for low-end device verification, batching concurrent verifications
+        self.tcb = TcbClient(config.TCB_ENDPOINT, config.TCB_BATCH_SIZE, config.TCB_BATCH_DELAY, config.TCB_TIMEOUT)
+        # Trust levels of paired low-end devices, from challenges the TCB verifies, kept fresh in the background
+        self.attestations = AttestationCache(self.tcb, self.ble_adapter.sign_challenge, config.ATTESTATION_TTL,
+                                             config.ATTESTATION_REFRESH_AHEAD, config.ATTESTATION_RETRY_DELAY)
+        self.attestation_task = None
+
+        # Offset to the platform clock, for measurement timestamps
+        self.clock = ClockSync(config.CLOCK_SYNC_INTERVAL, max_unanswered=config.CLOCK_SYNC_MAX_UNANSWERED)
+        self.ble_adapter.inject_clock(self.clock)
         
         # Set up callbacks
         # self.mqtt_handler.set_pairing_callback(self.handle_instruction)
@@ -61,8 +119,107 @@ class Gateway:
         self.running = True
 
         self.isFirstBoot = True   # Global variable to track if this is the first boot
-        self.heartbeat_counter = 11 
-        self.attempts = 0  # Global variable to track registration attempts
+        self.heartbeat = Heartbeat(
+            self.mac_address,
+            config.HEARTBEAT_INTERVAL,
+            config.HEARTBEAT_MIN_INTERVAL,
+            config.HEARTBEAT_MAX_INTERVAL,
+            config.HEARTBEAT_FULL_EVERY
+        )
+
+        # Warm restart: credentials, state, trust levels and paired sensors from the last run
+        self.state_store = StateStore(config.STATE_FILE) if config.STATE_PERSISTENCE else None
+        self.restored_sensors = self.restore_state()
+        self.restore_task = None
+
+        # Read instructions running in the background, at most BLE_CONCURRENT_READS
+        self.read_slots = asyncio.Semaphore(max(1, config.BLE_CONCURRENT_READS))
+        self.read_slot_freed = asyncio.Event()
+        self.read_tasks = set()
+
+        queue.expired_callback = self.report_expired_instruction
+
+        self._register_metrics()
+
+    def _register_metrics(self):
+        """
+        Expose queue depth and MQTT flow control state as gauges read at scrape time.
+        """
+        metrics.gauge("gateway_instruction_queue_depth", "Instructions waiting in the queue").set_function(queue.qsize)
+        metrics.gauge("gateway_heartbeat_interval_seconds", "Current adaptive heartbeat interval").set_function(lambda: self.heartbeat.interval)
+        metrics.gauge("gateway_attested_devices", "Low-end devices with a valid attestation").set_function(self.attestations.valid_count)
+
+        flow = self.mqtt_handler.get_flow_metrics
+        metrics.gauge("gateway_mqtt_inflight_window", "Adaptive in-flight window size").set_function(lambda: flow()['window'])
+        metrics.gauge("gateway_mqtt_inflight_messages", "QoS1 messages waiting for PUBACK").set_function(lambda: flow()['inflight'])
+        metrics.gauge("gateway_mqtt_backlog_messages", "Messages waiting for a free in-flight slot").set_function(lambda: flow()['backlog'])
+        metrics.gauge("gateway_mqtt_receive_maximum", "Receive Maximum advertised by the broker").set_function(lambda: flow()['receive_maximum'])
+        rtt = metrics.gauge("gateway_mqtt_ack_rtt_seconds", "Recent PUBACK round-trip time percentiles", ["quantile"])
+        for quantile, key in (("0.5", 'rtt_p50'), ("0.9", 'rtt_p90'), ("0.99", 'rtt_p99')):
+            rtt.labels(quantile).set_function(lambda key=key: flow()[key])
+
+    def restore_state(self) -> list:
+        """
+        Load the state snapshot written by a previous run.
+        
+        Returns:
+            list: Profiles of the sensors that were paired, to connect again.
+        """
+        if self.state_store is None:
+            return []
+        snapshot = self.state_store.load()
+        if snapshot is None:
+            return []
+        if snapshot.get('mac_address') != self.mac_address:
+            log.warning("Ignoring state snapshot of gateway %s", snapshot.get('mac_address'))
+            return []
+
+        self.secret = snapshot.get('secret', self.secret)
+        self.credentials.set(snapshot.get('mqtt_username', self.credentials.username),
+                             snapshot.get('mqtt_password', self.credentials.password),
+                             snapshot.get('mqtt_credentials_expire_at'))
+        self.atl = snapshot.get('atl', self.atl)
+        self.rtl = snapshot.get('rtl', self.rtl)
+        if snapshot.get('state') in (GatewayState.UNREGISTERED, GatewayState.REGISTERED, GatewayState.CONNECTED):
+            self.state = snapshot['state']
+
+        sensors = list(snapshot.get('sensors', {}).values())
+        log.info("Restored %s state with %s paired sensors from %s", self.state, len(sensors), self.state_store.path)
+        return sensors
+
+    def save_state(self):
+        """
+        Write the state snapshot if anything changed since the last one.
+        """
+        if self.state_store is None:
+            return
+        self.state_store.save({
+            'mac_address': self.mac_address,
+            'state': self.state,
+            'secret': self.secret,
+            **self.credentials.snapshot(),
+            'atl': self.atl,
+            'rtl': self.rtl,
+            'sensors': dict(self.ble_adapter.device_profiles),
+        })
+
+    async def _http_get(self, endpoint: str, url: str):
+        """
+        GET against the onboarding server, timed per endpoint. The blocking request runs in the
+        default executor, so heartbeats and instructions are not held up while it waits.
+        
+        Args:
+            endpoint (str): Short endpoint name used as metric label.
+            url (str): Full request URL.
+        """
+        import requests  # Imported on first use, a restart with saved credentials never needs it
+
+        loop = asyncio.get_running_loop()
+        start_time = time.monotonic()
+        try:
+            return await loop.run_in_executor(None, functools.partial(requests.get, url, timeout=10))
+        finally:
+            HTTP_REQUEST_SECONDS.labels(endpoint).observe(time.monotonic() - start_time)
 
 
     # def get_event_loop(self):
@@ -88,23 +245,22 @@ class Gateway:
         Returns:
             bool: True if registration was successful, False otherwise.
         """
-        print(f"Attempting to register gateway {self.mac_address}...")
+        log.info("Attempting to register gateway %s...", self.mac_address)
         
         try:
-            response = requests.get(
-                f"{config.WIPE_ENDPOINT}?macAddress={self.mac_address};onlydb={onlydb}",
-                timeout=10
-            )
+            response = await self._http_get("wipe", f"{config.WIPE_ENDPOINT}?macAddress={self.mac_address};onlydb={onlydb}")
             
             if response.status_code in [200, 201]:
-                print("Wipe successful")
+                log.info("Wipe successful")
+                if self.state_store is not None:
+                    self.state_store.clear()
                 return True
             else:
-                print(f"Wipe failed: {response.status_code} - {response.text}")
+                log.warning("Wipe failed: %s - %s", response.status_code, response.text)
                 return False
                 
         except Exception as e:
-            print(f"Wipe request failed: {e}")
+            log.warning("Wipe request failed: %s", e)
             return False
         
     async def register_gateway(self) -> bool:
@@ -114,16 +270,13 @@ class Gateway:
         Returns:
             bool: True if registration was successful, False otherwise.
         """
-        print(f"Attempting to register gateway {self.mac_address}...")
+        log.info("Attempting to register gateway %s...", self.mac_address)
         
         try:
-            response = requests.get(
-                f"{config.REGISTRATION_ENDPOINT}?macAddress={self.mac_address}",
-                timeout=10
-            )
+            response = await self._http_get("register", f"{config.REGISTRATION_ENDPOINT}?macAddress={self.mac_address}")
             
             if response.status_code in [200, 201]:
-                print("Registration successful")
+                log.info("Registration successful")
                 
                 # Assuming the server returns JSON with a secret
                 try:
@@ -134,20 +287,20 @@ class Gateway:
                         # For backward compatibility - in the example code we see concatenation with 'abcd'
                         self.secret = self.mac_address + 'abcd'
                         
-                    print(f"Received secret for gateway")
+                    log.info("Received secret for gateway")
                     return True
                 except ValueError:
-                    print("Registration response was not valid JSON")
+                    log.warning("Registration response was not valid JSON")
                     # Fallback for backward compatibility
                     self.secret = self.mac_address + 'abcd'
                     return True
                     
             else:
-                print(f"Registration failed: {response.status_code} - {response.text}")
+                log.warning("Registration failed: %s - %s", response.status_code, response.text)
                 return False
                 
         except Exception as e:
-            print(f"Registration request failed: {e}")
+            log.warning("Registration request failed: %s", e)
             return False
             
     async def get_mqtt_credentials(self) -> bool:
@@ -158,48 +311,49 @@ class Gateway:
             bool: True if credentials were successfully retrieved, False otherwise.
         """
         if self.secret is None:
-            print("Cannot get MQTT credentials: gateway not registered (no secret)")
+            log.warning("Cannot get MQTT credentials: gateway not registered (no secret)")
             return False
             
-        print(f"Requesting MQTT credentials for gateway {self.mac_address}...")
+        log.info("Requesting MQTT credentials for gateway %s...", self.mac_address)
         
         try:
-            response = requests.get(
-                f"{config.GET_CREDENTIALS_ENDPOINT}?macAddress={self.mac_address}&secret={self.secret}",
-                timeout=10
-            )
+            response = await self._http_get("getCredentials", f"{config.GET_CREDENTIALS_ENDPOINT}?macAddress={self.mac_address}&secret={self.secret}")
             
             if response.status_code == 200:
-                print("Credentials request successful")
+                log.info("Credentials request successful")
                 
                 # Extract credentials from response
                 try:
                     response_data = response.json()
+                    # Optional lifetime of the credentials, seconds or unix time
+                    expires_in = response_data.get('expiresIn')
+                    expires_at = response_data.get('expiresAt')
+                    if not isinstance(expires_in, (int, float)):
+                        expires_in = None
+                    if not isinstance(expires_at, (int, float)):
+                        expires_at = None
                     if 'username' in response_data and 'password' in response_data:
-                        self.mqtt_username = response_data['username']
-                        self.mqtt_password = response_data['password']
+                        self.credentials.set(response_data['username'], response_data['password'], expires_at, expires_in)
                     else:
                         # For backward compatibility - in the example code we see concatenation with '1234'
-                        self.mqtt_username = self.mac_address
-                        self.mqtt_password = self.mac_address + '1234'
+                        self.credentials.set(self.mac_address, self.mac_address + '1234', expires_at, expires_in)
                         
-                    print(f"Received MQTT credentials")
+                    log.info("Received MQTT credentials")
                     return True
                 except ValueError:
-                    print("Credentials response was not valid JSON")
+                    log.warning("Credentials response was not valid JSON")
                     # Fallback for backward compatibility
-                    self.mqtt_username = self.mac_address
-                    self.mqtt_password = self.mac_address + '1234'
+                    self.credentials.set(self.mac_address, self.mac_address + '1234')
                     return True
                     
             else:
-                print(f"Credentials request failed: {response.status_code} - {response.text}")
+                log.warning("Credentials request failed: %s - %s", response.status_code, response.text)
                 return False
                 
         except Exception as e:
             if config.DEBUG_MODE:
                     raise e
-            print(f"Credentials request failed: {e}")
+            log.warning("Credentials request failed: %s", e)
             return False
             
     async def connect_mqtt(self) -> bool:
@@ -209,143 +363,286 @@ class Gateway:
         Returns:
             bool: True if connection was successful, False otherwise.
         """
-        if self.mqtt_username is None or self.mqtt_password is None:
-            print("Cannot connect to MQTT: missing credentials")
+        if self.credentials.username is None or self.credentials.password is None:
+            log.warning("Cannot connect to MQTT: missing credentials")
             return False
             
         # Set credentials in MQTT handler
-        self.mqtt_handler.set_credentials(self.mqtt_username, self.mqtt_password)
+        self.mqtt_handler.set_credentials(self.credentials.username, self.credentials.password)
         
         # Connect to broker
-        return self.mqtt_handler.connect()
+        if self.mqtt_handler.connect():
+            return True
+        if self.mqtt_handler.auth_rejected:
+            # Only now are the credentials worth another round trip to the server
+            self.credentials.reject()
+        return False
 
-    def verify_atl_if_relevant(self, instruction: Dict[str, Any]) -> bool:
+    def verify_atl_if_relevant(self, instruction: Instruction) -> bool:
         """
         Verify the ATL in the instruction if it is relevant.
         
         Args:
-            instruction (Dict[str, Any]): The instruction to verify.
+            instruction (Instruction): The instruction to verify.
         """
-        print(f"Verifying trust level for instruction: {instruction}")
-        if (self.atl < self.rtl):
-            print(f"Actual trust level ({self.atl}) is below required trust level {self.rtl}. INSTRUCTION REJECTED.")
-            createTechnical = instruction.get('createTechnical')
-            if (createTechnical is not None and isinstance(createTechnical, bool) and createTechnical == True):
+        log.debug("Verifying trust level for instruction: %s", instruction)
+        atl = self.atl
+        address = getattr(instruction, 'address', None)
+        if address and self.attestations.is_tracked(address):
+            # Low-end device: its cached attestation counts too, the TCB is never asked here
+            device_tl = self.attestations.trust_level(address)
+            if device_tl is not None:
+                atl = min(atl, device_tl)
+            elif config.ATTESTATION_REQUIRED:
+                log.warning("Device %s has no valid attestation. INSTRUCTION REJECTED.", address)
+                return False
+
+        if (atl < self.rtl):
+            log.warning("Actual trust level (%s) is below required trust level %s. INSTRUCTION REJECTED.", atl, self.rtl)
+            if instruction.create_technical:
                 # we trigger a technical alarm in the platform
-                print("Triggered technical alarm due to low trust level.")
+                log.info("Triggered technical alarm due to low trust level.")
             return False
-        print(f"Actual trust level ({self.atl}) is above required trust level ({self.rtl}). INSTRUCTION ACCEPTED.")
+        log.info("Actual trust level (%s) is above required trust level (%s). INSTRUCTION ACCEPTED.", atl, self.rtl)
         return True
 
+    def track_attestation(self, device_info: Dict[str, Any]):
+        """
+        Attest a low-end device from now on, if its pairing information names its TCB UID.
+        """
+        uid = (device_info.get('config') or {}).get('uid')
+        if isinstance(uid, str) and uid:
+            self.attestations.track(device_info['address'], uid)
+
     
-    async def handle_instruction(self, instruction: Dict[str, Any]):
+    async def handle_instruction(self, instruction: Instruction):
         """
-        Handle pairing instructions received from MQTT.
+        Handle instructions received from MQTT.
         
         Args:
-            instruction (Dict[str, Any]): Pairing instruction.
+            instruction (Instruction): Validated instruction, see Instructions.py.
         """
         try:
-            instruction_type = instruction.get('type')
+            instruction_type = instruction.type
 
             # set ATL if provided in the instruction
-            atl = instruction.get('atl')
-            if (atl is not None and isinstance(atl, (float, int)) and not isinstance(atl, bool)):
-                print(f"Simulated ATL calculation triggered...")
-                print(f"Updating ATL to {atl} based on latest trust level calculation")
-                self.atl = atl
+            if instruction.atl is not None:
+                log.info("Simulated ATL calculation triggered...")
+                log.info("Updating ATL to %s based on latest trust level calculation", instruction.atl)
+                self.atl = instruction.atl
 
             if instruction_type == 'pair':
-                print(f"Received pairing instruction: {instruction}")
+                log.debug("Received pairing instruction: %s", instruction)
+
+                self.track_attestation(instruction.device_info())
+                if config.ATTESTATION_REQUIRED and self.attestations.is_tracked(instruction.address) \
+                        and self.attestations.trust_level(instruction.address) is None:
+                    # First pairing of a low-end device, nothing cached yet. It answers the challenge
+                    # over BLE, so it is connected first, and dropped again if it is not trusted.
+                    if await self.ble_adapter.pair_device(instruction.device_info()):
+                        await self.attestations.attest(instruction.address)
+                    if not self.verify_atl_if_relevant(instruction):
+                        await self.ble_adapter.unpair_device({'address': instruction.address})
+                    return
 
                 isTrustworthy = self.verify_atl_if_relevant(instruction)
                 if (isTrustworthy == False):
                     return
-                await self.ble_adapter.pair_device(instruction)
+                if await self.ble_adapter.pair_device(instruction.device_info()):
+                    # Connected now, it can answer its challenge
+                    self.attestations.retry(instruction.address)
                 
             elif instruction_type == 'unpair':
-                print(f"Received unpairing instruction: {instruction}")
-                await self.ble_adapter.unpair_device(instruction)
+                log.debug("Received unpairing instruction: %s", instruction)
+                await self.ble_adapter.unpair_device({'address': instruction.address})
+                self.attestations.forget(instruction.address)
             
             elif instruction_type == 'scan':
-                print(f"Received scan instruction: {instruction}")
+                log.debug("Received scan instruction: %s", instruction)
                 await self.ble_adapter.scan_devices(config.BLE_SCAN_TIMEOUT)
 
             elif instruction_type == 'read':
-                print(f"Received read instruction: {instruction}")
+                log.debug("Received read instruction: %s", instruction)
                 isTrustworthy = self.verify_atl_if_relevant(instruction)
                 if (isTrustworthy == False):
                     return
 
-                address = instruction['address']
-                await self.ble_adapter.read_data(address)
+                await self.ble_adapter.read_data(instruction.address)
+
+            elif instruction_type == 'trust':
+                # Trust level split off another instruction by the queue, already applied above
+                pass
+
+            elif instruction_type == 'timesync':
+                self.clock.on_response(instruction.request_id, instruction.t1, instruction.t2, instruction.received_at)
+
+            elif instruction_type == 'getheartbeat':
+                log.debug("Received heartbeat request: %s", instruction)
+                self.heartbeat.request_full()
 
             elif instruction_type == 'sensorlist':
-                print(f"Received sensorlist instruction: {instruction}")
+                log.debug("Received sensorlist instruction: %s", instruction)
                 
-                toPair = instruction['sensors']
+                toPair = instruction.sensors
                 for sensor in toPair:
+                    self.track_attestation(sensor)
                     if not self.ble_adapter.is_device_connected(sensor['address']):
                         successPaired = await self.ble_adapter.pair_device(sensor)
 
                         if successPaired is True:
-                            print(f"Successfully paired sensor {sensor['address']}")
+                            log.info("Successfully paired sensor %s", sensor['address'])
+                            self.attestations.retry(sensor['address'])
                         else:
-                            print(f"Failed to pair sensor {sensor['address']}")
+                            log.warning("Failed to pair sensor %s", sensor['address'])
 
            
 
             else:
-                print(f"Unknown instruction type: {instruction_type}")
+                log.warning("Unknown instruction type: %s", instruction_type)
                 
         except Exception as e:
             if config.DEBUG_MODE == True:
                 raise e
             
-            print(f"Error handling pairing instruction: {e}")
+            log.error("Error handling pairing instruction: %s", e)
+
+    async def process_instruction(self, instruction: Instruction):
+        """
+        Handle an instruction taken from the queue, and record its wait and handling time.
+        """
+        instruction_type = instruction.type
+        log.info("Processing %s instruction", instruction_type)
+
+        start_time = time.monotonic()
+        if instruction.received_at is not None:
+            INSTRUCTION_WAIT_SECONDS.observe(start_time - instruction.received_at)
+
+        try:
+            await self.handle_instruction(instruction)
+        finally:
+            queue.task_done(instruction)  # Mark the instruction as processed
+
+        INSTRUCTION_DURATION_SECONDS.labels(instruction_type).observe(time.monotonic() - start_time)
+        INSTRUCTIONS_HANDLED.labels(instruction_type).inc()
+
+    async def wait_for_read_slot(self, arrivals: int, timeout: float):
+        """
+        Wait until a read slot is free or an instruction is queued after `arrivals`, at most `timeout` seconds.
+        """
+        if not self.read_slots.locked():
+            return
+        self.read_slot_freed.clear()
+        waiters = {asyncio.ensure_future(self.read_slot_freed.wait()), asyncio.ensure_future(queue.wait(timeout, arrivals))}
+        try:
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    def _read_done(self, task: asyncio.Task):
+        self.read_tasks.discard(task)
+        self.read_slots.release()
+        self.read_slot_freed.set()
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Error handling read instruction: %s", task.exception())
+
+    def report_expired_instruction(self, instruction: Instruction):
+        """
+        Tell the platform that an instruction was dropped because its deadline passed.
+        
+        Args:
+            instruction (Instruction): The expired instruction.
+        """
+        payload = {
+            'from': self.mac_address,
+            'timestamp': int(time.time()),
+            'type': "expired",
+            'instruction': instruction.type,
+        }
+        if instruction.message_id is not None:
+            payload['messageId'] = instruction.message_id
+        address = getattr(instruction, 'address', None)
+        if address:
+            payload['address'] = address
+        self.mqtt_handler.publish(json.dumps(payload))
+
+    def send_heartbeat_if_due(self):
+        """
+        Publish a full, delta or keep-alive heartbeat if one is due.
+        """
+        sensors = {address: self.ble_adapter.is_device_connected(address) for address in list(self.ble_adapter.connected_devices)}
+        if not self.heartbeat.is_due(sensors, self.atl, self.rtl):
+            return
+
+        payload = self.heartbeat.build(sensors, self.atl, self.rtl)
+        log.info("Sending %s heartbeat %s (%d sensors)", payload['mode'], payload['seq'], len(sensors))
+
+        sent_at = time.monotonic()
+        seq = payload['seq']
+        future = self.mqtt_handler.publish(json.dumps(payload), wait_for_ack=True)
+        future.add_done_callback(lambda f: self.heartbeat.on_result(
+            seq, not f.cancelled() and f.result(), time.monotonic() - sent_at))
 
     async def run(self):
         """
         Run the gateway state machine.
         """
-        print(f"Starting gateway {self.mac_address}")
+        log.info("Starting gateway %s", self.mac_address)
+        await self.ble_adapter.start()
+        self.attestation_task = asyncio.create_task(self.attestations.run())
+        self.credentials_task = asyncio.create_task(self.credentials.run())
+
+        if self.restored_sensors:
+            for profile in self.restored_sensors:
+                self.track_attestation(profile)
+            # Reconnect known sensors right away, in parallel with the MQTT connection
+            self.restore_task = asyncio.create_task(
+                self.ble_adapter.restore_devices(self.restored_sensors, config.BLE_RESTORE_CONCURRENCY))
+            self.restored_sensors = []
         
         while self.running:
             try:
+                self.save_state()
+
                 # State machine
-                if self.state == GatewayState.UNREGISTERED and self.attempts < config.MAX_REGISTRATION_ATTEMPTS:
-                    print("Gateway is unregistered. Attempting to register...")
+                if self.state == GatewayState.UNREGISTERED:
+                    log.info("Gateway is unregistered. Attempting to register...")
                     if await self.register_gateway():
+                        self.supervisor.reset()
                         self.state = GatewayState.REGISTERED
                     else:
                         # Wait before retrying registration
-                        self.attempts += 1
-                        await asyncio.sleep(10)
+                        await self.supervisor.wait()
                         
-                elif self.state == GatewayState.REGISTERED and self.attempts < config.MAX_REGISTRATION_ATTEMPTS:
-                    print("Gateway is registered. Requesting MQTT credentials...")
-                    if await self.get_mqtt_credentials():
-                        if await self.connect_mqtt():
-                            self.state = GatewayState.CONNECTED
-                        else:
-                            # Wait before retrying MQTT connection
-                            self.attempts += 1
-                            await asyncio.sleep(5)
+                elif self.state == GatewayState.REGISTERED:
+                    log.info("Gateway is registered. Connecting to MQTT...")
+                    # Cached credentials are used as long as they are valid, the server is only asked for new ones
+                    # if there are none, they expired or the broker rejected them
+                    if await self.credentials.ensure() and await self.connect_mqtt():
+                        self.supervisor.reset()
+                        self.state = GatewayState.CONNECTED
                     else:
-                        # Wait before retrying credential request
-                        self.attempts += 1
-                        await asyncio.sleep(10)
+                        # Wait before retrying credential request or MQTT connection
+                        await self.supervisor.wait()
                         
                 elif self.state == GatewayState.CONNECTED:
                     # Main operational state - periodically check MQTT connection
                     if not self.mqtt_handler.connected:
-                        print("MQTT connection lost. Reconnecting...")
-                        if not await self.connect_mqtt():
+                        # The MQTT client retries on its own with the same delay bounds,
+                        # only replace it if it is still down after the backoff
+                        log.warning("MQTT connection lost. Reconnecting...")
+                        await self.supervisor.wait()
+                        if self.mqtt_handler.connected or await self.connect_mqtt():
+                            self.supervisor.reset()
+                            # The platform may have marked the gateway offline meanwhile
+                            self.heartbeat.request_full()
+                        else:
                             # Fall back to registered state if connection fails
                             self.state = GatewayState.REGISTERED
+                            continue
 
                     if self.isFirstBoot is True:
-                        print("First boot detected. Scanning for devices...")
+                        log.info("First boot detected. Scanning for devices...")
                         payload = {
                             'from': self.mac_address,
                             'timestamp': int(time.time()),
@@ -358,66 +655,64 @@ class Gateway:
                     try:
                         # Process any events in the queue
                         while True:
-                            instruction = queue.get_nowait()
-                            print(f"Processing instruction: {instruction}")
-                            await self.handle_instruction(instruction)
-                            queue.task_done()  # Mark the instruction as processed
-                            # TODO: handle different types of instructions - rename to handle_instruction(?)
+                            arrivals = queue.arrivals
+                            # While every read slot is busy, reads stay queued instead of blocking the loop
+                            concurrent_reads = config.BLE_CONCURRENT_READS > 1
+                            held = ('read',) if concurrent_reads and self.read_slots.locked() else ()
+                            instruction = queue.get_nowait(held)
+                            if instruction.type == 'read' and concurrent_reads:
+                                # Reads of different sensors overlap, the GATT scheduler paces them
+                                await self.read_slots.acquire()  # free, checked above
+                                task = asyncio.create_task(self.process_instruction(instruction))
+                                self.read_tasks.add(task)
+                                task.add_done_callback(self._read_done)
+                            else:
+                                await self.process_instruction(instruction)
                        
                     except asyncio.QueueEmpty:
                         # nothing to process
                         pass
 
-                    if self.heartbeat_counter >= 12:  # every 1 minutes
-                        print("Sending heartbeat...")
-                        
-                        # Get connected sensors and their status
-                        sensors = []
-                        for address, client in self.ble_adapter.connected_devices.items():
-                            print(f"Checking sensor {address} connection status...")
-
-                            isPaired = self.ble_adapter.is_device_connected(address)
-                            sensors.append({
-                                "address": address,
-                                "ispaired": isPaired
-                            })
-                        
-                        payload = {
-                            'from': self.mac_address,
-                            'timestamp': int(time.time()),
-                            'type': "heartbeat",
-                            'gatewayMac': self.mac_address,
-                            'sensorlist': sensors,  # Directly include the sensor list as a JSON array
-                            'atl': self.atl,
-                            'rtl': self.rtl,
-                        }
-                        self.mqtt_handler.publish(json.dumps(payload))
-                        self.heartbeat_counter = 0
+                    self.send_heartbeat_if_due()
+
+                    if config.CLOCK_SYNC_ENABLED and self.clock.is_due():
+                        self.mqtt_handler.publish(json.dumps(self.clock.request(self.mac_address)))
                     
-                    # Main loop delay
-                    self.heartbeat_counter += 1
-                    await asyncio.sleep(5)
+                    # Until the next instruction arrives, or the next heartbeat and connection check
+                    if queue.empty():
+                        await queue.wait(5)
+                    else:
+                        await self.wait_for_read_slot(arrivals, 5)
                     
             except Exception as e:
                 if config.DEBUG_MODE:
                     raise e
-                print(f"Error in main loop: {e}")
+                log.error("Error in main loop: %s", e)
                 await asyncio.sleep(10)
                 
     def stop(self):
         """
         Stop the gateway and clean up resources.
         """
-        print("Stopping gateway...")
+        log.info("Stopping gateway...")
         self.running = False
         
         # Disconnect MQTT
         if self.mqtt_handler is not None:
             self.mqtt_handler.disconnect()
+
+        self.ble_adapter.stop()
+        if self.attestation_task is not None:
+            self.attestation_task.cancel()
+        if self.credentials_task is not None:
+            self.credentials_task.cancel()
             
-        print("Gateway stopped")
+        log.info("Gateway stopped")
 
 async def main():
+    setup_logging()
+    if config.METRICS_ENABLED:
+        metrics.start_metrics_server(config.METRICS_PORT)
     gateway = Gateway()
     
     try:
@@ -425,7 +720,7 @@ async def main():
     except Exception as e:
         if config.DEBUG_MODE:
             raise e
-        print(f"Uncaught exception: {e}")
+        log.error("Uncaught exception: %s", e)
     # finally:
     #     gateway.stop()
 
@@ -0,0 +1,360 @@
+"""
+Minimal in-process MQTT broker stand-in for benchmarks and local testing.
+Speaks enough MQTT 3.1.1 and 5.0 for the gateway: CONNECT, PUBLISH QoS 0-2, SUBSCRIBE, PING, DISCONNECT.
+Runs its own event loop in a background thread, so blocking clients in the caller's loop cannot stall it.
+"""
+
+import argparse
+import asyncio
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from logger import get_logger
+
+log = get_logger("mock_broker")
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+PROPERTY_RECEIVE_MAXIMUM = 0x21
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value % 128
+        value //= 128
+        if value:
+            byte |= 0x80
+        out.append(byte)
+        if not value:
+            return bytes(out)
+
+
+def decode_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    multiplier, value = 1, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            return value, pos
+        multiplier *= 128
+
+
+def encode_string(value: str) -> bytes:
+    raw = value.encode('utf-8')
+    return struct.pack("!H", len(raw)) + raw
+
+
+def decode_string(data: bytes, pos: int) -> Tuple[bytes, int]:
+    length, = struct.unpack_from("!H", data, pos)
+    pos += 2
+    return data[pos:pos + length], pos + length
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+    for index, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if index >= len(topic_parts):
+            return False
+        if part != '+' and part != topic_parts[index]:
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+class _Session:
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.client_id = ""
+        self.protocol = 4
+        self.subscriptions: Dict[str, Tuple[int, bool]] = {}  # filter -> (qos, no local)
+        self.next_mid = 0
+
+    def mid(self) -> int:
+        self.next_mid = self.next_mid % 65535 + 1
+        return self.next_mid
+
+    def send(self, packet_type: int, flags: int, body: bytes):
+        self.writer.write(bytes([(packet_type << 4) | flags]) + encode_varint(len(body)) + body)
+
+
+class MockBroker:
+    """
+    In-process MQTT broker.
+
+    Observers registered with `add_observer` are called on the broker thread for every
+    PUBLISH received from a client as observer(topic, payload, client_id, received_at),
+    with received_at from time.monotonic().
+    """
+    def __init__(self, receive_maximum: Optional[int] = None, ack_delay: float = 0.0,
+                 credentials: Optional[Dict[str, str]] = None):
+        """
+        Initialize the broker.
+
+        Args:
+            receive_maximum (int, optional): Receive Maximum advertised to MQTTv5 clients.
+            ack_delay (float, optional): Seconds to delay every PUBACK/PUBREC, to simulate a slow broker.
+            credentials (Dict[str, str], optional): username -> password. None accepts everyone.
+        """
+        self.receive_maximum = receive_maximum
+        self.ack_delay = ack_delay
+        self.credentials = credentials
+
+        self.host = "127.0.0.1"
+        self.port = 0
+        self.sessions: List[_Session] = []
+        self.received = 0
+        self._observers: List[Callable[[str, bytes, str, float], None]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def add_observer(self, observer: Callable[[str, bytes, str, float], None]):
+        self._observers.append(observer)
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """
+        Start the broker on a background thread.
+
+        Args:
+            host (str, optional): Address to bind.
+            port (int, optional): Port to bind, 0 picks a free port.
+
+        Returns:
+            int: The port the broker listens on.
+        """
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle_client, host, port))
+            self.host = host
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="mock-broker", daemon=True)
+        self._thread.start()
+        started.wait()
+        log.info("Mock broker listening on %s:%s", host, self.port)
+        return self.port
+
+    def stop(self):
+        if self._loop is not None:
+            for session in list(self.sessions):
+                self._loop.call_soon_threadsafe(session.writer.close)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+
+    def publish(self, topic: str, payload: bytes, qos: int = 0):
+        """
+        Publish a message to subscribed clients, as if the platform sent it. Thread-safe.
+        """
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self._loop.call_soon_threadsafe(self._route, topic, payload, qos, None, b"")
+
+    def drop_clients(self):
+        """
+        Close every client connection, to simulate a broker outage. Thread-safe.
+        """
+        for session in list(self.sessions):
+            self._loop.call_soon_threadsafe(session.writer.close)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = _Session(writer)
+        try:
+            while True:
+                first = await reader.readexactly(1)
+                length, multiplier = 0, 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length) if length else b""
+
+                packet_type, flags = first[0] >> 4, first[0] & 0x0F
+                if not self._handle_packet(session, packet_type, flags, body):
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if session in self.sessions:
+                self.sessions.remove(session)
+            writer.close()
+
+    def _handle_packet(self, session: _Session, packet_type: int, flags: int, body: bytes) -> bool:
+        if packet_type == CONNECT:
+            return self._handle_connect(session, body)
+        elif packet_type == PUBLISH:
+            self._handle_publish(session, flags, body)
+        elif packet_type == PUBREL:
+            session.send(PUBCOMP, 0, body[:2])
+        elif packet_type == SUBSCRIBE:
+            self._handle_subscribe(session, body)
+        elif packet_type == UNSUBSCRIBE:
+            self._handle_unsubscribe(session, body)
+        elif packet_type == PINGREQ:
+            session.send(PINGRESP, 0, b"")
+        elif packet_type == DISCONNECT:
+            return False
+        # PUBACK/PUBREC/PUBCOMP from subscribers need no bookkeeping here
+        return True
+
+    def _handle_connect(self, session: _Session, body: bytes) -> bool:
+        _, pos = decode_string(body, 0)
+        session.protocol = body[pos]
+        connect_flags = body[pos + 1]
+        pos += 4  # level, flags, keep alive
+        if session.protocol == 5:
+            props_len, pos = decode_varint(body, pos)
+            pos += props_len
+
+        client_id, pos = decode_string(body, pos)
+        session.client_id = client_id.decode('utf-8', 'replace')
+        if connect_flags & 0x04:  # will
+            if session.protocol == 5:
+                props_len, pos = decode_varint(body, pos)
+                pos += props_len
+            _, pos = decode_string(body, pos)
+            _, pos = decode_string(body, pos)
+        username = password = None
+        if connect_flags & 0x80:
+            username, pos = decode_string(body, pos)
+            username = username.decode('utf-8', 'replace')
+        if connect_flags & 0x40:
+            password, pos = decode_string(body, pos)
+            password = password.decode('utf-8', 'replace')
+
+        accepted = self.credentials is None or self.credentials.get(username) == password
+        if session.protocol == 5:
+            properties = b""
+            if self.receive_maximum:
+                properties += bytes([PROPERTY_RECEIVE_MAXIMUM]) + struct.pack("!H", self.receive_maximum)
+            reason = 0x00 if accepted else 0x87  # Not authorized
+            session.send(CONNACK, 0, bytes([0, reason]) + encode_varint(len(properties)) + properties)
+        else:
+            session.send(CONNACK, 0, bytes([0, 0x00 if accepted else 0x05]))
+
+        if accepted:
+            self.sessions.append(session)
+        return accepted
+
+    def _handle_publish(self, session: _Session, flags: int, body: bytes):
+        received_at = time.monotonic()
+        qos = (flags >> 1) & 0x03
+        topic, pos = decode_string(body, 0)
+        mid = None
+        if qos:
+            mid, = struct.unpack_from("!H", body, pos)
+            pos += 2
+        properties = b""
+        if session.protocol == 5:
+            props_start = pos
+            props_len, pos = decode_varint(body, pos)
+            pos += props_len
+            properties = body[props_start:pos]
+        payload = body[pos:]
+        topic = topic.decode('utf-8', 'replace')
+
+        self.received += 1
+        for observer in self._observers:
+            observer(topic, payload, session.client_id, received_at)
+        self._route(topic, payload, qos, session, properties)
+
+        if qos:
+            ack_type = PUBACK if qos == 1 else PUBREC
+            if self.ack_delay:
+                self._loop.call_later(self.ack_delay, self._send_ack, session, ack_type, mid)
+            else:
+                self._send_ack(session, ack_type, mid)
+
+    def _send_ack(self, session: _Session, ack_type: int, mid: int):
+        if not session.writer.is_closing():
+            session.send(ack_type, 0, struct.pack("!H", mid))
+
+    def _route(self, topic: str, payload: bytes, qos: int, sender: Optional[_Session], properties: bytes):
+        for session in self.sessions:
+            for topic_filter, (sub_qos, no_local) in session.subscriptions.items():
+                if no_local and session is sender:
+                    continue
+                if topic_matches(topic_filter, topic):
+                    self._deliver(session, topic, payload, min(qos, sub_qos), properties)
+                    break
+
+    def _deliver(self, session: _Session, topic: str, payload: bytes, qos: int, properties: bytes):
+        body = encode_string(topic)
+        if qos:
+            body += struct.pack("!H", session.mid())
+        if session.protocol == 5:
+            body += properties or b"\x00"
+        if not session.writer.is_closing():
+            session.send(PUBLISH, qos << 1, body + payload)
+
+    def _handle_subscribe(self, session: _Session, body: bytes):
+        mid = body[:2]
+        pos = 2
+        if session.protocol == 5:
+            props_len, pos = decode_varint(body, pos)
+            pos += props_len
+        granted = bytearray()
+        while pos < len(body):
+            topic_filter, pos = decode_string(body, pos)
+            options = body[pos]
+            pos += 1
+            qos = min(options & 0x03, 1)
+            no_local = session.protocol == 5 and bool(options & 0x04)
+            session.subscriptions[topic_filter.decode('utf-8', 'replace')] = (qos, no_local)
+            granted.append(qos)
+        if session.protocol == 5:
+            session.send(SUBACK, 0, mid + b"\x00" + bytes(granted))
+        else:
+            session.send(SUBACK, 0, mid + bytes(granted))
+
+    def _handle_unsubscribe(self, session: _Session, body: bytes):
+        mid = body[:2]
+        pos = 2
+        if session.protocol == 5:
+            props_len, pos = decode_varint(body, pos)
+            pos += props_len
+        count = 0
+        while pos < len(body):
+            topic_filter, pos = decode_string(body, pos)
+            session.subscriptions.pop(topic_filter.decode('utf-8', 'replace'), None)
+            count += 1
+        if session.protocol == 5:
+            session.send(UNSUBACK, 0, mid + b"\x00" + bytes(count))
+        else:
+            session.send(UNSUBACK, 0, mid)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the mock MQTT broker in the foreground.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--receive-maximum", type=int, default=None, help="Receive Maximum advertised to MQTTv5 clients.")
+    parser.add_argument("--ack-delay", type=float, default=0.0, help="Seconds to delay every PUBACK.")
+    arguments = parser.parse_args()
+
+    from logger import setup_logging
+    setup_logging()
+    broker = MockBroker(receive_maximum=arguments.receive_maximum, ack_delay=arguments.ack_delay)
+    broker.start(arguments.host, arguments.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        broker.stop()
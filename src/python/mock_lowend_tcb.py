@@ -1,3 +1,16 @@
+"""
+Mock TCB for low-end device verification and conformity certificates.
+Key material, HMAC state and certificates are prepared once at start, so a request only hashes its nonce.
+/lowenddevice_verification_batch signs the nonces of many devices in one request.
+
+Run with waitress (threaded production WSGI server) when it is installed, else the threaded Flask server:
+    python3 mock_lowend_tcb.py --port 8000 --threads 16 --no-timing
+or with any WSGI server, e.g.:
+    gunicorn -w 4 -b 0.0.0.0:8000 mock_lowend_tcb:app
+Load test it with benchmark_tcb.py.
+"""
+
+import argparse
 import hashlib
 import json
 import hmac
@@ -19,51 +32,117 @@ keys = {
     '8': 'be95f803d250c1681af8a35db71d99d621d56e92967a956fa13a1e9336df0abd'
 }
 # Static conformity certificate structure
-conformity_certificate_template = {   
+conformity_certificate_template = {
     "device_id": "LOWEND_1",
     "domain_id": "QUBITECH",
     "integrity": "1",
     "access_control": "1"
                                    }
 
+PRINT_TIMING = True  # One timing line per request, --no-timing turns it off for load tests
+BATCH_MAX_DEVICES = 1000  # Largest batch /lowenddevice_verification_batch accepts
 
-def hash_with_key(data, key, data_is_hex):
-    """Hash the data with the provided key using HMAC-SHA256."""
-    key_bytes = bytes.fromhex(key)
+# Keyed HMAC-SHA256 objects per key index, copied for every request instead of decoding the key and
+# running the key schedule again
+prepared_hmacs = {key_index: hmac.new(bytes.fromhex(key), digestmod=hashlib.sha256) for key_index, key in keys.items()}
+
+
+def hash_with_key(data, key_index, data_is_hex):
+    """Hash the data with the key of key_index using HMAC-SHA256."""
     if data_is_hex:
         data_bytes = bytes.fromhex(data)
     else:
         data_bytes = data.encode('utf-8')
 
-    hmac_result = hmac.new(key_bytes,data_bytes, hashlib.sha256)
+    hmac_result = prepared_hmacs[key_index].copy()
+    hmac_result.update(data_bytes)
     return hmac_result.hexdigest()
 
+
+def certificate_prefix_hex(key_index):
+    """
+    Hex of the certificate response up to the UID, which is all that differs between requests.
+    The certificate and its signature only depend on the key.
+    """
+    conformity_certificate_json = json.dumps(conformity_certificate_template)
+    # Generate the conformity certificate HMAC without nonce
+    conformity_certificate_hmac = hash_with_key(conformity_certificate_json, key_index, data_is_hex = False)
+
+    cc_data = {
+        "cc": conformity_certificate_template,
+        "evidence": {
+            "signature": conformity_certificate_hmac,
+            "uid": None
+        }
+    }
+    cc_json = json.dumps(cc_data)
+    # json.dumps ends the document with the uid value and two closing braces
+    return cc_json[:-len('null}}')].encode('utf-8').hex()
+
+
+certificate_prefixes = {key_index: certificate_prefix_hex(key_index) for key_index in keys}
+
+
 @app.route('/lowenddevice_verification', methods=['POST'])
 def lowenddevice_verification():
     try:
         verify_start =time.time()
-        data = request.json
-        nonce = data.get('nonce')
-        uid = data.get('uid')
+        # Same checks as a batch entry, a bad UID or nonce is the client's error
+        result = sign_device(request.json)
+        if 'error' in result:
+            return jsonify({'error': result['error']}), 400
+        signed_nonce = result['signednonce']
+        if PRINT_TIMING:
+            verify_end =time.time()
+            print("[TIMING] DEVICE VERIFICATION = ", verify_end-verify_start)
 
-        if not nonce or not uid:
-            return jsonify({'error': 'Nonce or UID missing'}), 400
+        # Respond with the signed nonce
+        return jsonify({'signednonce': signed_nonce}), 200
 
-        # Determine the key based on the first character of the UID
-        key_index = uid[0]
-        key = keys.get(key_index)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        if not key:
-            return jsonify({'error': 'Invalid UID format'}), 400
 
+def sign_device(device):
+    """Signed nonce of one {uid, nonce} entry of a batch, or the error the single endpoint would give."""
+    if not isinstance(device, dict):
+        return {'error': 'Device must be an object'}
+    nonce = device.get('nonce')
+    uid = device.get('uid')
+    if not nonce or not uid:
+        return {'uid': uid, 'error': 'Nonce or UID missing'}
+    if not isinstance(uid, str) or uid[0] not in prepared_hmacs:
+        return {'uid': uid, 'error': 'Invalid UID format'}
+    try:
+        return {'uid': uid, 'signednonce': hash_with_key(nonce, uid[0], data_is_hex = True)}
+    except (ValueError, TypeError) as e:
+        return {'uid': uid, 'error': str(e)}
+
+
+@app.route('/lowenddevice_verification_batch', methods=['POST'])
+def lowenddevice_verification_batch():
+    """
+    Signs the nonces of many devices in one request.
+    Takes [{"uid": ..., "nonce": ...}, ...] (or {"devices": [...]}) and returns {"results": [...]} in the
+    same order, each {"uid", "signednonce"} or {"uid", "error"}. One bad entry does not fail the others.
+    """
+    try:
+        batch_start =time.time()
+        data = request.json
+        devices = data.get('devices') if isinstance(data, dict) else data
 
-        # Generate the signed nonce
-        signed_nonce = hash_with_key(nonce, key, data_is_hex = True)
-        verify_end =time.time()
-        print("[TIMING] DEVICE VERIFICATION = ", verify_end-verify_start)
+        if not isinstance(devices, list):
+            return jsonify({'error': 'Expected a list of devices'}), 400
+        if len(devices) > BATCH_MAX_DEVICES:
+            return jsonify({'error': f'At most {BATCH_MAX_DEVICES} devices per batch'}), 413
 
-        # Respond with the signed nonce
-        return jsonify({'signednonce': signed_nonce}), 200
+        # Signed in the request thread: a 32-byte HMAC is too short to gain from other threads under the GIL
+        results = [sign_device(device) for device in devices]
+        if PRINT_TIMING:
+            batch_end =time.time()
+            print("[TIMING] BATCH DEVICE VERIFICATION (%d) = " % len(devices), batch_end-batch_start)
+
+        return jsonify({'results': results}), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -76,40 +155,46 @@ def lowenddevice_cc():
         data = request.json
         uid = data.get('uid')
 
-        if not uid:
+        if not uid or not isinstance(uid, str):
             return jsonify({'error': 'UID missing'}), 400
 
         # Determine the key based on the first character of the UID
         key_index = uid[0]
-        key = keys.get(key_index)
 
-        if not key:
+        if key_index not in certificate_prefixes:
             return jsonify({'error': 'Invalid UID format'}), 400
 
-        conformity_certificate_json = json.dumps(conformity_certificate_template)
-        # Generate the conformity certificate HMAC without nonce
-        conformity_certificate_hmac = hash_with_key(conformity_certificate_json, key, data_is_hex = False)
-
-        # Format the JSON data to include conformity certificate and UID
-        cc_data = {
-            "cc": conformity_certificate_template,
-            "evidence": {
-                "signature": conformity_certificate_hmac,
-                "uid": uid
-            }
-        }
-        cc_json_bytes = json.dumps(cc_data).encode('utf-8')
-        
+        # Same bytes as json.dumps({"cc": ..., "evidence": {"signature": ..., "uid": uid}}), hex encoded
         response_data = {
-            "conformity_certificate" : cc_json_bytes.hex()
+            "conformity_certificate" : certificate_prefixes[key_index] + (json.dumps(uid) + '}}').encode('utf-8').hex()
         }
-        cc_end =time.time()
-        print("[TIMING] CONFORMITY CERTIFICATE = ", cc_end-cc_start)
+        if PRINT_TIMING:
+            cc_end =time.time()
+            print("[TIMING] CONFORMITY CERTIFICATE = ", cc_end-cc_start)
 
         return jsonify(response_data), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+
+def serve(host, port, threads):
+    try:
+        from waitress import serve as waitress_serve  # Optional, production WSGI server
+    except ImportError:
+        print("waitress is not installed, using the threaded Flask server")
+        app.run(host=host, port=port, threaded=True)
+    else:
+        waitress_serve(app, host=host, port=port, threads=threads)
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000)
+    parser = argparse.ArgumentParser(description="Mock TCB for low-end device verification.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--threads", type=int, default=16, help="Worker threads of the waitress server.")
+    parser.add_argument("--no-timing", action="store_true", help="Do not print a timing line per request.")
+    arguments = parser.parse_args()
+
+    PRINT_TIMING = not arguments.no_timing
+    serve(arguments.host, arguments.port, arguments.threads)
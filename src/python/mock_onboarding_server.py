@@ -0,0 +1,197 @@
+"""
+Minimal onboarding server stand-in for benchmarks and local testing.
+Answers /register, /getCredentials and /wipe like the platform's onboarding server, and hands the MQTT
+credentials it issues to a MockBroker, so gateways can connect with them.
+Runs its own event loop in a background thread, like mock_broker.py.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import secrets
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+from logger import get_logger
+
+log = get_logger("mock_onboarding")
+
+_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 503: "Service Unavailable"}
+
+
+def parse_query(query: str) -> Dict[str, str]:
+    """
+    Query parameters, separated by '&' or ';' (the wipe URL of the gateway uses ';').
+    """
+    params = {}
+    for item in query.replace(';', '&').split('&'):
+        name, _, value = item.partition('=')
+        if name:
+            params[unquote(name)] = unquote(value)
+    return params
+
+
+class MockOnboardingServer:
+    """
+    In-process onboarding server.
+
+    GET /register?macAddress=M                -> {"secret"}
+    GET /getCredentials?macAddress=M&secret=S -> {"username", "password"}, 401 for a wrong secret
+    GET /wipe?macAddress=M;onlydb=True        -> forgets the gateway and its credentials
+
+    Every request takes `latency` seconds of simulated server work, at most `concurrency`
+    requests work at once (the server's worker pool), and `failure_rate` of them answer 503.
+    Issued credentials are kept in `credentials` (username -> password); pass the same dict
+    to MockBroker(credentials=...) so the broker accepts exactly the onboarded gateways.
+    """
+    def __init__(self, latency: float = 0.0, concurrency: Optional[int] = None, failure_rate: float = 0.0,
+                 credentials: Optional[Dict[str, str]] = None, seed: Optional[int] = None):
+        """
+        Initialize the server.
+
+        Args:
+            latency (float, optional): Seconds of work per request.
+            concurrency (int, optional): Requests worked on at once, None for no limit.
+            failure_rate (float, optional): Share of requests answered with 503.
+            credentials (Dict[str, str], optional): username -> password of issued MQTT credentials.
+            seed (int, optional): Seed for the failure injection.
+        """
+        self.latency = latency
+        self.concurrency = concurrency
+        self.failure_rate = failure_rate
+        self.credentials = credentials if credentials is not None else {}
+        self.secrets: Dict[str, str] = {}  # MAC address -> secret of registered gateways
+        self.stats = {'requests': 0, 'injected_failures': 0}
+
+        self.host = "127.0.0.1"
+        self.port = 0
+        self._random = random.Random(seed)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """
+        Start the server on a background thread.
+
+        Returns:
+            int: The port the server listens on.
+        """
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            if self.concurrency:
+                self._slots = asyncio.Semaphore(self.concurrency)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle_client, host, port, backlog=1024))
+            self.host = host
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="mock-onboarding", daemon=True)
+        self._thread.start()
+        started.wait()
+        log.info("Mock onboarding server listening on %s:%s", host, self.port)
+        return self.port
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                keep_alive = True
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'connection' and value.strip().lower() == 'close':
+                        keep_alive = False
+
+                parts = request_line.decode('latin-1').split()
+                status, body = await self._respond(parts[1] if len(parts) > 1 else "/")
+                payload = json.dumps(body).encode('utf-8')
+                writer.write(f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+                             f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, target: str) -> Tuple[int, Dict]:
+        self.stats['requests'] += 1
+        url = urlsplit(target)
+        params = parse_query(url.query)
+        if self._slots is not None:
+            async with self._slots:
+                return await self._work(url.path, params)
+        return await self._work(url.path, params)
+
+    async def _work(self, path: str, params: Dict[str, str]) -> Tuple[int, Dict]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            self.stats['injected_failures'] += 1
+            return 503, {'error': "Injected failure"}
+
+        mac = params.get('macAddress')
+        if path not in ('/register', '/getCredentials', '/wipe'):
+            return 404, {'error': "Unknown endpoint"}
+        if not mac:
+            return 400, {'error': "macAddress missing"}
+
+        if path == '/register':
+            secret = self.secrets.setdefault(mac, secrets.token_hex(8))
+            return 200, {'secret': secret}
+        if path == '/getCredentials':
+            if self.secrets.get(mac) is None or params.get('secret') != self.secrets[mac]:
+                return 401, {'error': "Unknown gateway or wrong secret"}
+            password = self.credentials.setdefault(mac, secrets.token_hex(8))
+            return 200, {'username': mac, 'password': password}
+        self.secrets.pop(mac, None)
+        self.credentials.pop(mac, None)
+        return 200, {'wiped': mac}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the mock onboarding server in the foreground.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3010)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of work per request.")
+    parser.add_argument("--concurrency", type=int, default=None, help="Requests worked on at once.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of requests answered with 503.")
+    arguments = parser.parse_args()
+
+    from logger import setup_logging
+    setup_logging()
+    server = MockOnboardingServer(arguments.latency, arguments.concurrency, arguments.failure_rate)
+    server.start(arguments.host, arguments.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
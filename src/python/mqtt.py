@@ -1,6 +1,7 @@
 import paho.mqtt.client as mqtt
 import time
 from config import mqtt_hostname, mqtt_port
+from ConnectionSupervisor import ConnectionSupervisor
 
 class MQTTClient:
     def __init__(self, sensorMacAddress: str):
@@ -13,6 +14,10 @@ class MQTTClient:
         self._keep_alive = 60
         self._text_file = "attached_sensors.txt"
         
+        # Reconnects are done by the paho network thread, spaced out by the supervisor's delays
+        self._supervisor = ConnectionSupervisor()
+        self._supervisor.apply_to(self._client)
+        
         # Set up callbacks
         self._client.on_connect = self.on_connect
         self._client.on_disconnect = self.on_disconnect
@@ -22,30 +27,30 @@ class MQTTClient:
         print(f"Connecting to MQTT broker at {self._broker_address}:{self._broker_port}...")
         print(f"Connecting to MQTT broker, username {self._username}:{self._password}...")
         self._client.username_pw_set(self._username, self._password)
-        try:
-            self._client.connect(self._broker_address, self._broker_port, self._keep_alive)
-            print('Successfully called client.connect')
-            self._client.loop_start()  # Start the loop to process network traffic and dispatch callbacks
-        except Exception as e:
-            print(f"Connection failed: {e}. Retrying in 30 seconds...")
-            time.sleep(30)
-            self.connect()
+        while True:
+            try:
+                self._client.connect(self._broker_address, self._broker_port, self._keep_alive)
+                print('Successfully called client.connect')
+                self._client.loop_start()  # Start the loop to process network traffic and dispatch callbacks
+                return
+            except Exception as e:
+                delay = self._supervisor.next_delay()
+                print(f"Connection failed: {e}. Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             print("Connected to MQTT broker successfully.")
+            self._supervisor.reset()
             self._client.subscribe(self._topic)
             print(f"Subscribed to topic '{self._topic}'")
         else:
-            print(f"Failed to connect, return code {rc}. Retrying in 30 seconds...")
-            time.sleep(30)
-            self.connect()
+            # Sleeping here would block the network thread, the client loop retries with backoff
+            print(f"Failed to connect, return code {rc}. Retrying...")
 
     def on_disconnect(self, client, userdata, rc):
         if rc != 0:
-            print("Unexpected disconnection. Reconnecting in 30 seconds...")
-            time.sleep(30)
-            self.connect()
+            print("Unexpected disconnection. Reconnecting...")
 
     def on_message(self, client, userdata, msg):
         message = msg.payload.decode()
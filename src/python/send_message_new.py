@@ -5,6 +5,7 @@ from pathlib import Path
 import config
 from bluetooth import BluetoothAdapterFactory
 from MqttHandler import MqttHandler
+from logger import setup_logging
 
 
 def read_text_file(path: Path, fallback: str = "") -> str:
@@ -14,6 +15,7 @@ def read_text_file(path: Path, fallback: str = "") -> str:
 
 
 async def main(send_once: bool, interval: float, value: str):
+    setup_logging()
     base_dir = Path(__file__).resolve().parent
     sensor_mac = read_text_file(base_dir / "mock_mac.txt", "MOCK_SENSOR")
     gateway_mac = config.GATEWAY_MAC
@@ -28,6 +30,8 @@ async def main(send_once: bool, interval: float, value: str):
         config.MQTT_BROKER,
         config.MQTT_PORT,
         config.MQTT_KEEPALIVE,
+        protocol=config.MQTT_PROTOCOL_VERSION,
+        max_inflight=config.MQTT_MAX_INFLIGHT,
     )
     mqtt_handler.set_credentials(gateway_mac, config.MOCK_PASSWORD)
     mqtt_handler.set_auto_subscribe_on_connect(False)
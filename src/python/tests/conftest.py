@@ -0,0 +1,8 @@
+"""
+The gateway modules are imported by name from src/python, as main.py does.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
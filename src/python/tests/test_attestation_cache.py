@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import hmac
+import json
+
+import pytest
+
+from AttestationCache import AttestationCache
+from TcbClient import TcbClient, TcbError
+
+KEYS = {'1': bytes(range(32)), '2': bytes(range(32, 64))}  # first character of the UID -> device key
+CERTIFICATE = {"cc": {"integrity": "0.9", "access_control": "1"}, "evidence": {"signature": "ab"}}
+
+
+def sign(uid: str, nonce: str) -> str:
+    return hmac.new(KEYS[uid[0]], bytes.fromhex(nonce), hashlib.sha256).hexdigest()
+
+
+class FakeTcb(TcbClient):
+    """
+    TcbClient answering like mock_lowend_tcb.py, without HTTP.
+    """
+    def __init__(self):
+        super().__init__("http://tcb", batch_delay=0.01)
+        self.requests = []  # (endpoint, body)
+
+    def _post(self, endpoint, path, body):
+        self.requests.append((endpoint, body))
+        if endpoint == "cc":
+            certificate = dict(CERTIFICATE, evidence=dict(CERTIFICATE['evidence'], uid=body['uid']))
+            return {'conformity_certificate': json.dumps(certificate).encode().hex()}
+        return {'results': [{'uid': device['uid'], 'signednonce': sign(device['uid'], device['nonce'])}
+                            if device['uid'][0] in KEYS else {'uid': device['uid'], 'error': 'Invalid UID format'}
+                            for device in body]}
+
+
+class Devices:
+    """
+    Challenge callable of connected devices, each answering with the key of its UID.
+    """
+    def __init__(self, uids):
+        self.uids = dict(uids)  # address -> UID whose key the device holds
+        self.challenges = 0
+
+    async def __call__(self, address, nonce):
+        self.challenges += 1
+        uid = self.uids.get(address)
+        return sign(uid, nonce) if uid is not None else None
+
+
+def test_attested_devices_share_one_batch_and_fetch_the_certificate_once():
+    async def scenario():
+        tcb = FakeTcb()
+        devices = Devices({'AA': '1aa', 'BB': '2bb', 'CC': '1cc'})
+        cache = AttestationCache(tcb, devices, ttl=1.0, refresh_ahead=0.8)
+        for address, uid in devices.uids.items():
+            cache.track(address, uid)
+        task = asyncio.create_task(cache.run())
+        await asyncio.sleep(0.3)  # attested, and refreshed once after 0.2 s
+        task.cancel()
+        return tcb, devices, cache
+
+    tcb, devices, cache = asyncio.run(scenario())
+    assert {address: cache.trust_level(address) for address in devices.uids} == {'AA': 0.9, 'BB': 0.9, 'CC': 0.9}
+    endpoints = [endpoint for endpoint, _ in tcb.requests]
+    assert endpoints.count("cc") == 3
+    assert endpoints.count("verification_batch") == 2
+    assert all(len(body) == 3 for endpoint, body in tcb.requests if endpoint == "verification_batch")
+    assert devices.challenges == 6
+
+
+def test_wrong_signature_revokes():
+    async def scenario():
+        devices = Devices({'AA': '1aa'})
+        cache = AttestationCache(FakeTcb(), devices, retry_delay=60)
+        cache.track('AA', '1aa')
+        assert await cache.attest('AA') is not None
+        devices.uids['AA'] = '2aa'  # another key than the TCB has for 1aa
+        assert await cache.attest('AA') is None
+        return cache
+
+    cache = asyncio.run(scenario())
+    assert cache.trust_level('AA') is None
+    assert 'AA' in cache._retry_at
+
+
+def test_refused_device_is_not_attested():
+    async def scenario():
+        cache = AttestationCache(FakeTcb(), Devices({'AA': '9aa'}))
+        cache.track('AA', '9aa')
+        return await cache.attest('AA')
+
+    assert asyncio.run(scenario()) is None
+
+
+@pytest.mark.parametrize("error", [TcbError("unreachable"), ValueError("Expecting value"), KeyError("conformity_certificate")])
+def test_failed_tcb_request_is_retried_later(error):
+    class BrokenTcb(FakeTcb):
+        async def conformity_certificate(self, uid):
+            self.requests.append(("cc", uid))
+            raise error
+
+    async def scenario():
+        tcb = BrokenTcb()
+        cache = AttestationCache(tcb, Devices({'AA': '1aa'}), retry_delay=60)
+        cache.track('AA', '1aa')
+        task = asyncio.create_task(cache.run())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        return tcb, cache
+
+    tcb, cache = asyncio.run(scenario())
+    assert len(tcb.requests) == 1  # not asked again before retry_delay
+    assert 'AA' in cache._retry_at
+
+
+def test_unanswered_challenge_keeps_the_current_attestation():
+    async def scenario():
+        devices = Devices({'AA': '1aa'})
+        cache = AttestationCache(FakeTcb(), devices)
+        cache.track('AA', '1aa')
+        first = await cache.attest('AA')
+        del devices.uids['AA']  # disconnected
+        assert await cache.attest('AA') is None
+        return first, cache
+
+    first, cache = asyncio.run(scenario())
+    assert cache.entries['AA'] is first
+    assert cache.trust_level('AA') == 0.9
+    cache.retry('AA')
+    assert 'AA' not in cache._retry_at
@@ -0,0 +1,108 @@
+import pytest
+
+import ClockSync as clock_sync
+from ClockSync import ClockSync
+
+PLATFORM_AHEAD = 2.0  # platform clock - gateway clock, seconds
+
+
+class FakeTime:
+    """
+    Stands in for the time module: a gateway whose wall clock is 1000 s ahead of its monotonic clock.
+    """
+    def __init__(self):
+        self.now = 50.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now + 1000.0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(clock_sync, "time", fake)
+    return fake
+
+
+def exchange(sync, clock, uplink, downlink, processing=0.01):
+    """
+    One request and response over a link with the given one-way delays.
+    """
+    request = sync.request("aa:bb:cc:dd:ee:ff")
+    clock.now += uplink
+    t1 = clock.time() + PLATFORM_AHEAD
+    clock.now += processing
+    t2 = clock.time() + PLATFORM_AHEAD
+    clock.now += downlink
+    assert sync.on_response(request['requestId'], t1, t2)
+    return request
+
+
+def test_offset_and_delay_of_a_symmetric_exchange(clock):
+    sync = ClockSync()
+    request = exchange(sync, clock, 0.05, 0.05)
+
+    assert request['type'] == "timesync" and request['t0'] == 1050.0
+    assert sync.synced
+    assert sync.offset == pytest.approx(PLATFORM_AHEAD)
+    assert sync.delay == pytest.approx(0.1)
+    assert sync.wall_time(clock.now - 1.0) == pytest.approx(clock.time() - 1.0 + PLATFORM_AHEAD)
+
+
+def test_lowest_delay_sample_of_the_recent_ones_is_used(clock):
+    sync = ClockSync(samples=3)
+    exchange(sync, clock, 0.4, 0.01)  # queued on the way up: offset off by almost 0.2 s
+    assert sync.offset == pytest.approx(PLATFORM_AHEAD + 0.195)
+
+    exchange(sync, clock, 0.01, 0.01)
+    exchange(sync, clock, 0.01, 0.6)  # queued on the way down
+    assert sync.delay == pytest.approx(0.02)
+    assert sync.offset == pytest.approx(PLATFORM_AHEAD)
+
+    # The good sample drops out of the window of 3
+    exchange(sync, clock, 0.1, 0.2)
+    exchange(sync, clock, 0.2, 0.1)
+    assert sync.delay == pytest.approx(0.3)
+    assert sync.offset in (pytest.approx(PLATFORM_AHEAD - 0.05), pytest.approx(PLATFORM_AHEAD + 0.05))
+
+
+def test_unknown_and_forgotten_responses_are_ignored(clock):
+    sync = ClockSync(request_timeout=30)
+    first = sync.request("aa:bb:cc:dd:ee:ff")
+    clock.now += 31
+    sync.request("aa:bb:cc:dd:ee:ff")  # forgets the first one
+
+    assert not sync.on_response(first['requestId'], 0.0, 0.0)
+    assert not sync.on_response("nope", 0.0, 0.0)
+    assert not sync.synced
+
+
+def test_unanswered_requests_back_off_then_stop(clock):
+    sync = ClockSync(interval=300, request_timeout=10, max_unanswered=3)
+    gaps = []
+    last = clock.now
+    while not sync.stopped and clock.now < last + 1000:
+        if sync.is_due():
+            sync.request("aa:bb:cc:dd:ee:ff")
+            gaps.append(clock.now - last)
+            last = clock.now
+        clock.now += 1
+
+    assert gaps == [0, 10, 20]
+    assert sync.stopped and not sync.is_due()
+
+
+def test_answer_resets_the_backoff(clock):
+    sync = ClockSync(interval=300, request_timeout=10)
+    sync.request("aa:bb:cc:dd:ee:ff")
+    clock.now += 10
+    assert sync.is_due()
+    exchange(sync, clock, 0.05, 0.05)
+
+    clock.now += 299
+    assert not sync.is_due()
+    clock.now += 1
+    assert sync.is_due()
@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+from CredentialManager import CredentialManager
+
+
+class Server:
+    """
+    Fetch callable of an onboarding server handing out numbered credentials.
+    """
+    def __init__(self, expires_in=None, delay=0.0):
+        self.manager = None
+        self.expires_in = expires_in
+        self.delay = delay
+        self.fetches = 0
+        self.failing = False
+
+    async def __call__(self):
+        self.fetches += 1
+        await asyncio.sleep(self.delay)
+        if self.failing:
+            return False
+        self.manager.set(f"user{self.fetches}", f"password{self.fetches}", expires_in=self.expires_in)
+        return True
+
+
+def manager_for(server, **options):
+    manager = CredentialManager(server, **options)
+    server.manager = manager
+    return manager
+
+
+def test_cached_credentials_are_reused_until_rejected():
+    async def scenario():
+        server = Server()
+        manager = manager_for(server)
+        changes = []
+        manager.add_listener(lambda username, password: changes.append(username))
+
+        assert await manager.ensure()
+        assert all([await manager.ensure() for _ in range(3)])  # reconnects
+        assert server.fetches == 1
+
+        manager.reject()
+        assert not manager.valid
+        # Several connection attempts at once share one request
+        assert all(await asyncio.gather(manager.ensure(), manager.ensure()))
+        return server, manager, changes
+
+    server, manager, changes = asyncio.run(scenario())
+    assert server.fetches == 2
+    assert changes == ["user1", "user2"]
+    assert manager.valid and not manager.rejected
+    assert manager.username == "user2"
+
+
+def test_expired_credentials_are_fetched_again():
+    async def scenario():
+        server = Server()
+        manager = manager_for(server)
+        manager.set("saved", "password", expires_at=time.time() - 1)  # from the state snapshot
+        assert await manager.ensure()
+        return server, manager
+
+    server, manager = asyncio.run(scenario())
+    assert server.fetches == 1
+    assert manager.username == "user1"
+
+
+def test_credentials_are_refreshed_ahead_of_expiry():
+    async def scenario():
+        server = Server(expires_in=1.0)
+        manager = manager_for(server, refresh_ahead=0.8, retry_delay=60)
+        assert await manager.ensure()
+        task = asyncio.create_task(manager.run())
+        await asyncio.sleep(0.1)
+        before = server.fetches
+        await asyncio.sleep(0.2)  # refreshed 0.2 s after the first fetch
+        task.cancel()
+        return before, server, manager
+
+    before, server, manager = asyncio.run(scenario())
+    assert before == 1
+    assert server.fetches == 2
+    assert manager.username == "user2" and manager.valid
+
+
+def test_failed_refresh_keeps_the_credentials_and_waits_before_retrying():
+    async def scenario():
+        server = Server(expires_in=10.0)
+        manager = manager_for(server, refresh_ahead=10.0, retry_delay=0.2)  # due at once
+        assert await manager.ensure()
+        server.failing = True
+        task = asyncio.create_task(manager.run())
+        await asyncio.sleep(0.3)
+        failed = server.fetches
+        assert manager.username == "user1" and manager.valid  # still used for reconnects
+        server.failing, server.expires_in = False, 60.0
+        await asyncio.sleep(0.2)
+        task.cancel()
+        return failed, server, manager
+
+    failed, server, manager = asyncio.run(scenario())
+    assert failed == 3  # the first refresh, and one retry after retry_delay
+    assert server.fetches == 4
+    assert manager.username == "user4" and manager.valid
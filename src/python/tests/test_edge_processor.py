@@ -0,0 +1,53 @@
+import struct
+
+import pytest
+
+import EdgeProcessor
+from EdgeProcessor import EdgeProcessor as Processor
+
+
+def frames(sample_format, values, header=b"\x01\x02", per_frame=4):
+    packed = [struct.pack(sample_format, value) for value in values]
+    return [header + b"".join(packed[start:start + per_frame]) for start in range(0, len(packed), per_frame)]
+
+
+@pytest.fixture(params=["pure", "numpy"])
+def backend(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(EdgeProcessor, "np", None)
+    return request.param
+
+
+@pytest.mark.parametrize("sample_format", ["<h", ">h", "!H", "=i", "<1f", "h", "<hxx"])
+def test_decode_matches_struct(backend, sample_format):
+    values = [0, 1, 2, 3, 4, 5, 6, 7, 100, 3]
+    processor = Processor(sample_format, skip=2, decimate=3, window=4, thresholds={'max': 50})
+    result = processor.process(frames(sample_format, values))
+
+    assert result['samples'] == len(values)
+    assert result['series'] == [0, 3, 6, 3]
+    assert [window['count'] for window in result['windows']] == [4, 4, 2]
+    assert result['windows'][2] == {'min': 3, 'max': 100, 'mean': 51.5, 'count': 2}
+    assert result['alarmCount'] == 1
+    assert result['alarms'] == [{'index': 8, 'value': 100}]
+    assert processor.needs_raw(result)
+
+
+def test_partial_samples_are_cut(backend):
+    processor = Processor("<h", skip=1)
+    assert processor.process([b"\x00\x01\x00\x02", b"\x00"])['samples'] == 1
+
+
+@pytest.mark.parametrize("sample_format", ["<hhh", "<3h", "", "<z"])
+def test_formats_of_several_or_no_values_are_rejected(sample_format):
+    with pytest.raises(ValueError):
+        Processor(sample_format)
+
+
+def test_numpy_dtype_uses_struct_sizes():
+    np = pytest.importorskip("numpy")
+    assert EdgeProcessor.numpy_dtype("<l") == np.dtype("<i4")
+    assert EdgeProcessor.numpy_dtype("!f") == np.dtype(">f4")
+    assert EdgeProcessor.numpy_dtype("<hxx") is None
@@ -0,0 +1,207 @@
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+import FrameRing as frame_ring
+from FrameRing import POLICY_BLOCK, POLICY_OVERWRITE, FrameRing
+
+FRAMES = 5000
+
+
+@pytest.fixture(params=[False, True], ids=["mmap", "shared"])
+def shared(request):
+    return request.param
+
+
+def payload(index: int, size: int = 64) -> bytes:
+    return bytes([index % 256]) * size
+
+
+def produce(ring: FrameRing, count: int):
+    for index in range(count):
+        ring.write(float(index), index % 65536, payload(index, ring.payload_size))
+    ring.close()
+
+
+def consume(name: str, count: int, ready, results):
+    ring = FrameRing.attach(name)
+    ready.set()
+    received = torn = 0
+    last = -1.0
+    deadline = time.monotonic() + 60
+    try:
+        while last < count - 1 and time.monotonic() < deadline:
+            frame = ring.read()
+            if frame is None:
+                continue
+            timestamp, device, data = frame
+            if timestamp <= last or device != int(timestamp) % 65536 or data != payload(int(timestamp), ring.payload_size):
+                torn += 1
+            last = timestamp
+            received += 1
+    finally:
+        ring.close()
+    results.put((received, torn, last))
+
+
+def test_block_keeps_order(shared):
+    ring = FrameRing(8, 64, POLICY_BLOCK, shared=shared)
+    try:
+        producer = threading.Thread(target=lambda: [ring.write(float(index), 1, payload(index)) for index in range(100)])
+        producer.start()
+        frames = [ring.read(5) for _ in range(100)]
+        producer.join()
+
+        assert [frame[0] for frame in frames] == [float(index) for index in range(100)]
+        assert all(data == payload(int(timestamp)) for timestamp, _, data in frames)
+        assert ring.read(0) is None
+        assert ring.dropped == 0
+    finally:
+        ring.close()
+
+
+def test_block_refuses_when_full_without_waiting(shared):
+    ring = FrameRing(4, 16, POLICY_BLOCK, shared=shared)
+    try:
+        assert all(ring.write(float(index), 0, b"x", 0) for index in range(4))
+        assert not ring.write(4.0, 0, b"x", 0)
+        assert not ring.write(5.0, 0, b"x", 0.01)
+        assert ring.dropped == 2
+        assert len(ring) == 4
+        assert [frame[0] for frame in ring.read_many(10, 0)] == [0.0, 1.0, 2.0, 3.0]
+        assert ring.write(6.0, 0, b"x", 0)
+    finally:
+        ring.close()
+
+
+def test_overwrite_replaces_oldest(shared):
+    ring = FrameRing(4, 16, POLICY_OVERWRITE, shared=shared)
+    try:
+        for index in range(10):
+            assert ring.write(float(index), 0, bytes([index]))
+        assert ring.dropped == 6
+        assert len(ring) == 4
+        assert [data for _, _, data in ring.frames()] == [bytes([index]) for index in range(6, 10)]
+        assert [frame[0] for frame in ring.read_many(10)] == [6.0, 7.0, 8.0, 9.0]
+        assert ring.read() is None
+    finally:
+        ring.close()
+
+
+def test_overwrite_skips_a_slot_being_written():
+    ring = FrameRing(4, 16, POLICY_OVERWRITE, shared=False)
+    try:
+        for index in range(4):
+            ring.write(float(index), 0, bytes([index]))
+        # A producer that announced frame 4 but was interrupted before counting it:
+        # it is overwriting the slot of frame 0
+        original = ring._counter
+
+        def interrupted(offset):
+            return 5 if offset == frame_ring._STARTED_OFFSET else original(offset)
+        ring._counter = interrupted
+        assert ring.read()[0] == 1.0
+    finally:
+        ring.close()
+
+
+def test_overwrite_leaves_a_frame_whose_stores_are_not_visible_yet():
+    ring = FrameRing(4, 16, POLICY_OVERWRITE, shared=False)
+    try:
+        ring.write(0.0, 7, b"abc")
+        # Counted in written, but the payload store has not reached this CPU
+        start = frame_ring._HEADER_SIZE + frame_ring._FRAME_HEADER.size
+        ring._buffer[start] ^= 0xff
+        assert ring.read() is None
+        assert len(ring) == 1
+        ring._buffer[start] ^= 0xff
+        assert ring.read() == (0.0, 7, b"abc")
+    finally:
+        ring.close()
+
+
+def test_close_keeps_live_views_readable():
+    # As a DataCache whose cached_data views outlive the measurement
+    ring = FrameRing(4, 16, POLICY_OVERWRITE, shared=False)
+    ring.write(0.0, 0, b"abc")
+    views = [data for _, _, data in ring.frames()]
+    ring.close()
+    assert bytes(views[0]) == b"abc"
+
+
+def test_oversized_frame_is_rejected():
+    ring = FrameRing(4, 16, POLICY_OVERWRITE, shared=False)
+    try:
+        with pytest.raises(ValueError):
+            ring.write(0.0, 0, bytes(17))
+    finally:
+        ring.close()
+
+
+def test_block_across_processes():
+    context = multiprocessing.get_context("spawn")
+    ring = FrameRing(64, 64, POLICY_BLOCK, context=context)
+    try:
+        process = context.Process(target=produce, args=(ring, FRAMES))
+        process.start()
+        timestamps = []
+        while len(timestamps) < FRAMES:
+            frame = ring.read(30)
+            assert frame is not None
+            timestamp, device, data = frame
+            assert device == int(timestamp) % 65536 and data == payload(int(timestamp), ring.payload_size)
+            timestamps.append(timestamp)
+        process.join(30)
+
+        assert process.exitcode == 0
+        assert timestamps == [float(index) for index in range(FRAMES)]
+        assert ring.dropped == 0
+    finally:
+        ring.close()
+
+
+def test_overwrite_across_processes_returns_intact_frames():
+    context = multiprocessing.get_context("spawn")
+    ring = FrameRing(8, 256, POLICY_OVERWRITE)
+    try:
+        process = context.Process(target=produce, args=(ring, FRAMES * 10))
+        process.start()
+        last = -1.0
+        while process.is_alive() or len(ring):
+            frame = ring.read()
+            if frame is None:
+                continue
+            timestamp, device, data = frame
+            # Frames may be lost, but never torn or out of order
+            assert timestamp > last
+            assert device == int(timestamp) % 65536 and data == payload(int(timestamp), ring.payload_size)
+            last = timestamp
+        process.join(30)
+
+        assert process.exitcode == 0
+        assert last == float(FRAMES * 10 - 1)
+    finally:
+        ring.close()
+
+
+def test_overwrite_between_spawned_writer_and_reader_returns_no_torn_frames():
+    context = multiprocessing.get_context("spawn")
+    ring = FrameRing(8, 256, POLICY_OVERWRITE)
+    try:
+        ready, results = context.Event(), context.Queue()
+        reader = context.Process(target=consume, args=(ring.name, FRAMES * 10, ready, results))
+        reader.start()
+        assert ready.wait(30)
+        writer = context.Process(target=produce, args=(ring, FRAMES * 10))
+        writer.start()
+        writer.join(60)
+        received, torn, last = results.get(timeout=60)
+        reader.join(30)
+
+        assert writer.exitcode == 0 and reader.exitcode == 0
+        assert torn == 0
+        assert received > 0 and last == float(FRAMES * 10 - 1)
+    finally:
+        ring.close()
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+from GattScheduler import GattScheduler
+
+
+class Recorder:
+    """
+    GATT operations that take a fixed time, recording their order and how many ran at once.
+    """
+    def __init__(self):
+        self.running = {}  # address -> operations running
+        self.started = []  # (address, name)
+        self.most_per_device = 0
+        self.most_overall = 0
+
+    def operation(self, address, name, duration=0.02):
+        async def run():
+            self.started.append((address, name))
+            self.running[address] = self.running.get(address, 0) + 1
+            self.most_per_device = max(self.most_per_device, self.running[address])
+            self.most_overall = max(self.most_overall, sum(self.running.values()))
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                self.running[address] -= 1
+            return name
+        return run
+
+
+def test_operations_of_a_device_run_one_at_a_time_in_order():
+    async def scenario():
+        scheduler = GattScheduler(concurrency=2)
+        recorder = Recorder()
+        operations = [(address, f"{address}{index}") for index in range(4) for address in "ABCD"]
+        tasks = [asyncio.create_task(scheduler.run(address, "read_gatt_char", recorder.operation(address, name)))
+                 for address, name in operations]
+        await asyncio.sleep(0)
+        queued = scheduler.queued()
+        results = await asyncio.gather(*tasks)
+        return scheduler, recorder, operations, queued, results
+
+    scheduler, recorder, operations, queued, results = asyncio.run(scenario())
+    assert results == [name for _, name in operations]
+    assert recorder.most_per_device == 1
+    assert recorder.most_overall == 2
+    for address in "ABCD":
+        assert [name for device, name in recorder.started if device == address] == [f"{address}{index}" for index in range(4)]
+    assert queued == 14  # two running
+    assert scheduler.queued() == 0 and scheduler.stats['operations'] == 16
+
+
+def test_timeout_starts_when_the_operation_starts():
+    async def scenario():
+        scheduler = GattScheduler(concurrency=1, timeout=0.1)
+        recorder = Recorder()
+        first = asyncio.create_task(scheduler.run("A", "write_gatt_char", recorder.operation("A", "slow", 0.08)))
+        # Waits 0.08 s for the first, then runs 0.05 s: within its own 0.1 s
+        second = asyncio.create_task(scheduler.run("A", "write_gatt_char", recorder.operation("A", "queued", 0.05)))
+        return await asyncio.gather(first, second), scheduler.stats
+
+    results, stats = asyncio.run(scenario())
+    assert results == ["slow", "queued"]
+    assert stats['timeouts'] == 0
+
+
+def test_timed_out_operation_is_cancelled_and_frees_the_device():
+    cancelled = []
+
+    async def hanging():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def scenario():
+        scheduler = GattScheduler(timeout=10, timeouts={'start_notify': 0.05})
+        recorder = Recorder()
+        with pytest.raises(asyncio.TimeoutError):
+            await scheduler.run("A", "start_notify", hanging)
+        with pytest.raises(asyncio.TimeoutError):
+            await scheduler.run("A", "read_gatt_char", hanging, timeout=0.05)
+        result = await scheduler.run("A", "read_gatt_char", recorder.operation("A", "next"))
+        return scheduler, result
+
+    scheduler, result = asyncio.run(scenario())
+    assert cancelled == [True, True]
+    assert result == "next"
+    assert scheduler.stats == {'operations': 3, 'timeouts': 2, 'errors': 0}
+
+
+def test_failed_operation_frees_the_device_and_forget_drops_it():
+    async def failing():
+        raise OSError("Not connected")
+
+    async def scenario():
+        scheduler = GattScheduler()
+        recorder = Recorder()
+        with pytest.raises(OSError):
+            await scheduler.run("A", "read_gatt_char", failing)
+        result = await scheduler.run("A", "read_gatt_char", recorder.operation("A", "next"))
+        return scheduler, result
+
+    scheduler, result = asyncio.run(scenario())
+    assert result == "next"
+    assert scheduler.stats['errors'] == 1
+    scheduler.forget("A")
+    assert "A" not in scheduler._locks
@@ -0,0 +1,89 @@
+import asyncio
+import types
+
+import paho.mqtt.client as mqtt
+
+from InflightWindow import InflightWindow
+from InstructionQueue import InstructionQueue
+from MqttHandler import MqttHandler
+
+
+class RecordingClient:
+    """
+    Stands in for the paho client, remembering what was handed to it.
+    """
+    def __init__(self):
+        self.published = []  # (mid, payload)
+
+    def publish(self, topic, payload, qos=0, properties=None):
+        mid = len(self.published) + 1
+        self.published.append((mid, payload))
+        return types.SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS, mid=mid)
+
+
+def test_receive_maximum_sets_the_ceiling():
+    window = InflightWindow(max_window=100)
+    window.set_receive_maximum(20)
+    assert (window.window, window.ceiling) == (20, 20)
+    window.set_receive_maximum(65535)
+    assert window.window == 100
+    window.set_receive_maximum(None)  # MQTTv3.1.1
+    assert window.window == 100
+
+
+def test_window_shrinks_when_acks_slow_down_and_grows_when_saturated():
+    window = InflightWindow(max_window=16)
+    window.set_receive_maximum(8)
+    now = 0.0
+
+    def round_trip(rtt):
+        nonlocal now
+        mids = range(1, window.window + 1)
+        for mid in mids:
+            window.on_send(mid, now)
+        assert not window.has_capacity()
+        for mid in mids:
+            window.on_ack(mid, now + rtt)
+        now += 1.0
+
+    round_trip(0.01)
+    assert window.window == 8  # at the ceiling
+    round_trip(0.2)  # the broker is queueing
+    assert window.window == 6
+    sizes = []
+    for _ in range(60):  # until the smoothed RTT is back near the baseline
+        round_trip(0.01)
+        sizes.append(window.window)
+    assert sizes[-1] == 8
+    recovering = sizes[sizes.index(min(sizes)):]
+    assert recovering == sorted(recovering)  # grows step by step once acks are healthy again
+    assert window.snapshot()['inflight'] == 0
+
+
+def test_full_window_backlogs_messages_and_sends_them_in_order_as_acks_arrive():
+    async def scenario():
+        handler = MqttHandler(InstructionQueue(), "aa:bb:cc:dd:ee:ff", "broker", 1883, protocol=mqtt.MQTTv5)
+        client = handler.client = RecordingClient()
+        handler.connected = True
+        handler._handle_session_start(2)  # CONNACK Receive Maximum
+
+        futures = [handler.publish(f"message {index}", wait_for_ack=True) for index in range(5)]
+        assert [payload for _, payload in client.published] == ["message 0", "message 1"]
+        assert len(handler._backlog) == 3
+
+        handler._handle_ack(2, 1.0, True)
+        assert [payload for _, payload in client.published][2:] == ["message 2"]
+        assert futures[1].result() and not futures[0].done()
+
+        # A reconnect resends what was not acknowledged, ahead of the backlog
+        handler._requeue_inflight()
+        assert [entry[1] for entry in handler._backlog] == ["message 0", "message 2", "message 3", "message 4"]
+        handler._handle_session_start(10)
+
+        for mid, _ in client.published[3:]:
+            handler._handle_ack(mid, 2.0, True)
+        return client, futures
+
+    client, futures = asyncio.run(scenario())
+    assert [payload for _, payload in client.published] == [f"message {index}" for index in (0, 1, 2, 0, 2, 3, 4)]
+    assert all(future.result() for future in futures)
@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from InstructionQueue import InstructionQueue
+from Instructions import from_message
+
+
+def instruction(**message):
+    return from_message(message)
+
+
+def drain(queue):
+    taken = []
+    while True:
+        try:
+            taken.append(queue.get_nowait())
+        except asyncio.QueueEmpty:
+            return taken
+
+
+def test_duplicate_message_id_is_dropped():
+    queue = InstructionQueue()
+    assert queue.put_nowait(instruction(type='pair', address="A", messageId="m1"))
+    assert not queue.put_nowait(instruction(type='pair', address="A", messageId="m1"))
+    assert queue.put_nowait(instruction(type='pair', address="A", messageId="m2"))
+    assert queue.stats['duplicate'] == 1
+    assert queue.qsize() == 2
+
+
+def test_message_id_is_forgotten_after_the_window():
+    queue = InstructionQueue(dedupe_window=0.05)
+    assert queue.put_nowait(instruction(type='unpair', address="A", id=7))
+    time.sleep(0.06)
+    assert queue.put_nowait(instruction(type='unpair', address="A", id=7))
+
+
+def test_pending_reads_coalesce_per_address():
+    queue = InstructionQueue()
+    assert queue.put_nowait(instruction(type='read', address="A"))
+    assert not queue.put_nowait(instruction(type='read', address="A"))
+    assert queue.put_nowait(instruction(type='read', address="B"))
+    assert queue.stats['pending'] == 1
+    assert [taken.address for taken in drain(queue)] == ["A", "B"]
+
+
+def test_read_in_progress_is_shared_until_task_done():
+    queue = InstructionQueue()
+    queue.put_nowait(instruction(type='read', address="A"))
+    running = queue.get_nowait()
+    assert not queue.put_nowait(instruction(type='read', address="A"))
+    assert queue.stats['in_progress'] == 1
+
+    queue.task_done(running)
+    assert queue.put_nowait(instruction(type='read', address="A"))
+
+
+def test_sensorlists_coalesce_by_their_sensors():
+    queue = InstructionQueue()
+    assert queue.put_nowait(instruction(type='sensorlist', sensors=[{'address': "A"}, {'address': "B"}]))
+    assert not queue.put_nowait(instruction(type='sensorlist', sensors=[{'address': "B"}, {'address': "A"}]))
+    assert queue.put_nowait(instruction(type='sensorlist', sensors=[{'address': "A"}]))
+
+
+def test_pairing_is_never_coalesced():
+    queue = InstructionQueue()
+    assert queue.put_nowait(instruction(type='pair', address="A"))
+    assert queue.put_nowait(instruction(type='pair', address="A"))
+    assert queue.qsize() == 2
+
+
+def test_priority_order_and_trust_split():
+    queue = InstructionQueue()
+    queue.put_nowait(instruction(type='scan'))
+    queue.put_nowait(instruction(type='read', address="A", atl=0.5))
+    queue.put_nowait(instruction(type='pair', address="B"))
+
+    taken = drain(queue)
+    assert [item.type for item in taken] == ['trust', 'pair', 'read', 'scan']
+    assert taken[0].atl == 0.5
+    assert taken[2].atl is None
+
+
+def test_trust_split_off_a_coalesced_read_is_kept():
+    queue = InstructionQueue()
+    queue.put_nowait(instruction(type='read', address="A"))
+    assert not queue.put_nowait(instruction(type='read', address="A", atl=0.9))
+    assert [item.type for item in drain(queue)] == ['trust', 'read']
+
+
+def test_expired_instructions_are_reported_not_returned():
+    expired = []
+    queue = InstructionQueue(default_ttls={'read': 0.0}, expired_callback=expired.append)
+    queue.put_nowait(instruction(type='read', address="A"))
+    queue.put_nowait(instruction(type='pair', address="B", ttl=60))
+    assert [item.type for item in drain(queue)] == ['pair']
+    assert [item.type for item in expired] == ['read']
+    # An expired read no longer blocks the next one
+    assert queue.put_nowait(instruction(type='read', address="A"))
+
+
+def test_wait_wakes_up_when_another_thread_queues():
+    queue = InstructionQueue()
+
+    async def scenario():
+        assert not await queue.wait(0.01)
+        timer = threading.Timer(0.05, queue.put_nowait, [instruction(type='scan')])
+        timer.start()
+        start = time.monotonic()
+        assert await queue.wait(5)
+        return time.monotonic() - start
+
+    assert asyncio.run(scenario()) < 1.0
+
+
+@pytest.mark.parametrize("payload", [{'type': 'read'}, {'type': 'pair', 'address': ""}])
+def test_instructions_without_address_are_invalid(payload):
+    with pytest.raises(ValueError):
+        from_message(payload)
+
+
+def test_held_read_stays_queued_without_blocking_more_urgent_instructions():
+    queue = InstructionQueue()
+    queue.put_nowait(instruction(type='read', address="A"))
+    queue.put_nowait(instruction(type='scan'))
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_nowait(held=('read',))
+    assert queue.qsize() == 2
+
+    queue.put_nowait(instruction(type='unpair', address="B"))
+    assert queue.get_nowait(held=('read',)).type == 'unpair'
+    assert [item.type for item in drain(queue)] == ['read', 'scan']
+
+
+def test_wait_since_ignores_instructions_already_waiting():
+    queue = InstructionQueue()
+
+    async def scenario():
+        queue.put_nowait(instruction(type='read', address="A"))
+        arrivals = queue.arrivals
+        assert await queue.wait(5)
+        assert not await queue.wait(0.01, since=arrivals)
+        timer = threading.Timer(0.05, queue.put_nowait, [instruction(type='trust', atl=0.5)])
+        timer.start()
+        start = time.monotonic()
+        assert await queue.wait(5, since=arrivals)
+        return time.monotonic() - start
+
+    assert asyncio.run(scenario()) < 1.0
@@ -0,0 +1,70 @@
+import json
+import types
+
+import paho.mqtt.client as mqtt
+
+import Instructions
+from InstructionQueue import InstructionQueue
+from MqttHandler import MqttHandler
+
+MAC = "aa:bb:cc:dd:ee:ff"
+
+
+class EchoingBroker:
+    """
+    Stands in for the paho client of a broker without No Local: every message
+    published on a subscribed topic is delivered back to the handler.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.subscriptions = {}  # topic -> subscribe keyword arguments
+        self.mid = 0
+
+    def subscribe(self, topic, **options):
+        self.subscriptions[topic] = options
+        return (mqtt.MQTT_ERR_SUCCESS, 1)
+
+    def publish(self, topic, payload, qos=0, properties=None):
+        self.mid += 1
+        if topic in self.subscriptions:
+            message = mqtt.MQTTMessage(topic=topic.encode())
+            message.payload = payload.encode()
+            self.handler._on_message(self, None, message)
+        return types.SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS, mid=self.mid)
+
+
+def connected_handler(protocol):
+    queue = InstructionQueue()
+    handler = MqttHandler(queue, MAC, "broker", 1883, protocol=protocol)
+    handler.client = EchoingBroker(handler)
+    handler.connected = True
+    assert handler.subscribe()
+    return queue, handler
+
+
+def test_own_messages_are_dropped_by_their_prefix_on_mqtt_3_1_1(monkeypatch):
+    queue, handler = connected_handler(mqtt.MQTTv311)
+    assert handler.client.subscriptions == {MAC: {}}  # no No Local before MQTTv5
+
+    parsed = []
+    monkeypatch.setattr(Instructions, "loads", lambda payload: parsed.append(payload) or json.loads(payload))
+
+    # Shaped like instructions, so only recognising them as our own keeps them out of the queue
+    assert handler.publish(json.dumps({'from': MAC, 'timestamp': 1, 'type': "getsensorlist"}))
+    assert handler.publish(json.dumps({'from': MAC, 'type': "read", 'address': "11:22:33:44:55:66"}))
+    assert queue.empty()
+    assert parsed == []
+
+
+def test_instructions_from_the_platform_are_queued_on_mqtt_3_1_1():
+    queue, handler = connected_handler(mqtt.MQTTv311)
+
+    assert handler.publish(json.dumps({'from': "platform", 'type': "read", 'address': "11:22:33:44:55:66"}))
+    instruction = queue.get_nowait()
+    assert (instruction.type, instruction.address) == ('read', "11:22:33:44:55:66")
+
+
+def test_mqtt_5_subscribes_with_no_local():
+    _, handler = connected_handler(mqtt.MQTTv5)
+
+    assert handler.client.subscriptions[MAC]['options'].noLocal
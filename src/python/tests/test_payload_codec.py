@@ -0,0 +1,63 @@
+import json
+import zlib
+
+import PayloadCodec
+from PayloadCodec import CONTENT_TYPE_DEFLATE, CONTENT_TYPE_JSON, FRAME_VERSION, PayloadCodec as Codec
+
+ENVELOPE = {
+    'from': "aa:bb:cc:dd:ee:ff",
+    'gatewayMac': "aa:bb:cc:dd:ee:ff",
+    'sensorMac': "11:22:33:44:55:66",
+    'timestamp': "2024-05-01T12:00:00.000+00:00",
+    'type': 'measurement',
+    'seq': 7,
+}
+
+
+def test_small_payload_is_plain_json():
+    data = bytes(range(10))
+    payload, content_type = Codec(min_size=1024).encode(ENVELOPE, data)
+
+    assert content_type == CONTENT_TYPE_JSON
+    assert not PayloadCodec.is_frame(payload)
+    assert json.loads(payload) == dict(ENVELOPE, value=data.hex(','))
+    assert PayloadCodec.decode(payload) == dict(ENVELOPE, value=data.hex(','))
+
+
+def test_disabled_codec_never_compresses():
+    payload, content_type = Codec(enabled=False).encode(ENVELOPE, bytes(4096))
+
+    assert content_type == CONTENT_TYPE_JSON
+    assert not PayloadCodec.is_frame(payload)
+
+
+def test_frame_round_trip():
+    data = bytes(index % 251 for index in range(4096))
+    payload, content_type = Codec(min_size=1024).encode(ENVELOPE, data)
+
+    assert content_type == CONTENT_TYPE_DEFLATE
+    assert payload[0] == FRAME_VERSION
+    assert PayloadCodec.is_frame(payload)
+    assert len(payload) < len(data) * 3
+    assert PayloadCodec.decode(payload) == dict(ENVELOPE, value=data.hex(','))
+
+
+def test_frame_envelope_needs_the_dictionary():
+    payload, _ = Codec(min_size=0).encode(ENVELOPE, b"\x01\x02\x03")
+    envelope_length = int.from_bytes(payload[1:5], 'big')
+    compressed_envelope = payload[5:5 + envelope_length]
+
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=PayloadCodec.ENVELOPE_DICTIONARY)
+    assert json.loads(decompressor.decompress(compressed_envelope)) == ENVELOPE
+    # The envelope refers back into the preset dictionary, so it does not inflate without it
+    try:
+        assert json.loads(zlib.decompress(compressed_envelope, -zlib.MAX_WBITS)) != ENVELOPE
+    except (zlib.error, ValueError):
+        pass
+
+
+def test_empty_data_round_trip():
+    payload, content_type = Codec(min_size=0).encode(ENVELOPE, b"")
+
+    assert content_type == CONTENT_TYPE_DEFLATE
+    assert PayloadCodec.decode(payload) == dict(ENVELOPE, value="")
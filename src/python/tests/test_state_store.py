@@ -0,0 +1,73 @@
+import json
+import os
+import stat
+
+import pytest
+
+import StateStore as state_store
+from StateStore import StateStore
+
+STATE = {'mac_address': "aa:bb:cc:dd:ee:ff", 'secret': "s3cret", 'sensors': {"11:22:33:44:55:66": {'rate': 50}}}
+
+
+def leftovers(tmp_path):
+    return sorted(name for name in os.listdir(tmp_path) if name != "state.json")
+
+
+def test_round_trip_is_private_and_skips_unchanged_snapshots(tmp_path):
+    store = StateStore(str(tmp_path / "state.json"))
+    assert store.load() is None
+    assert store.save(STATE)
+    assert not store.save(dict(STATE))
+
+    assert StateStore(str(tmp_path / "state.json")).load() == dict(STATE, version=state_store.SNAPSHOT_VERSION)
+    assert stat.S_IMODE(os.stat(tmp_path / "state.json").st_mode) == 0o600
+    assert leftovers(tmp_path) == []
+
+
+@pytest.mark.parametrize("failure", ["serialise", "rename"])
+def test_failed_save_keeps_the_previous_snapshot(tmp_path, monkeypatch, failure):
+    store = StateStore(str(tmp_path / "state.json"))
+    assert store.save(STATE)
+
+    if failure == "serialise":
+        # json.dump fails halfway through the temporary file
+        changed = dict(STATE, secret="new", sensors={"11:22:33:44:55:66": object()})
+    else:
+        changed = dict(STATE, secret="new")
+
+        def broken_replace(source, destination):
+            raise OSError("no space left on device")
+        monkeypatch.setattr(state_store.os, "replace", broken_replace)
+    assert not store.save(changed)
+
+    monkeypatch.undo()
+    assert StateStore(str(tmp_path / "state.json")).load()['secret'] == "s3cret"
+    assert leftovers(tmp_path) == []
+    # Not mistaken for saved, so the next save writes it
+    assert store.save(dict(STATE, secret="new"))
+
+
+@pytest.mark.parametrize("content", [
+    '{"version": 1, "secret": "s3c',  # cut off by a crash of a writer that did not replace atomically
+    '',
+    '[1, 2]',
+    '{"version": 99, "secret": "s3cret"}',
+])
+def test_unusable_snapshot_is_ignored(tmp_path, content):
+    (tmp_path / "state.json").write_text(content)
+    store = StateStore(str(tmp_path / "state.json"))
+
+    assert store.load() is None
+    assert store.save(STATE)
+    assert json.loads((tmp_path / "state.json").read_text())['secret'] == "s3cret"
+
+
+def test_clear_removes_the_snapshot(tmp_path):
+    store = StateStore(str(tmp_path / "state.json"))
+    store.clear()
+    assert store.save(STATE)
+    store.clear()
+
+    assert not (tmp_path / "state.json").exists()
+    assert store.save(STATE)
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from TcbClient import TcbClient, TcbError, TcbRefused
+
+
+class BatchTcb(TcbClient):
+    """
+    TcbClient whose batch requests get fixed results, without HTTP.
+    """
+    def __init__(self, results):
+        super().__init__("http://tcb", batch_delay=0.01)
+        self.results = results
+        self.batches = []
+
+    def _post(self, endpoint, path, body):
+        self.batches.append(body)
+        return {'results': self.results}
+
+
+def sign_all(tcb, uids):
+    async def scenario():
+        return await asyncio.gather(*(tcb.sign_nonce(uid, "00ff") for uid in uids), return_exceptions=True)
+
+    return asyncio.run(scenario())
+
+
+def test_malformed_entries_fail_only_their_device():
+    tcb = BatchTcb([
+        {'uid': '1a', 'signednonce': "ab"},
+        "Internal Server Error",
+        {'uid': '1c', 'signednonce': 5},
+        {'uid': '9d', 'error': "Invalid UID format"},
+        {'uid': '1f', 'signednonce': "cd"},  # answers for another device
+        {'signednonce': "ef"},  # like the single endpoint, without the UID
+    ])
+    results = sign_all(tcb, ['1a', '1b', '1c', '9d', '1e', '1g'])
+
+    assert len(tcb.batches) == 1
+    assert results[0] == "ab" and results[5] == "ef"
+    assert isinstance(results[3], TcbRefused) and str(results[3]) == "Invalid UID format"
+    for failed in (results[1], results[2], results[4]):
+        assert type(failed) is TcbError
+
+
+@pytest.mark.parametrize("results", [{'1a': "ab"}, "ab", [{'uid': '1a', 'signednonce': "ab"}]])
+def test_results_that_are_not_one_list_entry_per_device_fail_the_batch(results):
+    outcome = sign_all(BatchTcb(results), ['1a', '1b'])
+
+    assert all(type(result) is TcbError for result in outcome)